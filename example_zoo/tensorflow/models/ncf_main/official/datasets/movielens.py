@@ -21,6 +21,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import hashlib
+import io
+import multiprocessing
 import os
 import sys
 import tempfile
@@ -46,6 +50,12 @@ DATASETS = [ML_1M, ML_20M]
 RATINGS_FILE = "ratings.csv"
 MOVIES_FILE = "movies.csv"
 
+# A binary copy of the columns of RATINGS_FILE, written alongside it.
+RATINGS_BINARY_FILE = "ratings.npz"
+
+# The raw csv files are regularized in blocks of whole lines of about this size.
+_TRANSFORM_BLOCK_BYTES = 2 ** 26
+
 # URL to download dataset
 _DATA_URL = "http://files.grouplens.org/datasets/movielens/"
 
@@ -83,6 +93,21 @@ NUM_RATINGS = {
     ML_20M: 20000263
 }
 
+_RATING_DTYPES = {
+    USER_COLUMN: np.int32,
+    ITEM_COLUMN: np.int32,
+    RATING_COLUMN: np.float32,
+    TIMESTAMP_COLUMN: np.int64,
+}
+
+# The size and sha256 of the regularized csv that a binary ratings file was
+# written from.
+_BINARY_SOURCE_BYTES = "source_bytes"
+_BINARY_SOURCE_SHA256 = "source_sha256"
+
+# The csv is hashed in chunks of this size when validating a binary copy.
+_HASH_CHUNK_BYTES = 2 ** 23
+
 
 def _download_and_clean(dataset, data_dir):
   """Download MovieLens dataset in a standard format.
@@ -139,35 +164,164 @@ def _download_and_clean(dataset, data_dir):
     tf.gfile.DeleteRecursively(temp_dir)
 
 
-def _transform_csv(input_path, output_path, names, skip_first, separator=","):
+def _read_line_blocks(f, block_bytes, skip_first):
+  """Yield blocks of whole lines from a binary file object."""
+  remainder = b""
+  while True:
+    block = f.read(block_bytes)
+    if not block:
+      break
+    block = remainder + block
+    if skip_first:
+      end_of_first = block.find(b"\n")
+      if end_of_first < 0:
+        remainder = block
+        continue
+      block = block[end_of_first + 1:]
+      skip_first = False
+
+    end = block.rfind(b"\n") + 1
+    remainder = block[end:]
+    if end:
+      yield block[:end]
+
+  if remainder and not skip_first:
+    yield remainder
+
+
+def _regularize_block(block, separator):
+  """Convert a block of lines with the given separator to csv."""
+  text = block.decode("utf-8", errors="ignore")
+  if separator == ",":
+    return text.encode("utf-8")
+
+  if "," not in text:
+    return text.replace(separator, ",").encode("utf-8")
+
+  # Fields which contain commas (such as movie titles) need to be quoted.
+  lines = []
+  for line in text.split("\n"):
+    fields = line.split(separator)
+    lines.append(",".join('"{}"'.format(field) if "," in field else field
+                          for field in fields))
+  return "\n".join(lines).encode("utf-8")
+
+
+def _transform_csv(input_path, output_path, names, skip_first, separator=",",
+                   binary_output_path=None):
   """Transform csv to a regularized format.
 
+  The file is read and converted in blocks of many lines, rather than line by
+  line, so the common case of a block with no fields that need quoting is a
+  single string replacement.
+
   Args:
     input_path: The path of the raw csv.
     output_path: The path of the cleaned csv.
     names: The csv column names.
     skip_first: Boolean of whether to skip the first line of the raw csv.
     separator: Character used to separate fields in the raw csv.
+    binary_output_path: If set, the columns (which must be RATING_COLUMNS) are
+      also parsed and saved to this path as a .npz file. See
+      load_ratings_binary.
   """
   if six.PY2:
     names = [n.decode("utf-8") for n in names]
 
+  columns = {name: [] for name in names}
+  num_bytes = 0
+  sha256 = hashlib.sha256()
   with tf.gfile.Open(output_path, "wb") as f_out, \
       tf.gfile.Open(input_path, "rb") as f_in:
 
     # Write column names to the csv.
-    f_out.write(",".join(names).encode("utf-8"))
-    f_out.write(b"\n")
-    for i, line in enumerate(f_in):
-      if i == 0 and skip_first:
-        continue  # ignore existing labels in the csv
+    header = ",".join(names).encode("utf-8") + b"\n"
+    f_out.write(header)
+    num_bytes += len(header)
+    sha256.update(header)
+    for block in _read_line_blocks(f_in, _TRANSFORM_BLOCK_BYTES, skip_first):
+      block = _regularize_block(block, separator)
+      f_out.write(block)
+      num_bytes += len(block)
+      sha256.update(block)
+
+      if binary_output_path:
+        df = pd.read_csv(io.BytesIO(block), header=None, names=names,
+                         dtype=_RATING_DTYPES)
+        for name in names:
+          columns[name].append(df[name].values)
+
+  if binary_output_path:
+    with tf.gfile.Open(binary_output_path, "wb") as f:
+      arrays = {name: np.concatenate(columns[name]) if columns[name] else
+                      np.zeros((0,), dtype=_RATING_DTYPES[name])
+                for name in names}
+      arrays[_BINARY_SOURCE_BYTES] = np.array(num_bytes, dtype=np.int64)
+      arrays[_BINARY_SOURCE_SHA256] = np.array(
+          six.text_type(sha256.hexdigest()))
+      np.savez(f, **arrays)
+
+
+def _transform_csv_star(kwargs):
+  _transform_csv(**kwargs)
+
+
+def _transform_csvs(jobs, num_workers=None):
+  """Run _transform_csv for several files, in parallel processes.
+
+  Args:
+    jobs: A list of dicts of _transform_csv arguments.
+    num_workers: The number of processes. Defaults to one per file, up to the
+      number of CPUs.
+  """
+  num_workers = num_workers or min(len(jobs), multiprocessing.cpu_count())
+  if num_workers <= 1:
+    for job in jobs:
+      _transform_csv(**job)
+    return
 
-      line = line.decode("utf-8", errors="ignore")
-      fields = line.split(separator)
-      if separator != ",":
-        fields = ['"{}"'.format(field) if "," in field else field
-                  for field in fields]
-      f_out.write(",".join(fields).encode("utf-8"))
+  with contextlib.closing(multiprocessing.Pool(num_workers)) as pool:
+    pool.map(_transform_csv_star, jobs)
+
+
+def _file_sha256(path):
+  sha256 = hashlib.sha256()
+  with tf.gfile.Open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b""):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+
+def load_ratings_binary(ratings_path, columns=None):
+  """Read the columns of the binary copy of a regularized ratings csv.
+
+  Args:
+    ratings_path: The path of a RATINGS_FILE.
+    columns: The RATING_COLUMNS to read. Others are not loaded. (Default all.)
+
+  Returns:
+    A dict of the arrays of the columns, or None if there is no binary copy of
+    the csv or the csv has changed since it was written. Changes are detected
+    by size, and otherwise by hashing the csv, which is much cheaper than
+    parsing it.
+  """
+  binary_path = os.path.join(os.path.dirname(ratings_path),
+                             RATINGS_BINARY_FILE)
+  if not tf.gfile.Exists(binary_path):
+    return None
+
+  with tf.gfile.Open(binary_path, "rb") as f:
+    # Each array of an .npz file is only read when it is accessed.
+    npz = np.load(f, allow_pickle=False)
+    source_bytes = int(npz[_BINARY_SOURCE_BYTES])
+    source_sha256 = (npz[_BINARY_SOURCE_SHA256].item()
+                     if _BINARY_SOURCE_SHA256 in npz.files else None)
+    if (source_bytes != tf.gfile.Stat(ratings_path).length or
+        source_sha256 != _file_sha256(ratings_path)):
+      tf.logging.info("Ignoring {}, as {} has changed.".format(
+          binary_path, ratings_path))
+      return None
+    return {column: npz[column] for column in columns or RATING_COLUMNS}
 
 
 def _regularize_1m_dataset(temp_dir):
@@ -189,15 +343,15 @@ def _regularize_1m_dataset(temp_dir):
   """
   working_dir = os.path.join(temp_dir, ML_1M)
 
-  _transform_csv(
-      input_path=os.path.join(working_dir, "ratings.dat"),
-      output_path=os.path.join(temp_dir, RATINGS_FILE),
-      names=RATING_COLUMNS, skip_first=False, separator="::")
-
-  _transform_csv(
-      input_path=os.path.join(working_dir, "movies.dat"),
-      output_path=os.path.join(temp_dir, MOVIES_FILE),
-      names=MOVIE_COLUMNS, skip_first=False, separator="::")
+  _transform_csvs([
+      dict(input_path=os.path.join(working_dir, "ratings.dat"),
+           output_path=os.path.join(temp_dir, RATINGS_FILE),
+           names=RATING_COLUMNS, skip_first=False, separator="::",
+           binary_output_path=os.path.join(temp_dir, RATINGS_BINARY_FILE)),
+      dict(input_path=os.path.join(working_dir, "movies.dat"),
+           output_path=os.path.join(temp_dir, MOVIES_FILE),
+           names=MOVIE_COLUMNS, skip_first=False, separator="::"),
+  ])
 
   tf.gfile.DeleteRecursively(working_dir)
 
@@ -223,15 +377,15 @@ def _regularize_20m_dataset(temp_dir):
   """
   working_dir = os.path.join(temp_dir, ML_20M)
 
-  _transform_csv(
-      input_path=os.path.join(working_dir, "ratings.csv"),
-      output_path=os.path.join(temp_dir, RATINGS_FILE),
-      names=RATING_COLUMNS, skip_first=True, separator=",")
-
-  _transform_csv(
-      input_path=os.path.join(working_dir, "movies.csv"),
-      output_path=os.path.join(temp_dir, MOVIES_FILE),
-      names=MOVIE_COLUMNS, skip_first=True, separator=",")
+  _transform_csvs([
+      dict(input_path=os.path.join(working_dir, "ratings.csv"),
+           output_path=os.path.join(temp_dir, RATINGS_FILE),
+           names=RATING_COLUMNS, skip_first=True, separator=",",
+           binary_output_path=os.path.join(temp_dir, RATINGS_BINARY_FILE)),
+      dict(input_path=os.path.join(working_dir, "movies.csv"),
+           output_path=os.path.join(temp_dir, MOVIES_FILE),
+           names=MOVIE_COLUMNS, skip_first=True, separator=","),
+  ])
 
   tf.gfile.DeleteRecursively(working_dir)
 
@@ -14,8 +14,6 @@
 # ==============================================================================
 """Central location for NCF specific values."""
 
-import sys
-
 import numpy as np
 
 from official.datasets import movielens
@@ -56,16 +54,39 @@ DUPLICATE_MASK = "duplicate_mask"
 HR_METRIC_NAME = "HR_METRIC"
 NDCG_METRIC_NAME = "NDCG_METRIC"
 
-# Trying to load a cache created in py2 when running in py3 will cause an
-# error due to differences in unicode handling.
-RAW_CACHE_FILE = "raw_data_cache_py{}.pickle".format(sys.version_info[0])
-CACHE_INVALIDATION_SEC = 3600 * 24
+# Directory of the preprocessed ratings, stored as one .npy file per array.
+RAW_CACHE_DIR = "raw_data_cache"
+
+# Directory of the assembled evaluation sets, one subdirectory of .npy files
+# per dataset and eval seed. Eval sets are cached with this seed unless another
+# is given.
+EVAL_CACHE_DIR = "eval_data_cache"
+DEFAULT_EVAL_SEED = 0
 
 # ==============================================================================
 # == Data Generation ===========================================================
 # ==============================================================================
-CYCLES_TO_BUFFER = 3  # The number of train cycles worth of data to "run ahead"
-                      # of the main training loop.
+# The number of train cycles worth of data to "run ahead" of the main training
+# loop is adapted to the measured rates of constructing and consuming epochs,
+# within these bounds. Epochs written to file shards are further limited to
+# RUN_AHEAD_BUDGET_MB on disk, but at least MIN_CYCLES_TO_BUFFER is always
+# constructed. In memory, the training ring bounds the run-ahead instead.
+MIN_CYCLES_TO_BUFFER = 1
+MAX_CYCLES_TO_BUFFER = 4
+RUN_AHEAD_BUDGET_MB = 2048
+
+# The ring which holds training data between the producer and tf.data has this
+# many slots, or fewer if they would not fit in RUN_AHEAD_BUDGET_MB. The
+# producer blocks while every slot is in use. PREFETCH_BATCHES is the number of
+# batches the input pipeline prefetches. Slots are reused only after
+# PREFETCH_BATCHES later batches have been yielded, since tf.data may not copy
+# the yielded arrays.
+TRAIN_RING_SLOTS = 512
+PREFETCH_BATCHES = 16
+
+# When training batches are constructed by a process pool, the number of shared
+# output slots (and therefore batches in flight) per worker process.
+SLOTS_PER_DATA_PROCESS = 2
 
 # Number of batches to run per epoch when using synthetic data. At high batch
 # sizes, we run for more batches than with real data, which is good since
@@ -77,3 +98,11 @@ NUM_FILE_SHARDS = 16
 TRAIN_FOLDER_TEMPLATE = "training_cycle_{}"
 EVAL_FOLDER = "eval_data"
 SHARD_TEMPLATE = "shard_{}.tfrecords"
+
+# Shard formats for StreamingFilesDataset. Binary shards hold fixed length
+# records after a fixed size header describing their layout.
+BINARY_SHARD_FORMAT = "binary"
+TFRECORD_SHARD_FORMAT = "tfrecord"
+SHARD_FORMATS = [BINARY_SHARD_FORMAT, TFRECORD_SHARD_FORMAT]
+BINARY_SHARD_TEMPLATE = "shard_{}.bin"
+BINARY_SHARD_HEADER_BYTES = 512
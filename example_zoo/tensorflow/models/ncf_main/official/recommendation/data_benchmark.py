@@ -0,0 +1,585 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmark the negative sampling strategies of the NCF data pipeline.
+
+For each data constructor this reports:
+  1) The time to build the lookup variables (construct_lookup_variables).
+  2) The size of the lookup variables, and the growth in peak resident memory
+     while building them and sampling.
+  3) The time to sample the negatives of a training epoch, using the same
+     batching and thread pool as BaseDataConstructor._construct_training_epoch.
+  4) The throughput (batches per second) of constructing single training and
+     eval batches (_make_training_batch and _make_eval_batch), and of
+     constructing training batches with each of --num_threads threads.
+
+Each constructor is run in a fresh forked process so that the peak memory of
+one constructor does not mask that of the next. The constructors are run on a
+MovieLens dataset, or if --synthetic_users is set, on random interactions with
+the given numbers of users and items and density.
+
+Every result is also logged as a metric to the benchmark logger, so with
+--benchmark_logger_type=BenchmarkFileLogger the results are written as JSON to
+--benchmark_log_dir, like those of model runs.
+
+If --num_data_processes is passed, the throughput (batches per second) of full
+training epoch construction is also reported for each number of worker
+processes, where zero is the default thread pool.
+
+If --shard_format_batches is passed, the shard formats used when streaming
+files to TPUs are compared on that many synthetic training batches: the time to
+serialize and write them, their size on disk, and the throughput of reading
+them back through tf.data (and, for binary shards, through np.memmap).
+
+Usage:
+  python data_benchmark.py --data_dir /tmp/movielens-data --dataset ml-20m \
+    --num_data_processes 0,1,2,4,8,16
+  python data_benchmark.py --synthetic_users 1000000 --synthetic_items 50000 \
+    --synthetic_density 0.001 --benchmark_logger_type BenchmarkFileLogger \
+    --benchmark_log_dir /tmp/ncf_data_benchmark
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import timeit
+
+# pylint: disable=g-bad-import-order
+import numpy as np
+from absl import app as absl_app
+from absl import flags
+import tensorflow as tf
+# pylint: enable=g-bad-import-order
+
+from official.datasets import movielens
+from official.recommendation import constants as rconst
+from official.recommendation import data_pipeline
+from official.recommendation import data_preprocessing
+from official.recommendation import popen_helper
+from official.recommendation import stat_utils
+from official.utils.flags import core as flags_core
+from official.utils.logs import logger
+
+
+CONSTRUCTOR_TYPES = ["bisection", "materialized", "csr"]
+
+# Set before forking, so that the benchmark processes inherit the training
+# data rather than receiving a pickled copy.
+_DATA = {}
+
+
+def _peak_rss_mb():
+  # ru_maxrss is reported in kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _lookup_nbytes(producer):
+  """Total size of the arrays built by construct_lookup_variables."""
+  inputs = (producer._train_pos_users, producer._train_pos_items,  # pylint: disable=protected-access
+            producer._eval_pos_users, producer._eval_pos_items)  # pylint: disable=protected-access
+  return sum(value.nbytes for value in vars(producer).values()
+             if isinstance(value, np.ndarray) and
+             not any(value is x for x in inputs))
+
+
+def _synthetic_data(num_users, num_items, density, seed=0):
+  """Random interactions in the layout of the preprocessed MovieLens data.
+
+  Each user interacts with about density * num_items distinct items (at least
+  two), one of which is held out as the eval positive.
+
+  Args:
+    num_users: The number of users.
+    num_items: The number of items.
+    density: The mean fraction of items that each user has interacted with.
+    seed: Seed of the interactions.
+
+  Returns:
+    A dict with the train and eval users and items.
+  """
+  if num_items >= np.iinfo(rconst.ITEM_DTYPE).max:
+    raise ValueError("Items are stored as {}, so there must be fewer than {} "
+                     "of them.".format(np.dtype(rconst.ITEM_DTYPE).name,
+                                       np.iinfo(rconst.ITEM_DTYPE).max))
+
+  state = np.random.RandomState(seed)  # pylint: disable=no-member
+  num_samples = state.poisson(density * num_items, size=num_users)
+  users = np.repeat(np.arange(num_users, dtype=np.int64), num_samples)
+  items = state.randint(0, num_items, size=users.shape[0])
+
+  # Two guaranteed interactions per user, so every user has a training and an
+  # eval positive.
+  first = np.arange(num_users, dtype=np.int64)
+  users = np.concatenate([users, first, first])
+  items = np.concatenate([items, first % num_items, (first + 1) % num_items])
+
+  # Sorting deduplicates (user, item) pairs and groups users; the last item of
+  # each user in a random order is its eval positive.
+  keys = np.unique(users * num_items + items)
+  keys = keys[np.lexsort((state.random_sample(keys.shape), keys // num_items))]
+  users, items = keys // num_items, keys % num_items
+  is_eval = np.ones(users.shape, dtype=np.bool_)
+  is_eval[:-1] = users[1:] != users[:-1]
+
+  return {
+      rconst.TRAIN_USER_KEY: users[~is_eval].astype(rconst.USER_DTYPE),
+      rconst.TRAIN_ITEM_KEY: items[~is_eval].astype(rconst.ITEM_DTYPE),
+      rconst.EVAL_USER_KEY: users[is_eval].astype(rconst.USER_DTYPE),
+      rconst.EVAL_ITEM_KEY: items[is_eval].astype(rconst.ITEM_DTYPE),
+  }
+
+
+def _make_producer(constructor_type, num_users, num_items, batch_size,
+                   num_neg, num_epochs=1, num_data_processes=0,
+                   eval_batch_size=1 + rconst.NUM_EVAL_NEGATIVES):
+  return data_pipeline.get_constructor(constructor_type)(
+      maximum_number_epochs=num_epochs,
+      num_users=num_users,
+      num_items=num_items,
+      user_map=None,
+      item_map=None,
+      train_pos_users=_DATA[rconst.TRAIN_USER_KEY],
+      train_pos_items=_DATA[rconst.TRAIN_ITEM_KEY],
+      train_batch_size=batch_size,
+      batches_per_train_step=1,
+      num_train_negatives=num_neg,
+      eval_pos_users=_DATA[rconst.EVAL_USER_KEY],
+      eval_pos_items=_DATA[rconst.EVAL_ITEM_KEY],
+      eval_batch_size=eval_batch_size,
+      batches_per_eval_step=1,
+      stream_files=False,
+      num_data_processes=num_data_processes)
+
+
+def _sample_epoch(producer, epoch_order):
+  """Sample the negatives of one epoch in training batch sized chunks."""
+  train_pos_users = _DATA[rconst.TRAIN_USER_KEY]
+  (train_pos_count,) = train_pos_users.shape
+  batch_size = producer.train_batch_size
+
+  def sample_batch(i):
+    batch_indices = epoch_order[i * batch_size:(i + 1) * batch_size]
+    users = train_pos_users[np.mod(batch_indices, train_pos_count)]
+    negative_users = users[np.greater_equal(batch_indices, train_pos_count)]
+    producer.lookup_negative_items(negative_users=negative_users)
+
+  with popen_helper.get_threadpool(6) as pool:
+    pool.map(sample_batch, range(producer.train_batches_per_epoch))
+
+
+def _batches_per_sec(make_batch, num_batches, batches_per_epoch,
+                     num_threads=1):
+  """Time the construction of num_batches batches with a thread pool."""
+  get_pool = (popen_helper.get_threadpool if num_threads > 1 else
+              popen_helper.get_fauxpool)
+  with get_pool(num_threads) as pool:
+    start_time = timeit.default_timer()
+    pool.map(make_batch, [i % batches_per_epoch for i in range(num_batches)])
+    return num_batches / (timeit.default_timer() - start_time)
+
+
+def _benchmark_constructor(args):
+  """Measure a single constructor. This runs in a forked process."""
+  (constructor_type, num_users, num_items, batch_size, eval_batch_size,
+   num_neg, num_epochs, timed_batches, num_threads) = args
+  np.random.seed(stat_utils.random_int32())
+  rss_baseline = _peak_rss_mb()
+
+  producer = _make_producer(constructor_type, num_users, num_items,
+                            batch_size, num_neg,
+                            eval_batch_size=eval_batch_size)
+
+  start_time = timeit.default_timer()
+  producer.construct_lookup_variables()
+  construct_time = timeit.default_timer() - start_time
+
+  elements_in_epoch = (1 + num_neg) * _DATA[rconst.TRAIN_USER_KEY].shape[0]
+  epoch_times = []
+  for _ in range(num_epochs):
+    epoch_order = stat_utils.permutation(
+        (elements_in_epoch, stat_utils.random_int32()))
+    start_time = timeit.default_timer()
+    _sample_epoch(producer, epoch_order)
+    epoch_times.append(timeit.default_timer() - start_time)
+
+  # pylint: disable=protected-access
+  producer._current_epoch_order = epoch_order
+  train_rate = _batches_per_sec(producer._make_training_batch, timed_batches,
+                                producer.train_batches_per_epoch)
+  eval_rate = _batches_per_sec(producer._make_eval_batch, timed_batches,
+                               producer.eval_batches_per_epoch)
+  thread_scaling = [
+      (threads, _batches_per_sec(producer._make_training_batch, timed_batches,
+                                 producer.train_batches_per_epoch, threads))
+      for threads in num_threads]
+  # pylint: enable=protected-access
+
+  return {
+      "constructor_type": constructor_type,
+      "construct_time": construct_time,
+      "lookup_mb": _lookup_nbytes(producer) / 1024 ** 2,
+      "peak_rss_growth_mb": _peak_rss_mb() - rss_baseline,
+      "epoch_time": float(np.mean(epoch_times)),
+      "train_batches_per_sec": train_rate,
+      "eval_batches_per_sec": eval_rate,
+      "thread_scaling": thread_scaling,
+  }
+
+
+def _log_results(results, num_users, num_items, num_train_positives):
+  """Log each result as a metric, tagged with its constructor and data size."""
+  benchmark_logger = logger.get_benchmark_logger()
+  for result in results:
+    extras = {"constructor_type": result["constructor_type"],
+              "num_users": num_users, "num_items": num_items,
+              "num_train_positives": num_train_positives}
+    for name, unit in (("construct_time", "seconds"),
+                       ("lookup_mb", "MB"),
+                       ("peak_rss_growth_mb", "MB"),
+                       ("epoch_time", "seconds"),
+                       ("train_batches_per_sec", "batches per second"),
+                       ("eval_batches_per_sec", "batches per second")):
+      benchmark_logger.log_metric(name, result[name], unit=unit, extras=extras)
+    for threads, rate in result["thread_scaling"]:
+      benchmark_logger.log_metric(
+          "train_batches_per_sec", rate, unit="batches per second",
+          extras=dict(extras, num_threads=threads))
+
+
+def _benchmark_data_processes(constructor_type, num_users, num_items,
+                              batch_size, num_neg, num_epochs,
+                              num_data_processes):
+  """Measure full training epoch construction, including storing batches."""
+  # pylint: disable=protected-access
+  producer = _make_producer(constructor_type, num_users, num_items,
+                            batch_size, num_neg, num_epochs=num_epochs,
+                            num_data_processes=num_data_processes)
+  producer._start_shuffle_iterator()
+  producer.construct_lookup_variables()
+
+  # Consume batches concurrently, as training would, since the producer blocks
+  # once the training data ring is full.
+  def consume():
+    for _ in producer._train_dataset.data_generator(
+        epochs_between_evals=num_epochs):
+      pass
+
+  consumer = threading.Thread(target=consume)
+  consumer.start()
+
+  epoch_times = []
+  for _ in range(num_epochs):
+    start_time = timeit.default_timer()
+    producer._construct_training_epoch()
+    epoch_times.append(timeit.default_timer() - start_time)
+    producer._train_dataset._epochs_requested += 1
+  consumer.join()
+
+  producer._stop_training_pool()
+  # pylint: enable=protected-access
+  return producer.train_batches_per_epoch / np.mean(epoch_times)
+
+
+def run_benchmark(data_dir, dataset, constructor_types, batch_size, num_neg,
+                  num_epochs, num_data_processes=(),
+                  scaling_constructor_type="bisection",
+                  eval_batch_size=1 + rconst.NUM_EVAL_NEGATIVES,
+                  timed_batches=20, num_threads=(1,), synthetic_users=0,
+                  synthetic_items=0, synthetic_density=0.):
+  """Run each constructor on MovieLens or synthetic data and print a summary."""
+  if synthetic_users:
+    _DATA.update(_synthetic_data(synthetic_users, synthetic_items,
+                                 synthetic_density))
+    num_users, num_items = synthetic_users, synthetic_items
+  else:
+    raw_rating_path = "{}/{}/{}".format(data_dir, dataset,
+                                        movielens.RATINGS_FILE)
+    cache_path = "{}/{}/{}".format(data_dir, dataset, rconst.RAW_CACHE_DIR)
+    raw_data, _ = data_preprocessing._filter_index_sort(  # pylint: disable=protected-access
+        raw_rating_path, cache_path)
+    _DATA.update(raw_data)
+    num_users, num_items = (
+        data_preprocessing.DATASET_TO_NUM_USERS_AND_ITEMS[dataset])
+
+  num_train_positives = _DATA[rconst.TRAIN_USER_KEY].shape[0]
+  print("{} users, {} items, {} training positives ({:.3%} dense)\n".format(
+      num_users, num_items, num_train_positives,
+      num_train_positives / num_users / num_items))
+
+  results = []
+  for constructor_type in constructor_types:
+    args = (constructor_type, num_users, num_items, batch_size,
+            eval_batch_size, num_neg, num_epochs, timed_batches, num_threads)
+    with popen_helper.get_forkpool(1) as pool:
+      results.append(pool.apply(_benchmark_constructor, (args,)))
+
+  print("{:<14}{:>16}{:>14}{:>18}{:>14}{:>16}{:>16}".format(
+      "constructor", "construct (s)", "lookup (MB)", "peak RSS +(MB)",
+      "epoch (s)", "train batch/s", "eval batch/s"))
+  for result in results:
+    print("{constructor_type:<14}{construct_time:>16.2f}{lookup_mb:>14.1f}"
+          "{peak_rss_growth_mb:>18.1f}{epoch_time:>14.2f}"
+          "{train_batches_per_sec:>16.1f}{eval_batches_per_sec:>16.1f}"
+          .format(**result))
+
+  if len(num_threads) > 1:
+    print("\nTraining batches / sec by thread count")
+    print("{:<14}".format("constructor") +
+          "".join("{:>10}".format(threads) for threads in num_threads))
+    for result in results:
+      print("{:<14}".format(result["constructor_type"]) +
+            "".join("{:>10.1f}".format(rate)
+                    for _, rate in result["thread_scaling"]))
+
+  _log_results(results, num_users, num_items, num_train_positives)
+
+  if num_data_processes:
+    print("\n{:<14}{:>16}{:>14}".format(
+        "processes", "batches / sec", "speedup"))
+  baseline = None
+  for num_processes in num_data_processes:
+    batches_per_sec = _benchmark_data_processes(
+        scaling_constructor_type, num_users, num_items, batch_size, num_neg,
+        num_epochs, num_processes)
+    baseline = baseline or batches_per_sec
+    print("{:<14}{:>16.1f}{:>14.2f}".format(
+        num_processes, batches_per_sec, batches_per_sec / baseline))
+    logger.get_benchmark_logger().log_metric(
+        "train_epoch_batches_per_sec", batches_per_sec,
+        unit="batches per second",
+        extras={"constructor_type": scaling_constructor_type,
+                "num_data_processes": num_processes})
+
+  return results
+
+
+def _write_shards(shard_format, batch_size, batches):
+  """Write batches to shards, as an epoch of training data would be."""
+  manager = data_pipeline.DatasetManager(
+      True, True, len(batches), shard_root=tempfile.mkdtemp(prefix="ncf_"),
+      batch_size=batch_size, shard_format=shard_format)
+  start_time = timeit.default_timer()
+  manager.start_construction()
+  with popen_helper.get_threadpool(6) as pool:
+    pool.map(lambda i: manager.put(i, batches[i]), range(len(batches)))
+  manager.end_construction()
+  write_time = timeit.default_timer() - start_time
+
+  data_dir = manager._result_queue.get()  # pylint: disable=protected-access
+  return manager, write_time, data_dir
+
+
+def _read_shards(manager, data_dir, batch_size):
+  """Read every batch back through tf.data. Returns batches per second."""
+  # pylint: disable=protected-access
+  file_pattern = os.path.join(data_dir, manager._shard_template.format("*"))
+  with tf.Graph().as_default():
+    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+    dataset = dataset.interleave(manager._make_file_dataset,
+                                 cycle_length=rconst.NUM_FILE_SHARDS)
+    dataset = dataset.map(
+        functools.partial(manager._deserialize, batch_size=batch_size),
+        num_parallel_calls=16)
+    dataset = dataset.prefetch(rconst.PREFETCH_BATCHES)
+    next_element = dataset.make_one_shot_iterator().get_next()
+    # pylint: enable=protected-access
+
+    count = 0
+    with tf.Session() as sess:
+      start_time = timeit.default_timer()
+      try:
+        while True:
+          sess.run(next_element)
+          count += 1
+      except tf.errors.OutOfRangeError:
+        pass
+  return count / (timeit.default_timer() - start_time)
+
+
+def _memmap_shards(data_dir):
+  """Read every batch of binary shards with np.memmap. Returns batches/sec."""
+  count = 0
+  start_time = timeit.default_timer()
+  for filename in sorted(tf.gfile.ListDirectory(data_dir)):
+    records = data_pipeline.read_binary_shard(os.path.join(data_dir, filename))
+    for record in records:
+      # Copy the fields out of the page cache, as a feed into TF would.
+      users = np.array(record[movielens.USER_COLUMN])
+      np.array(record[movielens.ITEM_COLUMN])
+      np.less(np.arange(users.shape[0]), record[rconst.MASK_START_INDEX][0])
+      record["labels"].astype(np.bool_)
+      count += 1
+  return count / (timeit.default_timer() - start_time)
+
+
+def run_shard_format_benchmark(batch_size, num_batches):
+  """Compare the binary and TFRecord shard formats on synthetic batches."""
+  batches = [{
+      movielens.USER_COLUMN: np.random.randint(
+          0, 2 ** 17, batch_size).astype(rconst.USER_DTYPE),
+      movielens.ITEM_COLUMN: np.random.randint(
+          0, 2 ** 15, batch_size).astype(rconst.ITEM_DTYPE),
+      rconst.MASK_START_INDEX: np.array(batch_size, dtype=np.int32),
+      "labels": np.random.randint(0, 2, batch_size).astype(np.bool_),
+  } for _ in range(num_batches)]
+
+  print("{:<10}{:>14}{:>14}{:>20}{:>20}".format(
+      "format", "write (s)", "disk (MB)", "tf.data batch/sec",
+      "memmap batch/sec"))
+  for shard_format in rconst.SHARD_FORMATS:
+    manager, write_time, data_dir = _write_shards(
+        shard_format, batch_size, batches)
+    disk_bytes = sum(
+        os.path.getsize(os.path.join(data_dir, filename))
+        for filename in tf.gfile.ListDirectory(data_dir))
+    read_rate = _read_shards(manager, data_dir, batch_size)
+    memmap_rate = (_memmap_shards(data_dir)
+                   if shard_format == rconst.BINARY_SHARD_FORMAT else None)
+    shutil.rmtree(os.path.dirname(data_dir))
+
+    print("{:<10}{:>14.2f}{:>14.1f}{:>20.1f}{:>20}".format(
+        shard_format, write_time, disk_bytes / 1024 ** 2, read_rate,
+        "{:.1f}".format(memmap_rate) if memmap_rate else "-"))
+
+
+def define_flags():
+  """Add flags specifying the benchmark arguments."""
+  flags.DEFINE_string(
+      name="data_dir", default="/tmp/movielens-data/",
+      help=flags_core.help_wrap("Directory containing the MovieLens data."))
+
+  flags.DEFINE_enum(
+      name="dataset", default=movielens.ML_20M,
+      enum_values=movielens.DATASETS, case_sensitive=False,
+      help=flags_core.help_wrap("Dataset to benchmark with."))
+
+  flags.DEFINE_list(
+      name="constructor_types", default=CONSTRUCTOR_TYPES,
+      help=flags_core.help_wrap("Data constructors to compare."))
+
+  flags.DEFINE_integer(
+      name="batch_size", default=98304,
+      help=flags_core.help_wrap("Training batch size."))
+
+  flags.DEFINE_integer(
+      name="num_neg", default=4,
+      help=flags_core.help_wrap(
+          "The number of negative instances to pair with a positive instance."))
+
+  flags.DEFINE_list(
+      name="num_data_processes", default=[],
+      help=flags_core.help_wrap(
+          "Numbers of data worker processes to measure epoch construction "
+          "throughput with. 0 uses the default thread pool."))
+
+  flags.DEFINE_enum(
+      name="scaling_constructor_type", default="bisection",
+      enum_values=CONSTRUCTOR_TYPES, case_sensitive=False,
+      help=flags_core.help_wrap(
+          "Data constructor to use when measuring throughput."))
+
+  flags.DEFINE_integer(
+      name="shard_format_batches", default=0,
+      help=flags_core.help_wrap(
+          "If positive, compare the shard formats on this many synthetic "
+          "batches."))
+
+  flags.DEFINE_integer(
+      name="num_epochs", default=3,
+      help=flags_core.help_wrap(
+          "The number of epochs to sample. The mean time is reported."))
+
+  flags.DEFINE_integer(
+      name="eval_batch_size", default=160000,
+      help=flags_core.help_wrap(
+          "Eval batch size. Must be a multiple of {}.".format(
+              1 + rconst.NUM_EVAL_NEGATIVES)))
+
+  flags.DEFINE_integer(
+      name="timed_batches", default=20,
+      help=flags_core.help_wrap(
+          "The number of single training and eval batches to time each "
+          "constructor on."))
+
+  flags.DEFINE_list(
+      name="num_threads", default=["1", "2", "4", "8"],
+      help=flags_core.help_wrap(
+          "Thread counts to measure training batch construction with."))
+
+  flags.DEFINE_integer(
+      name="synthetic_users", default=0,
+      help=flags_core.help_wrap(
+          "If positive, benchmark on random interactions of this many users "
+          "rather than on --dataset."))
+
+  flags.DEFINE_integer(
+      name="synthetic_items", default=20000,
+      help=flags_core.help_wrap("Number of items of the synthetic data."))
+
+  flags.DEFINE_float(
+      name="synthetic_density", default=0.005,
+      help=flags_core.help_wrap(
+          "Mean fraction of the items that each synthetic user has "
+          "interacted with."))
+
+  flags_core.define_benchmark()
+
+
+def main(_):
+  flags_obj = flags.FLAGS
+  with logger.benchmark_context(flags_obj):
+    logger.get_benchmark_logger().log_run_info(
+        model_name="ncf_data_pipeline",
+        dataset_name=("synthetic" if flags_obj.synthetic_users
+                      else flags_obj.dataset),
+        run_params={
+            "batch_size": flags_obj.batch_size,
+            "eval_batch_size": flags_obj.eval_batch_size,
+            "num_neg": flags_obj.num_neg,
+            "synthetic_users": flags_obj.synthetic_users,
+            "synthetic_items": flags_obj.synthetic_items,
+            "synthetic_density": flags_obj.synthetic_density,
+        },
+        test_id=flags_obj.benchmark_test_id)
+
+    run_benchmark(
+        data_dir=flags_obj.data_dir, dataset=flags_obj.dataset,
+        constructor_types=flags_obj.constructor_types,
+        batch_size=flags_obj.batch_size, num_neg=flags_obj.num_neg,
+        num_epochs=flags_obj.num_epochs,
+        num_data_processes=[int(i) for i in flags_obj.num_data_processes],
+        scaling_constructor_type=flags_obj.scaling_constructor_type,
+        eval_batch_size=flags_obj.eval_batch_size,
+        timed_batches=flags_obj.timed_batches,
+        num_threads=[int(i) for i in flags_obj.num_threads],
+        synthetic_users=flags_obj.synthetic_users,
+        synthetic_items=flags_obj.synthetic_items,
+        synthetic_density=flags_obj.synthetic_density)
+
+    if flags_obj.shard_format_batches:
+      run_shard_format_benchmark(batch_size=flags_obj.batch_size,
+                                 num_batches=flags_obj.shard_format_batches)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  define_flags()
+  absl_app.run(main)
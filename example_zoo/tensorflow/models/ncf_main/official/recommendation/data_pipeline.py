@@ -19,12 +19,16 @@ from __future__ import division
 from __future__ import print_function
 
 import atexit
+import collections
+import ctypes
 import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
 import tempfile
 import threading
-import time
 import timeit
 import traceback
 import typing
@@ -71,6 +75,256 @@ _EVAL_FEATURE_MAP = {
 }
 
 
+# The fields of a binary shard record, in order. Each is a tuple of the name,
+# dtype and whether the field holds one value per example (rather than a single
+# value per batch). Booleans are stored as one byte.
+_BINARY_TRAIN_FIELDS = (
+    (movielens.USER_COLUMN, rconst.USER_DTYPE, True),
+    (movielens.ITEM_COLUMN, rconst.ITEM_DTYPE, True),
+    ("labels", np.int8, True),
+    (rconst.MASK_START_INDEX, np.int32, False),
+)
+
+
+_BINARY_EVAL_FIELDS = (
+    (movielens.USER_COLUMN, rconst.USER_DTYPE, True),
+    (movielens.ITEM_COLUMN, rconst.ITEM_DTYPE, True),
+    (rconst.DUPLICATE_MASK, np.int8, True),
+)
+
+
+def _binary_record_dtype(fields, batch_size):
+  """The NumPy equivalent of a binary shard record."""
+  return np.dtype([(name, dtype, (batch_size if per_example else 1,))
+                   for name, dtype, per_example in fields])
+
+
+def read_binary_shard(path):
+  """Memory map the records of a binary shard on a local disk.
+
+  Args:
+    path: The path of a shard written with shard_format="binary".
+
+  Returns:
+    A NumPy structured array with one record per batch. For instance
+    records[movielens.ITEM_COLUMN] has shape [num_batches, batch_size].
+  """
+  with tf.gfile.Open(path, "rb") as f:
+    header = json.loads(
+        f.read(rconst.BINARY_SHARD_HEADER_BYTES).decode("utf-8"))
+  dtype = np.dtype([(str(name), np.dtype(dtype_str), (count,))
+                    for name, dtype_str, count in header["fields"]])
+
+  if os.path.getsize(path) == rconst.BINARY_SHARD_HEADER_BYTES:
+    # np.memmap does not support empty files.
+    return np.zeros(shape=(0,), dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode="r",
+                   offset=rconst.BINARY_SHARD_HEADER_BYTES)
+
+
+# The arrays of a cached eval set, each stored as a .npy file of shape
+# [batches per epoch, eval batch size]. Booleans are stored as one byte.
+_EVAL_CACHE_FIELDS = (
+    (movielens.USER_COLUMN, rconst.USER_DTYPE),
+    (movielens.ITEM_COLUMN, rconst.ITEM_DTYPE),
+    (rconst.DUPLICATE_MASK, np.bool_),
+)
+_EVAL_CACHE_VERSION = 1
+_CACHE_MANIFEST_FILE = "manifest.json"
+
+
+# Training batch worker processes are forked after the lookup variables have
+# been constructed, and receive the data constructor through the pool
+# initializer. They therefore share the training positives and the negative
+# lookup arrays with the main process rather than receiving a copy.
+_WORKER_STATE = {}
+
+
+def _format_seconds(seconds):
+  return "unmeasured" if seconds is None else "{:.1f} s/epoch".format(seconds)
+
+
+def _shared_array(shape, dtype):
+  """Allocate a NumPy array which is shared with forked processes."""
+  dtype = np.dtype(dtype)
+  raw = multiprocessing.RawArray(ctypes.c_char,
+                                 int(np.prod(shape)) * dtype.itemsize)
+  return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _init_training_worker(producer):
+  _WORKER_STATE["producer"] = producer
+
+
+def _fill_training_slot(args):
+  """Construct a training batch in a worker process.
+
+  Args:
+    args: A size three tuple of the batch index, the index of the shared slot
+      to write the batch into, and a seed. Workers are reseeded for every batch
+      because forked processes otherwise share the random state of the parent.
+
+  Returns:
+    The mask start index of the batch.
+  """
+  i, slot, seed = args
+  np.random.seed(seed)
+  producer = _WORKER_STATE["producer"]
+  return producer._fill_training_slot(i, slot)  # pylint: disable=protected-access
+
+
+class _BatchRing(object):
+  """A bounded ring of preallocated training batches.
+
+  Producers copy each batch into a free slot of fixed shape arrays, blocking
+  while every slot is in use, and the consumer yields views of the slots in
+  the order in which they were filled. This avoids allocating new arrays for
+  every batch and bounds the memory used by data which has not been consumed.
+  """
+  def __init__(self, num_slots, release_delay, batch_size):
+    # type: (int, int, int) -> None
+    if num_slots <= release_delay:
+      raise ValueError("The ring ({} slots) must be larger than the release "
+                       "delay ({})".format(num_slots, release_delay))
+    self._release_delay = release_delay
+    self._arange = np.arange(batch_size)
+    shape = (num_slots, batch_size)
+    self._slabs = {
+        movielens.USER_COLUMN: np.empty(shape, dtype=rconst.USER_DTYPE),
+        movielens.ITEM_COLUMN: np.empty(shape, dtype=rconst.ITEM_DTYPE),
+        rconst.VALID_POINT_MASK: np.empty(shape, dtype=np.bool_),
+        "labels": np.empty(shape, dtype=np.bool_),
+    }
+    self._free = list(range(num_slots - 1, -1, -1))
+    self._ready = collections.deque()
+    self._yielded = collections.deque()
+    self._stopped = False
+    self._cv = threading.Condition()
+
+    # Total seconds the consumer has spent waiting for a batch.
+    self.wait_time = 0.
+
+  @staticmethod
+  def slot_bytes(batch_size):
+    # type: (int) -> int
+    """The memory used by one slot of a ring of batch_size batches."""
+    return batch_size * (np.dtype(rconst.USER_DTYPE).itemsize +
+                         np.dtype(rconst.ITEM_DTYPE).itemsize + 2)
+
+  def depth(self):
+    """The number of batches which are ready to be consumed."""
+    with self._cv:
+      return len(self._ready)
+
+  def stop(self):
+    """Release blocked producers. Later batches are discarded."""
+    with self._cv:
+      self._stopped = True
+      self._cv.notify_all()
+
+  def put(self, data):
+    """Copy a batch into the ring, waiting for a free slot if necessary."""
+    with self._cv:
+      while not self._free and not self._stopped:
+        self._cv.wait()
+      if self._stopped:
+        return
+      slot = self._free.pop()
+
+    # Slots are owned by a single producer until they are marked ready, so
+    # they can be filled without holding the lock.
+    for key in (movielens.USER_COLUMN, movielens.ITEM_COLUMN, "labels"):
+      self._slabs[key][slot] = data[key]
+    np.less(self._arange, data[rconst.MASK_START_INDEX],
+            out=self._slabs[rconst.VALID_POINT_MASK][slot])
+
+    with self._cv:
+      self._ready.append(slot)
+      self._cv.notify_all()
+
+  def get(self, timeout):
+    """Return the next batch as views into its slot.
+
+    The slot of a batch is only released once `release_delay` later batches
+    have been retrieved, as downstream consumers may still reference it.
+
+    Args:
+      timeout: Seconds to wait for a batch before raising queue.Empty.
+    """
+    start_time = timeit.default_timer()
+    deadline = start_time + timeout
+    with self._cv:
+      while not self._ready:
+        remaining = deadline - timeit.default_timer()
+        if remaining <= 0:
+          raise queue.Empty
+        self._cv.wait(remaining)
+      slot = self._ready.popleft()
+      self.wait_time += timeit.default_timer() - start_time
+
+      self._yielded.append(slot)
+      if len(self._yielded) > self._release_delay:
+        self._free.append(self._yielded.popleft())
+        self._cv.notify_all()
+
+    data = {key: slab[slot] for key, slab in self._slabs.items()}
+    return data, data.pop("labels")
+
+
+class _RunAheadController(object):
+  """Choose how many training epochs to construct ahead of the consumer.
+
+  If an epoch takes P seconds to construct and C seconds to consume, then the
+  producer needs to start an epoch about ceil(P / C) epochs before it is
+  requested, plus one to absorb variation in either rate. (For instance while
+  the consumer is evaluating.) Both rates are exponential moving averages of
+  measured epochs. The target is bounded by MIN_CYCLES_TO_BUFFER and
+  MAX_CYCLES_TO_BUFFER and, for epochs written to files, by the disk budget.
+  """
+  _SMOOTHING = 0.5
+
+  def __init__(self, budget_bytes):
+    # type: (int) -> None
+    self._budget_bytes = budget_bytes
+    self.producer_epoch_time = None
+    self.consumer_epoch_time = None
+    self.epoch_bytes = 0
+    self._last_request_time = None
+    self._last_request_epochs = 0
+
+  def _smooth(self, average, value):
+    if average is None:
+      return value
+    return self._SMOOTHING * value + (1 - self._SMOOTHING) * average
+
+  def record_epoch(self, seconds, num_bytes):
+    """Record the construction time and size (if written to files) of an epoch.
+    """
+    self.producer_epoch_time = self._smooth(self.producer_epoch_time, seconds)
+    self.epoch_bytes = max(self.epoch_bytes, num_bytes)
+
+  def record_request(self, num_epochs):
+    """Record that the consumer has asked for the next num_epochs epochs."""
+    now = timeit.default_timer()
+    if self._last_request_time is not None:
+      self.consumer_epoch_time = self._smooth(
+          self.consumer_epoch_time,
+          (now - self._last_request_time) / self._last_request_epochs)
+    self._last_request_time = now
+    self._last_request_epochs = num_epochs
+
+  def target(self):
+    if self.producer_epoch_time is None or not self.consumer_epoch_time:
+      target = rconst.MIN_CYCLES_TO_BUFFER + 1
+    else:
+      target = int(np.ceil(
+          self.producer_epoch_time / self.consumer_epoch_time)) + 1
+    target = min(target, rconst.MAX_CYCLES_TO_BUFFER)
+    if self.epoch_bytes:
+      target = min(target, self._budget_bytes // self.epoch_bytes)
+    return max(target, rconst.MIN_CYCLES_TO_BUFFER)
+
+
 class DatasetManager(object):
   """Helper class for handling TensorFlow specific data tasks.
 
@@ -79,8 +333,10 @@ class DatasetManager(object):
   management, tf.Dataset creation, etc.).
   """
   def __init__(self, is_training, stream_files, batches_per_epoch,
-               shard_root=None, deterministic=False):
-    # type: (bool, bool, int, typing.Optional[str], bool) -> None
+               shard_root=None, deterministic=False, batch_size=None,
+               shard_format=rconst.TFRECORD_SHARD_FORMAT,
+               run_ahead_budget_mb=rconst.RUN_AHEAD_BUDGET_MB):
+    # type: (bool, bool, int, typing.Optional[str], bool, typing.Optional[int], str, int) -> None
     """Constructs a `DatasetManager` instance.
     Args:
       is_training: Boolean of whether the data provided is training or
@@ -92,7 +348,23 @@ class DatasetManager(object):
       batches_per_epoch: The number of batches in a single epoch.
       shard_root: The base directory to be used when stream_files=True.
       deterministic: Forgo non-deterministic speedups. (i.e. sloppy=True)
+      batch_size: The size of the batches which will be stored. Required for
+        binary shards, whose records have a fixed length.
+      shard_format: The file format when stream_files=True. Either
+        "tfrecord", tf.train.Example records, or "binary", fixed length records
+        read with a FixedLengthRecordDataset.
+      run_ahead_budget_mb: The maximum size of the training epochs which are
+        written to files ahead of the consumer, or of the ring of training
+        batches held in memory.
     """
+    if shard_format not in rconst.SHARD_FORMATS:
+      raise ValueError("Unrecognized shard format: {}".format(shard_format))
+    if (stream_files and shard_format == rconst.BINARY_SHARD_FORMAT and
+        batch_size is None):
+      raise ValueError("batch_size is required for binary shards.")
+    if is_training and not stream_files and batch_size is None:
+      raise ValueError("batch_size is required for in memory training data.")
+
     self._is_training = is_training
     self._deterministic = deterministic
     self._stream_files = stream_files
@@ -102,11 +374,41 @@ class DatasetManager(object):
     self._batches_per_epoch = batches_per_epoch
     self._epochs_completed = 0
     self._epochs_requested = 0
+    self._epoch_start_time = None
+    self._epoch_bytes = 0
+    self._stream_wait_time = 0.
+
+    # Guards the epoch counts; the producer waits on it while enough epochs
+    # are buffered, and is notified as epochs are requested.
+    self._epoch_cv = threading.Condition()
+    self._run_ahead = _RunAheadController(run_ahead_budget_mb * 1024 ** 2)
+
+    # (seconds since construction, epochs requested, epochs buffered, batches
+    # ready, run-ahead target, seconds the consumer has waited for data) at
+    # every epoch request and completion.
+    self.run_ahead_history = []
+    self._creation_time = timeit.default_timer()
     self._shard_root = shard_root
+    self._batch_size = batch_size
+    self._shard_format = shard_format
+    self._binary_fields = (_BINARY_TRAIN_FIELDS if is_training else
+                           _BINARY_EVAL_FIELDS)
 
     self._result_queue = queue.Queue()
     self._result_reuse = []
 
+    # Training data is passed to tf.data through a bounded ring, while eval
+    # data is kept for reuse and therefore stays in the queue. The ring has
+    # TRAIN_RING_SLOTS slots unless fewer fit in the run-ahead budget.
+    self._train_ring = None
+    if is_training and not stream_files:
+      release_delay = rconst.PREFETCH_BATCHES + 2
+      num_slots = min(rconst.TRAIN_RING_SLOTS,
+                      run_ahead_budget_mb * 1024 ** 2 //
+                      _BatchRing.slot_bytes(batch_size))
+      self._train_ring = _BatchRing(max(num_slots, release_delay + 1),
+                                    release_delay, batch_size)
+
   @property
   def current_data_root(self):
     subdir = (rconst.TRAIN_FOLDER_TEMPLATE.format(self._epochs_completed)
@@ -116,7 +418,51 @@ class DatasetManager(object):
   def buffer_reached(self):
     # Only applicable for training.
     return (self._epochs_completed - self._epochs_requested >=
-            rconst.CYCLES_TO_BUFFER and self._is_training)
+            self._run_ahead.target() and self._is_training)
+
+  def wait_for_consumer(self, should_stop):
+    # type: (typing.Callable[[], bool]) -> None
+    """Block until another epoch may be constructed or should_stop() is True.
+
+    Callers which change the result of should_stop() must call wake().
+    """
+    start_time = timeit.default_timer()
+    with self._epoch_cv:
+      while self.buffer_reached() and not should_stop():
+        if not self._epoch_cv.wait(timeout=60):
+          tf.logging.info(
+              "Waited {:.0f} seconds for training data to be consumed".format(
+                  timeit.default_timer() - start_time))
+
+  def wake(self):
+    with self._epoch_cv:
+      self._epoch_cv.notify_all()
+
+  def stop(self):
+    """Wake the producer, and release it if it is blocked on the ring."""
+    self.wake()
+    if self._train_ring is not None:
+      self._train_ring.stop()
+
+  def _record_run_ahead(self, event):
+    """Append the state of the buffer to run_ahead_history and log it."""
+    if not self._is_training:
+      return
+    wait_time = self._stream_wait_time + (
+        self._train_ring.wait_time if self._train_ring else 0.)
+    entry = (timeit.default_timer() - self._creation_time,
+             self._epochs_requested,
+             self._epochs_completed - self._epochs_requested,
+             self._train_ring.depth() if self._train_ring else 0,
+             self._run_ahead.target(), wait_time)
+    self.run_ahead_history.append(entry)
+    tf.logging.info(
+        "Training data {}: {} epochs buffered (target {}), {} batches ready. "
+        "Epoch construction {}, consumption {}. Consumer has waited {:.1f} "
+        "seconds.".format(
+            event, entry[2], entry[4], entry[3],
+            _format_seconds(self._run_ahead.producer_epoch_time),
+            _format_seconds(self._run_ahead.consumer_epoch_time), wait_time))
 
   @staticmethod
   def _serialize(data):
@@ -129,16 +475,64 @@ class DatasetManager(object):
     return tf.train.Example(
         features=tf.train.Features(feature=feature_dict)).SerializeToString()
 
+  @property
+  def _shard_template(self):
+    return (rconst.BINARY_SHARD_TEMPLATE
+            if self._shard_format == rconst.BINARY_SHARD_FORMAT
+            else rconst.SHARD_TEMPLATE)
+
+  def _binary_header(self):
+    """The fixed size header of a binary shard, describing its records."""
+    record_dtype = _binary_record_dtype(self._binary_fields, self._batch_size)
+    header = json.dumps({
+        "batch_size": self._batch_size,
+        "record_bytes": record_dtype.itemsize,
+        "fields": [[name, np.dtype(dtype).str,
+                    self._batch_size if per_example else 1]
+                   for name, dtype, per_example in self._binary_fields],
+    }).encode("utf-8")
+    assert len(header) <= rconst.BINARY_SHARD_HEADER_BYTES
+    return header.ljust(rconst.BINARY_SHARD_HEADER_BYTES, b" ")
+
+  def _serialize_binary(self, data):
+    """Concatenate the raw bytes of the fields into a fixed length record."""
+    record = b"".join(memoryview(data[name]).tobytes()
+                      for name, _, _ in self._binary_fields)
+    assert len(record) == _binary_record_dtype(
+        self._binary_fields, self._batch_size).itemsize
+    return record
+
+  def _make_file_dataset(self, filename):
+    """Read the records of a single shard."""
+    if self._shard_format == rconst.BINARY_SHARD_FORMAT:
+      record_dtype = _binary_record_dtype(self._binary_fields, self._batch_size)
+      return tf.data.FixedLengthRecordDataset(
+          filename, record_bytes=record_dtype.itemsize,
+          header_bytes=rconst.BINARY_SHARD_HEADER_BYTES)
+    return tf.data.TFRecordDataset(filename)
+
   def _deserialize(self, serialized_data, batch_size):
-    """Convert serialized TFRecords into tensors.
+    """Convert serialized records into tensors.
 
     Args:
       serialized_data: A tensor containing serialized records.
       batch_size: The data arrives pre-batched, so batch size is needed to
         deserialize the data.
     """
-    feature_map = _TRAIN_FEATURE_MAP if self._is_training else _EVAL_FEATURE_MAP
-    features = tf.parse_single_example(serialized_data, feature_map)
+    if self._shard_format == rconst.BINARY_SHARD_FORMAT:
+      # Slice the raw bytes of each field out of the record.
+      features = {}
+      offset = 0
+      for name, dtype, per_example in self._binary_fields:
+        num_bytes = ((batch_size if per_example else 1) *
+                     np.dtype(dtype).itemsize)
+        features[name] = tf.substr(serialized_data, offset, num_bytes)
+        offset += num_bytes
+
+    else:
+      feature_map = (_TRAIN_FEATURE_MAP if self._is_training else
+                     _EVAL_FEATURE_MAP)
+      features = tf.parse_single_example(serialized_data, feature_map)
 
     users = tf.reshape(tf.decode_raw(
         features[movielens.USER_COLUMN], rconst.USER_DTYPE), (batch_size,))
@@ -180,30 +574,39 @@ class DatasetManager(object):
 
     Args:
       index: Used to select shards when writing to files.
-      data: A dict of the data to be stored. This method mutates data, and
-        therefore expects to be the only consumer.
+      data: A dict of the data to be stored. The arrays are copied (or
+        serialized) before this method returns, so the caller may reuse them.
     """
 
     if self._stream_files:
-      example_bytes = self._serialize(data)
+      example_bytes = (self._serialize_binary(data)
+                       if self._shard_format == rconst.BINARY_SHARD_FORMAT
+                       else self._serialize(data))
       with self._write_locks[index % rconst.NUM_FILE_SHARDS]:
         self._writers[index % rconst.NUM_FILE_SHARDS].write(example_bytes)
+        self._epoch_bytes += len(example_bytes)
+
+    elif self._is_training:
+      self._train_ring.put(data)
 
     else:
-      if self._is_training:
-        mask_start_index = data.pop(rconst.MASK_START_INDEX)
-        batch_size = data[movielens.ITEM_COLUMN].shape[0]
-        data[rconst.VALID_POINT_MASK] = np.less(np.arange(batch_size),
-                                                mask_start_index)
-        data = (data, data.pop("labels"))
       self._result_queue.put(data)
 
   def start_construction(self):
+    self._epoch_start_time = timeit.default_timer()
+    self._epoch_bytes = 0
     if self._stream_files:
       tf.gfile.MakeDirs(self.current_data_root)
-      template = os.path.join(self.current_data_root, rconst.SHARD_TEMPLATE)
-      self._writers = [tf.io.TFRecordWriter(template.format(i))
-                       for i in range(rconst.NUM_FILE_SHARDS)]
+      template = os.path.join(self.current_data_root, self._shard_template)
+      if self._shard_format == rconst.BINARY_SHARD_FORMAT:
+        header = self._binary_header()
+        self._writers = [tf.gfile.GFile(template.format(i), "wb")
+                         for i in range(rconst.NUM_FILE_SHARDS)]
+        for writer in self._writers:
+          writer.write(header)
+      else:
+        self._writers = [tf.io.TFRecordWriter(template.format(i))
+                         for i in range(rconst.NUM_FILE_SHARDS)]
 
   def end_construction(self):
     if self._stream_files:
@@ -211,7 +614,11 @@ class DatasetManager(object):
       self._writers = []
       self._result_queue.put(self.current_data_root)
 
-    self._epochs_completed += 1
+    self._run_ahead.record_epoch(
+        timeit.default_timer() - self._epoch_start_time, self._epoch_bytes)
+    with self._epoch_cv:
+      self._epochs_completed += 1
+    self._record_run_ahead("constructed")
 
   def data_generator(self, epochs_between_evals):
     """Yields examples during local training."""
@@ -220,7 +627,7 @@ class DatasetManager(object):
 
     if self._is_training:
       for _ in range(self._batches_per_epoch * epochs_between_evals):
-        yield self._result_queue.get(timeout=300)
+        yield self._train_ring.get(timeout=300)
 
     else:
       if self._result_reuse:
@@ -248,19 +655,29 @@ class DatasetManager(object):
       epochs_between_evals: How many epochs worth of data to yield.
         (Generator mode only.)
     """
-    self._epochs_requested += 1
+    # Each epoch which will be yielded counts towards the run-ahead buffer.
+    num_epochs = epochs_between_evals if self._is_training else 1
+    self._run_ahead.record_request(num_epochs)
+    with self._epoch_cv:
+      self._epochs_requested += num_epochs
+      self._epoch_cv.notify_all()
+    self._record_run_ahead("requested")
+
     if self._stream_files:
       if epochs_between_evals > 1:
         raise ValueError("epochs_between_evals > 1 not supported for file "
                          "based dataset.")
+      start_time = timeit.default_timer()
       epoch_data_dir = self._result_queue.get(timeout=300)
+      self._stream_wait_time += timeit.default_timer() - start_time
       if not self._is_training:
         self._result_queue.put(epoch_data_dir)  # Eval data is reused.
 
       file_pattern = os.path.join(
-          epoch_data_dir, rconst.SHARD_TEMPLATE.format("*"))
+          epoch_data_dir, self._shard_template.format("*"))
       dataset = StreamingFilesDataset(
-          files=file_pattern, worker_job="worker",
+          files=file_pattern, filetype=self._make_file_dataset,
+          worker_job="worker",
           num_parallel_reads=rconst.NUM_FILE_SHARDS, num_epochs=1,
           sloppy=not self._deterministic)
       map_fn = functools.partial(self._deserialize, batch_size=batch_size)
@@ -289,7 +706,7 @@ class DatasetManager(object):
           generator=data_generator, output_types=types,
           output_shapes=shapes)
 
-    return dataset.prefetch(16)
+    return dataset.prefetch(rconst.PREFETCH_BATCHES)
 
   def make_input_fn(self, batch_size):
     """Create an input_fn which checks for batch size consistency."""
@@ -324,8 +741,8 @@ class BaseDataConstructor(threading.Thread):
                maximum_number_epochs,   # type: int
                num_users,               # type: int
                num_items,               # type: int
-               user_map,                # type: dict
-               item_map,                # type: dict
+               user_map,                # type: data_preprocessing.IdMap
+               item_map,                # type: data_preprocessing.IdMap
                train_pos_users,         # type: np.ndarray
                train_pos_items,         # type: np.ndarray
                train_batch_size,        # type: int
@@ -336,7 +753,12 @@ class BaseDataConstructor(threading.Thread):
                eval_batch_size,         # type: int
                batches_per_eval_step,   # type: int
                stream_files,            # type: bool
-               deterministic=False      # type: bool
+               deterministic=False,     # type: bool
+               num_data_processes=0,    # type: int
+               shard_format=rconst.TFRECORD_SHARD_FORMAT,  # type: str
+               eval_cache_dir=None,     # type: typing.Optional[str]
+               eval_seed=None,          # type: typing.Optional[int]
+               run_ahead_budget_mb=rconst.RUN_AHEAD_BUDGET_MB  # type: int
               ):
     # General constants
     self._maximum_number_epochs = maximum_number_epochs
@@ -374,6 +796,14 @@ class BaseDataConstructor(threading.Thread):
     self.eval_batches_per_epoch = self._count_batches(
         self._eval_elements_in_epoch, eval_batch_size, batches_per_eval_step)
 
+    # Eval negatives are drawn from a per batch random state derived from this
+    # seed, so that an eval set can be cached and reused across runs.
+    self._eval_cache_dir = eval_cache_dir
+    if eval_seed is None:
+      eval_seed = (rconst.DEFAULT_EVAL_SEED if eval_cache_dir else
+                   stat_utils.random_int32())
+    self._eval_seed = int(eval_seed)
+
     # Intermediate artifacts
     self._current_epoch_order = np.empty(shape=(0,))
     self._shuffle_iterator = None
@@ -387,10 +817,10 @@ class BaseDataConstructor(threading.Thread):
 
     self._train_dataset = DatasetManager(
         True, stream_files, self.train_batches_per_epoch, self._shard_root,
-        deterministic)
+        deterministic, train_batch_size, shard_format, run_ahead_budget_mb)
     self._eval_dataset = DatasetManager(
         False, stream_files, self.eval_batches_per_epoch, self._shard_root,
-        deterministic)
+        deterministic, eval_batch_size, shard_format)
 
     # Threading details
     super(BaseDataConstructor, self).__init__()
@@ -399,6 +829,11 @@ class BaseDataConstructor(threading.Thread):
     self._fatal_exception = None
     self.deterministic = deterministic
 
+    # Process pool details. (Only used if num_data_processes > 0.)
+    self._num_data_processes = num_data_processes
+    self._train_pool = None
+    self._train_slots = None
+
   def __str__(self):
     multiplier = ("(x{} devices)".format(self._batches_per_train_step)
                   if self._batches_per_train_step > 1 else "")
@@ -419,25 +854,57 @@ class BaseDataConstructor(threading.Thread):
 
   def stop_loop(self):
     self._stop_loop = True
+    self._train_dataset.stop()
 
   def construct_lookup_variables(self):
     """Perform any one time pre-compute work."""
     raise NotImplementedError
 
   def lookup_negative_items(self, **kwargs):
-    """Randomly sample negative items for given users."""
+    """Randomly sample negative items for given users.
+
+    Subclasses draw from the `random_state` keyword argument (a
+    np.random.RandomState) if it is given, and from the global NumPy random
+    state otherwise.
+    """
     raise NotImplementedError
 
   def _run(self):
     atexit.register(self.stop_loop)
-    self._start_shuffle_iterator()
     self.construct_lookup_variables()
-    self._construct_training_epoch()
-    self._construct_eval_epoch()
-    for _ in range(self._maximum_number_epochs - 1):
+    if self._num_data_processes:
+      # The workers inherit the lookup variables, and are forked before the
+      # shuffle pool and the eval thread start so that they do not inherit
+      # those threads' locks. TensorFlow's threads already exist, however, so
+      # this relies on the workers only running NumPy code.
+      self._start_training_pool()
+    self._start_shuffle_iterator()
+
+    # Training puts block once the consumer falls behind, so the eval data is
+    # constructed alongside the training epochs rather than after the first
+    # one, and the first evaluation never waits on training.
+    eval_thread = threading.Thread(target=self._construct_eval_epoch_or_fail)
+    eval_thread.daemon = True
+    eval_thread.start()
+
+    for _ in range(self._maximum_number_epochs):
       self._construct_training_epoch()
+    self._stop_training_pool()
+    eval_thread.join()
     self.stop_loop()
 
+  def _construct_eval_epoch_or_fail(self):
+    try:
+      self._construct_eval_epoch()
+    except Exception as e:
+      traceback.print_exc()
+      self._fatal_exception = e
+      sys.stderr.flush()
+      # Training would otherwise go on until the consumer times out waiting
+      # for eval data.
+      self.stop_loop()
+      raise
+
   def run(self):
     try:
       self._run()
@@ -460,12 +927,14 @@ class BaseDataConstructor(threading.Thread):
     imap = pool.imap if self.deterministic else pool.imap_unordered
     self._shuffle_iterator = imap(stat_utils.permutation, args)
 
-  def _get_training_batch(self, i):
+  def _make_training_batch(self, i):
     """Construct a single batch of training data.
 
     Args:
-      i: The index of the batch. This is used when stream_files=True to assign
-        data to file shards.
+      i: The index of the batch.
+
+    Returns:
+      A dict of the users, items, labels and mask start index of the batch.
     """
     batch_indices = self._current_epoch_order[i * self.train_batch_size:
                                               (i + 1) * self.train_batch_size]
@@ -497,21 +966,97 @@ class BaseDataConstructor(threading.Thread):
       items = np.concatenate([items, item_pad])
       labels = np.concatenate([labels, label_pad])
 
-    self._train_dataset.put(i, {
+    return {
         movielens.USER_COLUMN: users,
         movielens.ITEM_COLUMN: items,
         rconst.MASK_START_INDEX: np.array(mask_start_index, dtype=np.int32),
         "labels": labels,
-    })
+    }
+
+  def _get_training_batch(self, i):
+    """Construct a single batch of training data and store it.
+
+    Args:
+      i: The index of the batch. This is used when stream_files=True to assign
+        data to file shards.
+    """
+    if self._stop_loop:
+      return
+    self._train_dataset.put(i, self._make_training_batch(i))
+
+  def _start_training_pool(self):
+    """Fork the worker processes which construct training batches.
+
+    Workers write batches into a ring of preallocated slots in shared memory,
+    so that only the batch index, slot and seed are pickled per batch. The
+    epoch order is also shared; it is rewritten in place each epoch.
+    """
+    num_slots = self._num_data_processes * rconst.SLOTS_PER_DATA_PROCESS
+    shape = (num_slots, self.train_batch_size)
+    self._train_slots = {
+        movielens.USER_COLUMN: _shared_array(shape, rconst.USER_DTYPE),
+        movielens.ITEM_COLUMN: _shared_array(shape, rconst.ITEM_DTYPE),
+        "labels": _shared_array(shape, np.bool_),
+    }
+    self._current_epoch_order = _shared_array(
+        (self._elements_in_epoch,), np.int32)
+
+    self._train_pool = popen_helper.get_forkpool(
+        self._num_data_processes, init_worker=_init_training_worker,
+        closing=False, init_args=(self,))
+    atexit.register(self._train_pool.terminate)
+
+  def _stop_training_pool(self):
+    if self._train_pool is not None:
+      self._train_pool.close()
+      self._train_pool.join()
+      self._train_pool = None
+
+  def _fill_training_slot(self, i, slot):
+    """Construct a training batch into a shared slot. (Worker process only.)"""
+    data = self._make_training_batch(i)
+    for key, slots in self._train_slots.items():
+      slots[slot] = data[key]
+    return int(data[rconst.MASK_START_INDEX])
+
+  def _construct_training_batches_with_processes(self, batch_indices):
+    """Construct training batches in the worker processes.
+
+    At most one batch per slot is in flight. Batches are stored in order as
+    they complete, after which their slots are reused.
+
+    Args:
+      batch_indices: The indices of the batches to construct.
+    """
+    (num_slots, _) = self._train_slots["labels"].shape
+    free_slots = list(range(num_slots))
+    in_flight = collections.deque()
+
+    def store_oldest():
+      i, slot, result = in_flight.popleft()
+      mask_start_index = result.get()
+
+      # The dataset manager copies or serializes the batch before put returns,
+      # so the slot can be passed without a copy.
+      data = {key: slots[slot] for key, slots in self._train_slots.items()}
+      data[rconst.MASK_START_INDEX] = np.array(mask_start_index, dtype=np.int32)
+      self._train_dataset.put(i, data)
+      free_slots.append(slot)
+
+    for i in batch_indices:
+      if self._stop_loop:
+        break
+      if not free_slots:
+        store_oldest()
+      slot = free_slots.pop()
+      in_flight.append((i, slot, self._train_pool.apply_async(
+          _fill_training_slot, ((i, slot, stat_utils.random_int32()),))))
+
+    while in_flight:
+      store_oldest()
 
   def _wait_to_construct_train_epoch(self):
-    count = 0
-    while self._train_dataset.buffer_reached() and not self._stop_loop:
-      time.sleep(0.01)
-      count += 1
-      if count >= 100 and np.log10(count) == np.round(np.log10(count)):
-        tf.logging.info(
-            "Waited {} times for training data to be consumed".format(count))
+    self._train_dataset.wait_for_consumer(lambda: self._stop_loop)
 
   def _construct_training_epoch(self):
     """Loop to construct a batch of training data."""
@@ -522,12 +1067,20 @@ class BaseDataConstructor(threading.Thread):
 
     self._train_dataset.start_construction()
     map_args = list(range(self.train_batches_per_epoch))
-    self._current_epoch_order = next(self._shuffle_iterator)
 
-    get_pool = (popen_helper.get_fauxpool if self.deterministic else
-                popen_helper.get_threadpool)
-    with get_pool(6) as pool:
-      pool.map(self._get_training_batch, map_args)
+    if self._num_data_processes:
+      if self._train_pool is None:
+        self._start_training_pool()
+      # Workers read the epoch order from shared memory.
+      self._current_epoch_order[:] = next(self._shuffle_iterator)
+      self._construct_training_batches_with_processes(map_args)
+
+    else:
+      self._current_epoch_order = next(self._shuffle_iterator)
+      get_pool = (popen_helper.get_fauxpool if self.deterministic else
+                  popen_helper.get_threadpool)
+      with get_pool(6) as pool:
+        pool.map(self._get_training_batch, map_args)
     self._train_dataset.end_construction()
 
     tf.logging.info("Epoch construction complete. Time: {:.1f} seconds".format(
@@ -573,28 +1126,130 @@ class BaseDataConstructor(threading.Thread):
     assert users.shape == items.shape == duplicate_mask.shape
     return users, items, duplicate_mask
 
-  def _get_eval_batch(self, i):
+  def _make_eval_batch(self, i):
     """Construct a single batch of evaluation data.
 
     Args:
       i: The index of the batch.
+
+    Returns:
+      A dict of the flattened user, item and duplicate mask arrays.
     """
     low_index = i * self._eval_users_per_batch
     high_index = (i + 1) * self._eval_users_per_batch
     users = np.repeat(self._eval_pos_users[low_index:high_index, np.newaxis],
                       1 + rconst.NUM_EVAL_NEGATIVES, axis=1)
     positive_items = self._eval_pos_items[low_index:high_index, np.newaxis]
-    negative_items = (self.lookup_negative_items(negative_users=users[:, :-1])
+
+    # Seeding by batch rather than drawing from the global random state makes
+    # the negatives independent of the order in which batches are constructed.
+    random_state = np.random.RandomState([self._eval_seed, i])  # pylint: disable=no-member
+    negative_items = (self.lookup_negative_items(negative_users=users[:, :-1],
+                                                 random_state=random_state)
                       .reshape(-1, rconst.NUM_EVAL_NEGATIVES))
 
     users, items, duplicate_mask = self._assemble_eval_batch(
         users, positive_items, negative_items, self._eval_users_per_batch)
 
-    self._eval_dataset.put(i, {
+    return {
         movielens.USER_COLUMN: users.flatten(),
         movielens.ITEM_COLUMN: items.flatten(),
         rconst.DUPLICATE_MASK: duplicate_mask.flatten(),
-    })
+    }
+
+  def _get_eval_batch(self, i):
+    self._eval_dataset.put(i, self._make_eval_batch(i))
+
+  def _eval_cache_key(self):
+    """Hash everything which determines the contents of the eval set.
+
+    The negatives of every constructor are the kth negative item of a user for
+    the same random draws, so the constructor type is not part of the key.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps({
+        "version": _EVAL_CACHE_VERSION,
+        "num_users": self._num_users,
+        "num_items": self._num_items,
+        "batch_size": self.eval_batch_size,
+        "batch_count": self.eval_batches_per_epoch,
+        "seed": self._eval_seed,
+    }, sort_keys=True).encode("utf-8"))
+    for array in (self._train_pos_users, self._train_pos_items,
+                  self._eval_pos_users, self._eval_pos_items):
+      sha256.update(memoryview(np.ascontiguousarray(array)))
+    return sha256.hexdigest()
+
+  def _eval_cache_path(self):
+    return os.path.join(self._eval_cache_dir, self._eval_cache_key())
+
+  def _read_eval_cache(self, cache_path):
+    # type: (str) -> typing.Optional[dict]
+    """Open a cached eval set, or return None if there is none.
+
+    Local caches are memory mapped, so batches are read from disk only as they
+    are consumed.
+    """
+    if not tf.gfile.Exists(os.path.join(cache_path, _CACHE_MANIFEST_FILE)):
+      return None
+
+    data = {}
+    for key, _ in _EVAL_CACHE_FIELDS:
+      path = os.path.join(cache_path, key + ".npy")
+      if os.path.exists(path):
+        data[key] = np.load(path, mmap_mode="r", allow_pickle=False)
+      else:
+        with tf.gfile.Open(path, "rb") as f:
+          data[key] = np.load(f, allow_pickle=False)
+    return data
+
+  def _write_eval_cache(self, cache_path):
+    """Construct the eval set directly into memory mapped .npy files.
+
+    Remote caches are assembled in a local temporary directory and then
+    copied. The manifest is written last, so that a partially written cache is
+    never read.
+    """
+    is_local = "://" not in cache_path
+    staging_dir = (cache_path + ".tmp{}".format(os.getpid()) if is_local else
+                   tempfile.mkdtemp(prefix="ncf_eval_"))
+    if tf.gfile.Exists(staging_dir):
+      tf.gfile.DeleteRecursively(staging_dir)
+    tf.gfile.MakeDirs(staging_dir)
+
+    shape = (self.eval_batches_per_epoch, self.eval_batch_size)
+    data = {key: np.lib.format.open_memmap(
+        os.path.join(staging_dir, key + ".npy"), mode="w+", dtype=dtype,
+        shape=shape) for key, dtype in _EVAL_CACHE_FIELDS}
+
+    def write_batch(i):
+      for key, value in six.iteritems(self._make_eval_batch(i)):
+        data[key][i] = value
+
+    get_pool = (popen_helper.get_fauxpool if self.deterministic else
+                popen_helper.get_threadpool)
+    with get_pool(6) as pool:
+      pool.map(write_batch, range(self.eval_batches_per_epoch))
+
+    for value in data.values():
+      value.flush()
+    del data
+
+    if tf.gfile.Exists(cache_path):
+      tf.gfile.DeleteRecursively(cache_path)
+    if is_local:
+      os.rename(staging_dir, cache_path)
+    else:
+      tf.gfile.MakeDirs(cache_path)
+      for key, _ in _EVAL_CACHE_FIELDS:
+        tf.gfile.Copy(os.path.join(staging_dir, key + ".npy"),
+                      os.path.join(cache_path, key + ".npy"))
+      tf.gfile.DeleteRecursively(staging_dir)
+
+    with tf.gfile.Open(os.path.join(cache_path, _CACHE_MANIFEST_FILE),
+                       "w") as f:
+      json.dump({"version": _EVAL_CACHE_VERSION, "seed": self._eval_seed,
+                 "shape": list(shape)}, f, sort_keys=True)
 
   def _construct_eval_epoch(self):
     """Loop to construct data for evaluation."""
@@ -603,16 +1258,37 @@ class BaseDataConstructor(threading.Thread):
 
     start_time = timeit.default_timer()
 
-    self._eval_dataset.start_construction()
-    map_args = [i for i in range(self.eval_batches_per_epoch)]
+    if self._eval_cache_dir is None:
+      self._eval_dataset.start_construction()
+      map_args = [i for i in range(self.eval_batches_per_epoch)]
 
-    get_pool = (popen_helper.get_fauxpool if self.deterministic else
-                popen_helper.get_threadpool)
-    with get_pool(6) as pool:
-      pool.map(self._get_eval_batch, map_args)
+      get_pool = (popen_helper.get_fauxpool if self.deterministic else
+                  popen_helper.get_threadpool)
+      with get_pool(6) as pool:
+        pool.map(self._get_eval_batch, map_args)
+      self._eval_dataset.end_construction()
+
+      tf.logging.info("Eval construction complete. Time: {:.1f} seconds"
+                      .format(timeit.default_timer() - start_time))
+      return
+
+    cache_path = self._eval_cache_path()
+    data = self._read_eval_cache(cache_path)
+    if data is None:
+      tf.logging.info("Constructing eval set cache: {}".format(cache_path))
+      self._write_eval_cache(cache_path)
+      data = self._read_eval_cache(cache_path)
+    else:
+      tf.logging.info("Using cached eval set: {}".format(cache_path))
+
+    # Each batch is a view of a row of the cache rather than a copy.
+    self._eval_dataset.start_construction()
+    for i in range(self.eval_batches_per_epoch):
+      self._eval_dataset.put(i, {key: data[key][i]
+                                 for key, _ in _EVAL_CACHE_FIELDS})
     self._eval_dataset.end_construction()
 
-    tf.logging.info("Eval construction complete. Time: {:.1f} seconds".format(
+    tf.logging.info("Eval set ready. Time: {:.1f} seconds".format(
         timeit.default_timer() - start_time))
 
   def make_input_fn(self, is_training):
@@ -747,9 +1423,10 @@ class MaterializedDataConstructor(BaseDataConstructor):
     tf.logging.info("Negative sample table built. Time: {:.1f} seconds".format(
         timeit.default_timer() - start_time))
 
-  def lookup_negative_items(self, negative_users, **kwargs):
+  def lookup_negative_items(self, negative_users, random_state=None,
+                            **kwargs):
     negative_item_choice = stat_utils.very_slightly_biased_randint(
-        self._per_user_neg_count[negative_users])
+        self._per_user_neg_count[negative_users], random_state)
     return self._negative_table[negative_users, negative_item_choice]
 
 
@@ -800,7 +1477,8 @@ class BisectionDataConstructor(BaseDataConstructor):
     tf.logging.info("Negative total vector built. Time: {:.1f} seconds".format(
         timeit.default_timer() - start_time))
 
-  def lookup_negative_items(self, negative_users, **kwargs):
+  def lookup_negative_items(self, negative_users, random_state=None,
+                            **kwargs):
     output = np.zeros(shape=negative_users.shape, dtype=rconst.ITEM_DTYPE) - 1
 
     left_index = self.index_bounds[negative_users]
@@ -808,7 +1486,8 @@ class BisectionDataConstructor(BaseDataConstructor):
 
     num_positives = right_index - left_index + 1
     num_negatives = self._num_items - num_positives
-    neg_item_choice = stat_utils.very_slightly_biased_randint(num_negatives)
+    neg_item_choice = stat_utils.very_slightly_biased_randint(
+        num_negatives, random_state)
 
     # Shortcuts:
     # For points where the negative is greater than or equal to the tally before
@@ -865,9 +1544,94 @@ class BisectionDataConstructor(BaseDataConstructor):
     return output
 
 
+class CSRDataConstructor(BaseDataConstructor):
+  """Sample negatives with a single searchsorted over all users.
+
+  Positive items are stored in compressed sparse row (CSR) form: a vector of
+  row pointers (indptr) into the per-user sorted positives. As in
+  BisectionDataConstructor, each positive is tagged with the number of
+  negatives which precede it, which for the jth (zero indexed) positive of a
+  user is simply:
+    item_id - j
+
+  These tallies are non-decreasing within a user and are less than num_items,
+  so offsetting them by (user * num_items) yields a single sorted vector over
+  all users. For instance:
+
+  num_users = 2
+  num_items = 5
+  positives = [[1, 3], [0]]
+
+  indptr:        [0, 2, 3]
+  offset tally:  [1, 2, 5]
+
+  The ith negative item for a user is then i plus the number of that user's
+  positives whose tally is less than or equal to i, which for an entire batch
+  of users is one vectorized `np.searchsorted` call:
+    searchsorted(offset_tally, user * num_items + i, side="right")
+      - indptr[user] + i
+
+  Unlike the bisection there is no python level loop over users during the
+  pre-compute, and no loop over bisection steps during sampling; the lookup
+  arrays are one int64 entry per positive plus one per user.
+  """
+  def __init__(self, *args, **kwargs):
+    super(CSRDataConstructor, self).__init__(*args, **kwargs)
+    self._indptr = None
+    self._offset_tally = None
+
+  def construct_lookup_variables(self):
+    start_time = timeit.default_timer()
+
+    users = self._train_pos_users.astype(np.int64)
+    items = self._train_pos_items.astype(np.int64)
+
+    # Positives must be unique for the tallies to be non-decreasing.
+    sorted_keys = np.sort(users * self._num_items + items)
+    assert np.all(sorted_keys[1:] > sorted_keys[:-1])
+    sorted_users = sorted_keys // self._num_items
+
+    # Users without positives simply have an empty row.
+    self._indptr = np.searchsorted(
+        sorted_users, np.arange(self._num_users + 1, dtype=np.int64))
+
+    rank_within_user = (np.arange(sorted_keys.shape[0], dtype=np.int64) -
+                        self._indptr[sorted_users])
+    self._offset_tally = sorted_keys - rank_within_user
+
+    tf.logging.info("CSR negative tally built. Time: {:.1f} seconds".format(
+        timeit.default_timer() - start_time))
+
+  def lookup_negative_items(self, negative_users, random_state=None,
+                            **kwargs):
+    lower = self._indptr[negative_users]
+    num_negatives = (self._num_items -
+                     (self._indptr[negative_users + 1] - lower))
+    neg_item_choice = stat_utils.very_slightly_biased_randint(
+        num_negatives, random_state)
+
+    positives_before = np.searchsorted(
+        self._offset_tally,
+        negative_users.astype(np.int64) * self._num_items + neg_item_choice,
+        side="right") - lower
+
+    return (neg_item_choice + positives_before).astype(rconst.ITEM_DTYPE)
+
+
 def get_constructor(name):
+  """Look up a data constructor class by name.
+
+  materialized builds a dense (num_users x num_items) table, so it has the
+  cheapest lookups but a build time and memory use which grow with the product
+  of users and items. bisection and csr only store per positive tallies; csr
+  replaces the per user loops and bisection steps of bisection with vectorized
+  sorts and searches. data_benchmark.py measures these trade-offs for a given
+  dataset or synthetic data size.
+  """
   if name == "bisection":
     return BisectionDataConstructor
   if name == "materialized":
     return MaterializedDataConstructor
+  if name == "csr":
+    return CSRDataConstructor
   raise ValueError("Unrecognized constructor: {}".format(name))
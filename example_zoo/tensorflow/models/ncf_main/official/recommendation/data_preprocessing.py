@@ -18,9 +18,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
+import json
 import os
-import pickle
-import time
 import timeit
 import typing
 
@@ -46,9 +46,206 @@ _EXPECTED_CACHE_KEYS = (
     rconst.TRAIN_USER_KEY, rconst.TRAIN_ITEM_KEY, rconst.EVAL_USER_KEY,
     rconst.EVAL_ITEM_KEY, rconst.USER_MAP, rconst.ITEM_MAP)
 
+_CACHE_MANIFEST_FILE = "manifest.json"
 
-def _filter_index_sort(raw_rating_path, cache_path):
-  # type: (str, str, bool) -> (dict, bool)
+# Increment when the contents or layout of the cache change.
+_CACHE_VERSION = 2
+
+_HASH_CHUNK_BYTES = 2 ** 23
+
+
+class IdMap(object):
+  """Mapping of raw IDs to regularized IDs, backed by sorted arrays.
+
+  The raw IDs are stored in sorted order along with the regularized ID of each,
+  so lookups are binary searches. Unlike a dict, the map is saved and loaded
+  as a single array, and whole arrays of raw IDs can be mapped with `lookup`.
+  """
+  def __init__(self, sorted_ids, indices):
+    # type: (np.ndarray, np.ndarray) -> None
+    self.sorted_ids = sorted_ids
+    self.indices = indices
+
+  @classmethod
+  def from_raw_ids(cls, raw_ids):
+    """Map raw_ids[i] to i."""
+    order = np.argsort(raw_ids, kind="mergesort")
+    return cls(raw_ids[order], order)
+
+  @classmethod
+  def from_array(cls, array):
+    return cls(array[0], array[1])
+
+  def to_array(self):
+    return np.stack([self.sorted_ids,
+                     self.indices.astype(self.sorted_ids.dtype)])
+
+  def lookup(self, raw_ids):
+    """Map an array of raw IDs, raising a KeyError if any is unknown."""
+    positions = np.minimum(np.searchsorted(self.sorted_ids, raw_ids),
+                           len(self) - 1)
+    found = self.sorted_ids[positions] == raw_ids
+    if not np.all(found):
+      raise KeyError(np.asarray(raw_ids)[np.logical_not(found)])
+    return self.indices[positions]
+
+  def __len__(self):
+    return self.sorted_ids.shape[0]
+
+  def __getitem__(self, raw_id):
+    return int(self.lookup(np.array([raw_id]))[0])
+
+  def __contains__(self, raw_id):
+    try:
+      self.lookup(np.array([raw_id]))
+      return True
+    except KeyError:
+      return False
+
+
+def _preprocessing_params():
+  """Parameters which change the contents of the cache."""
+  return {"min_num_ratings": rconst.MIN_NUM_RATINGS}
+
+
+def _source_stat(raw_rating_path):
+  stat = tf.gfile.Stat(raw_rating_path)
+  return {"size": stat.length, "mtime_nsec": stat.mtime_nsec}
+
+
+def _source_sha256(raw_rating_path):
+  sha256 = hashlib.sha256()
+  with tf.gfile.Open(raw_rating_path, "rb") as f:
+    for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b""):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+
+def _write_manifest(cache_path, manifest):
+  with tf.gfile.Open(os.path.join(cache_path, _CACHE_MANIFEST_FILE), "w") as f:
+    json.dump(manifest, f, sort_keys=True)
+
+
+def _read_raw_ratings(raw_rating_path, chunk_size=None):
+  # type: (str, typing.Optional[int]) -> (np.ndarray, np.ndarray, np.ndarray)
+  """Read the user, item and timestamp columns of a ratings CSV.
+
+  Args:
+    raw_rating_path: The path to the CSV which contains the raw dataset.
+    chunk_size: If set, the CSV is parsed this many rows at a time and only
+      the three needed columns of each chunk are kept, so that the peak memory
+      is a small multiple of the final arrays rather than of a DataFrame of
+      the whole file. The columns themselves are still read in full. Ignored
+      when the binary copy of the CSV is read.
+
+  Returns:
+    Arrays of the raw user ids, item ids and timestamps.
+  """
+  columns = [movielens.USER_COLUMN, movielens.ITEM_COLUMN,
+             movielens.TIMESTAMP_COLUMN]
+
+  # The binary copy written by movielens.download avoids parsing the CSV.
+  binary = movielens.load_ratings_binary(raw_rating_path, columns)
+  if binary is not None:
+    return tuple(binary[column] for column in columns)
+
+  with tf.gfile.Open(raw_rating_path) as f:
+    if chunk_size is None:
+      df = pd.read_csv(f, usecols=columns)
+      return tuple(df[column].values for column in columns)
+
+    chunks = {column: [] for column in columns}
+    for chunk in pd.read_csv(f, usecols=columns, chunksize=chunk_size):
+      for column in columns:
+        chunks[column].append(chunk[column].values)
+  return tuple(np.concatenate(chunks[column]) for column in columns)
+
+
+def _write_cache(cache_path, raw_rating_path, data):
+  """Write each array of the processed data to its own .npy file."""
+  if tf.gfile.Exists(cache_path):
+    tf.gfile.DeleteRecursively(cache_path)
+  tf.gfile.MakeDirs(cache_path)
+  for key in _EXPECTED_CACHE_KEYS:
+    value = data[key]
+    if isinstance(value, IdMap):
+      value = value.to_array()
+    with tf.gfile.Open(os.path.join(cache_path, key + ".npy"), "wb") as f:
+      np.save(f, value, allow_pickle=False)
+
+  # The manifest is written last, so that a partially written cache is never
+  # considered valid.
+  source = _source_stat(raw_rating_path)
+  source["sha256"] = _source_sha256(raw_rating_path)
+  _write_manifest(cache_path, {
+      "version": _CACHE_VERSION,
+      "source": source,
+      "params": _preprocessing_params(),
+  })
+
+
+def _cache_is_valid(cache_path, raw_rating_path):
+  # type: (str, str) -> bool
+  """Validate the cache against its source using only the manifest.
+
+  The cache is valid if it was built with the current preprocessing parameters
+  from a file of the same size and modification time. If only the modification
+  time differs (e.g. the CSV was copied or touched), the file is hashed and the
+  manifest updated if the contents are unchanged.
+  """
+  manifest_path = os.path.join(cache_path, _CACHE_MANIFEST_FILE)
+  if not tf.gfile.Exists(manifest_path):
+    return False
+
+  with tf.gfile.Open(manifest_path, "r") as f:
+    manifest = json.load(f)
+
+  source = _source_stat(raw_rating_path)
+  if (manifest.get("version") != _CACHE_VERSION or
+      manifest.get("params") != _preprocessing_params() or
+      manifest["source"]["size"] != source["size"]):
+    return False
+
+  if manifest["source"]["mtime_nsec"] != source["mtime_nsec"]:
+    if _source_sha256(raw_rating_path) != manifest["source"]["sha256"]:
+      return False
+    tf.logging.info("Raw data modification time changed, but its contents "
+                    "did not. Updating the cache manifest.")
+    manifest["source"]["mtime_nsec"] = source["mtime_nsec"]
+    _write_manifest(cache_path, manifest)
+
+  return True
+
+
+def _read_cache(cache_path, raw_rating_path):
+  # type: (str, str) -> typing.Optional[dict]
+  """Read the processed data, or return None if the cache is not valid.
+
+  Local caches are memory mapped rather than read, so they load in constant
+  time.
+  """
+  if not _cache_is_valid(cache_path, raw_rating_path):
+    if tf.gfile.Exists(cache_path):
+      tf.logging.info("Removing stale raw data cache.")
+      tf.gfile.DeleteRecursively(cache_path)
+    return None
+
+  data = {}
+  for key in _EXPECTED_CACHE_KEYS:
+    path = os.path.join(cache_path, key + ".npy")
+    if os.path.exists(path):
+      data[key] = np.load(path, mmap_mode="r", allow_pickle=False)
+    else:
+      with tf.gfile.Open(path, "rb") as f:
+        data[key] = np.load(f, allow_pickle=False)
+
+  for key in (rconst.USER_MAP, rconst.ITEM_MAP):
+    data[key] = IdMap.from_array(data[key])
+  return data
+
+
+def _filter_index_sort(raw_rating_path, cache_path, chunk_size=None):
+  # type: (str, str, typing.Optional[int]) -> (dict, bool)
   """Read in data CSV, and output structured data.
 
   This function reads in the raw CSV of positive items, and performs three
@@ -60,66 +257,46 @@ def _filter_index_sort(raw_rating_path, cache_path):
   2)  Zero index the users and items such that the largest user_id is
       `num_users - 1` and the largest item_id is `num_items - 1`
 
-  3)  Sort the dataframe by user_id, with timestamp as a secondary sort key.
-      This allows the dataframe to be sliced by user in-place, and for the last
+  3)  Sort the data by user_id, with timestamp as a secondary sort key.
+      This allows the data to be sliced by user in-place, and for the last
       item to be selected simply by calling the `-1` index of a user's slice.
 
-  While all of these transformations are performed by Pandas (and are therefore
-  single-threaded), they only take ~2 minutes, and the overhead to apply a
-  MapReduce pattern to parallel process the dataset adds significant complexity
-  for no computational gain. For a larger dataset parallelizing this
-  preprocessing could yield speedups. (Also, this preprocessing step is only
-  performed once for an entire run.
+  All of these transformations are vectorized NumPy / Pandas operations on
+  the user, item and timestamp columns (pd.factorize to count and index, sorts
+  to order, and a boundary mask to select the last item of each user) rather
+  than per-row or per-group Python callbacks. The results are cached as one
+  .npy file per array in the `cache_path` directory, along with a manifest
+  identifying the source file and preprocessing parameters.
 
   Args:
     raw_rating_path: The path to the CSV which contains the raw dataset.
-    cache_path: The path to the file where results of this function are saved.
+    cache_path: The path to the directory where results of this function are
+      saved.
+    chunk_size: If set, parse the CSV in chunks of this many rows, so that no
+      DataFrame of the whole CSV is built. See _read_raw_ratings.
 
   Returns:
-    A filtered, zero-index remapped, sorted dataframe, a dict mapping raw user
-    IDs to regularized user IDs, and a dict mapping raw item IDs to regularized
-    item IDs.
+    A dict of the sorted training and evaluation positives and the IdMaps from
+    raw user and item IDs to regularized IDs, as well as whether the cache was
+    valid.
   """
-  valid_cache = tf.gfile.Exists(cache_path)
-  if valid_cache:
-    with tf.gfile.Open(cache_path, "rb") as f:
-      cached_data = pickle.load(f)
-
-    cache_age = time.time() - cached_data.get("create_time", 0)
-    if cache_age > rconst.CACHE_INVALIDATION_SEC:
-      valid_cache = False
-
-    for key in _EXPECTED_CACHE_KEYS:
-      if key not in cached_data:
-        valid_cache = False
+  data = _read_cache(cache_path, raw_rating_path)
+  valid_cache = data is not None
 
-    if not valid_cache:
-      tf.logging.info("Removing stale raw data cache file.")
-      tf.gfile.Remove(cache_path)
-
-  if valid_cache:
-    data = cached_data
-  else:
-    with tf.gfile.Open(raw_rating_path) as f:
-      df = pd.read_csv(f)
+  if not valid_cache:
+    users, items, timestamps = _read_raw_ratings(raw_rating_path, chunk_size)
 
     # Get the info of users who have more than 20 ratings on items
-    grouped = df.groupby(movielens.USER_COLUMN)
-    df = grouped.filter(
-        lambda x: len(x) >= rconst.MIN_NUM_RATINGS) # type: pd.DataFrame
-
-    original_users = df[movielens.USER_COLUMN].unique()
-    original_items = df[movielens.ITEM_COLUMN].unique()
+    user_codes, _ = pd.factorize(users)
+    keep = np.bincount(user_codes)[user_codes] >= rconst.MIN_NUM_RATINGS
+    users, items, timestamps = users[keep], items[keep], timestamps[keep]
 
-    # Map the ids of user and item to 0 based index for following processing
+    # Map the ids of user and item to 0 based index for following processing.
+    # factorize numbers the ids in order of appearance, like enumerating
+    # pd.Series.unique().
     tf.logging.info("Generating user_map and item_map...")
-    user_map = {user: index for index, user in enumerate(original_users)}
-    item_map = {item: index for index, item in enumerate(original_items)}
-
-    df[movielens.USER_COLUMN] = df[movielens.USER_COLUMN].apply(
-        lambda user: user_map[user])
-    df[movielens.ITEM_COLUMN] = df[movielens.ITEM_COLUMN].apply(
-        lambda item: item_map[item])
+    users, original_users = pd.factorize(users)
+    items, original_items = pd.factorize(items)
 
     num_users = len(original_users)
     num_items = len(original_items)
@@ -129,47 +306,41 @@ def _filter_index_sort(raw_rating_path, cache_path):
 
     assert num_users <= np.iinfo(rconst.USER_DTYPE).max
     assert num_items <= np.iinfo(rconst.ITEM_DTYPE).max
-    assert df[movielens.USER_COLUMN].max() == num_users - 1
-    assert df[movielens.ITEM_COLUMN].max() == num_items - 1
+    assert users.max() == num_users - 1
+    assert items.max() == num_items - 1
 
-    # This sort is used to shard the dataframe by user, and later to select
-    # the last item for a user to be used in validation.
+    # This sort is used to shard the data by user, and later to select the
+    # last item for a user to be used in validation.
     tf.logging.info("Sorting by user, timestamp...")
 
-    # This sort is equivalent to
-    #   df.sort_values([movielens.USER_COLUMN, movielens.TIMESTAMP_COLUMN],
-    #   inplace=True)
-    # except that the order of items with the same user and timestamp are
-    # sometimes different. For some reason, this sort results in a better
-    # hit-rate during evaluation, matching the performance of the MLPerf
-    # reference implementation.
-    df.sort_values(by=movielens.TIMESTAMP_COLUMN, inplace=True)
-    df.sort_values([movielens.USER_COLUMN, movielens.TIMESTAMP_COLUMN],
-                   inplace=True, kind="mergesort")
-
-    df = df.reset_index()  # The dataframe does not reconstruct indices in the
-                           # sort or filter steps.
-
-    grouped = df.groupby(movielens.USER_COLUMN, group_keys=False)
-    eval_df, train_df = grouped.tail(1), grouped.apply(lambda x: x.iloc[:-1])
+    # This sort is equivalent to a lexsort by user then timestamp, except that
+    # the order of items with the same user and timestamp are sometimes
+    # different. For some reason, this sort results in a better hit-rate during
+    # evaluation, matching the performance of the MLPerf reference
+    # implementation. (It reproduces the sort_values calls of the original
+    # DataFrame implementation: a quicksort by timestamp followed by a stable
+    # sort by user and timestamp.)
+    order = np.argsort(timestamps, kind="quicksort")
+    order = order[np.lexsort((timestamps[order], users[order]))]
+    users = users[order].astype(rconst.USER_DTYPE)
+    items = items[order].astype(rconst.ITEM_DTYPE)
+
+    # The last item of each user is held out for evaluation.
+    is_eval = np.ones(users.shape, dtype=np.bool_)
+    is_eval[:-1] = users[1:] != users[:-1]
+    is_train = np.logical_not(is_eval)
 
     data = {
-        rconst.TRAIN_USER_KEY: train_df[movielens.USER_COLUMN]
-                               .values.astype(rconst.USER_DTYPE),
-        rconst.TRAIN_ITEM_KEY: train_df[movielens.ITEM_COLUMN]
-                               .values.astype(rconst.ITEM_DTYPE),
-        rconst.EVAL_USER_KEY: eval_df[movielens.USER_COLUMN]
-                              .values.astype(rconst.USER_DTYPE),
-        rconst.EVAL_ITEM_KEY: eval_df[movielens.ITEM_COLUMN]
-                              .values.astype(rconst.ITEM_DTYPE),
-        rconst.USER_MAP: user_map,
-        rconst.ITEM_MAP: item_map,
-        "create_time": time.time(),
+        rconst.TRAIN_USER_KEY: users[is_train],
+        rconst.TRAIN_ITEM_KEY: items[is_train],
+        rconst.EVAL_USER_KEY: users[is_eval],
+        rconst.EVAL_ITEM_KEY: items[is_eval],
+        rconst.USER_MAP: IdMap.from_raw_ids(np.asarray(original_users)),
+        rconst.ITEM_MAP: IdMap.from_raw_ids(np.asarray(original_items)),
     }
 
     tf.logging.info("Writing raw data cache.")
-    with tf.gfile.Open(cache_path, "wb") as f:
-      pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_cache(cache_path, raw_rating_path, data)
 
   # TODO(robieta): MLPerf cache clear.
   return data, valid_cache
@@ -192,11 +363,14 @@ def instantiate_pipeline(dataset, data_dir, params, constructor_type=None,
 
   st = timeit.default_timer()
   raw_rating_path = os.path.join(data_dir, dataset, movielens.RATINGS_FILE)
-  cache_path = os.path.join(data_dir, dataset, rconst.RAW_CACHE_FILE)
+  cache_path = os.path.join(data_dir, dataset, rconst.RAW_CACHE_DIR)
 
-  raw_data, _ = _filter_index_sort(raw_rating_path, cache_path)
+  raw_data, _ = _filter_index_sort(raw_rating_path, cache_path,
+                                   params.get("csv_chunk_rows"))
   user_map, item_map = raw_data["user_map"], raw_data["item_map"]
   num_users, num_items = DATASET_TO_NUM_USERS_AND_ITEMS[dataset]
+  eval_cache_dir = (os.path.join(data_dir, dataset, rconst.EVAL_CACHE_DIR)
+                    if params.get("cache_eval_data") else None)
 
   if num_users != len(user_map):
     raise ValueError("Expected to find {} users, but found {}".format(
@@ -221,7 +395,13 @@ def instantiate_pipeline(dataset, data_dir, params, constructor_type=None,
       eval_batch_size=params["eval_batch_size"],
       batches_per_eval_step=params["batches_per_step"],
       stream_files=params["use_tpu"],
-      deterministic=deterministic
+      deterministic=deterministic,
+      num_data_processes=params.get("num_data_processes", 0),
+      shard_format=params.get("shard_format", rconst.TFRECORD_SHARD_FORMAT),
+      eval_cache_dir=eval_cache_dir,
+      eval_seed=params.get("seed"),
+      run_ahead_budget_mb=params.get("run_ahead_budget_mb",
+                                     rconst.RUN_AHEAD_BUDGET_MB)
   )
 
   run_time = timeit.default_timer() - st
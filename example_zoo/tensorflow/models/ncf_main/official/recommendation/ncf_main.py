@@ -175,6 +175,12 @@ def parse_flags(flags_obj):
       "match_mlperf": flags_obj.ml_perf,
       "use_xla_for_gpu": flags_obj.use_xla_for_gpu,
       "epochs_between_evals": FLAGS.epochs_between_evals,
+      "num_data_processes": flags_obj.num_data_processes,
+      "shard_format": flags_obj.shard_format,
+      "csv_chunk_rows": flags_obj.csv_chunk_rows,
+      "cache_eval_data": flags_obj.cache_eval_data,
+      "run_ahead_budget_mb": flags_obj.run_ahead_budget_mb,
+      "seed": flags_obj.seed,
   }
 
 
@@ -385,11 +391,56 @@ def define_ncf_flags():
 
   flags.DEFINE_enum(
       name="constructor_type", default="bisection",
-      enum_values=["bisection", "materialized"], case_sensitive=False,
+      enum_values=["bisection", "materialized", "csr"], case_sensitive=False,
       help=flags_core.help_wrap(
           "Strategy to use for generating false negatives. materialized has a"
           "precompute that scales badly, but a faster per-epoch construction"
-          "time and can be faster on very large systems."))
+          "time and can be faster on very large systems. csr replaces the "
+          "per-user loops of bisection with vectorized sorts and searches."))
+
+  flags.DEFINE_integer(
+      name="num_data_processes", default=0,
+      help=flags_core.help_wrap(
+          "If greater than zero, training batches are constructed by this many "
+          "worker processes, which write into shared memory, rather than by a "
+          "thread pool. This avoids contention on the GIL when the data "
+          "constructor is the bottleneck on hosts with many cores."))
+
+  flags.DEFINE_enum(
+      name="shard_format", default=rconst.TFRECORD_SHARD_FORMAT,
+      enum_values=rconst.SHARD_FORMATS, case_sensitive=False,
+      help=flags_core.help_wrap(
+          "File format of the data shards streamed to TPUs. Opting into "
+          "binary shards, which hold fixed length records, makes shards "
+          "cheaper to write and parse than the tf.train.Example records of "
+          "the default tfrecord shards."))
+
+  flags.DEFINE_integer(
+      name="csv_chunk_rows", default=None,
+      help=flags_core.help_wrap(
+          "If set, the ratings CSV is parsed this many rows at a time during "
+          "preprocessing, so that no DataFrame of the whole CSV is built. The "
+          "user, item and timestamp columns are still held in memory in "
+          "full, and the flag has no effect when the binary copy of the "
+          "ratings is read instead of the CSV."))
+
+  flags.DEFINE_integer(
+      name="run_ahead_budget_mb", default=rconst.RUN_AHEAD_BUDGET_MB,
+      help=flags_core.help_wrap(
+          "The data constructor runs between {} and {} training epochs ahead "
+          "of training, depending on how quickly epochs are constructed and "
+          "consumed. When epochs are written to files (TPUs), this also "
+          "limits the size of the epochs buffered on disk.".format(
+              rconst.MIN_CYCLES_TO_BUFFER, rconst.MAX_CYCLES_TO_BUFFER)))
+
+  flags.DEFINE_bool(
+      name="cache_eval_data", default=False,
+      help=flags_core.help_wrap(
+          "If set, the assembled eval set (negatives and duplicate masks) is "
+          "written to data_dir the first time it is constructed, and memory "
+          "mapped by later runs with the same dataset and seed instead of "
+          "being reconstructed. The eval set is drawn with --seed, or a fixed "
+          "seed if it is not set."))
 
   flags.DEFINE_bool(
       name="ml_perf", default=False,
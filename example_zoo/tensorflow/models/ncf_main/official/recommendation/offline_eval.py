@@ -0,0 +1,304 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Compute NCF HR and NDCG from scores produced outside of the Estimator.
+
+neumf_model.compute_top_k_and_ndcg ranks the true item of each user among its
+eval negatives inside the graph, which ties evaluation to the Estimator and to
+eval batches of whole users. This module computes the same metrics with NumPy
+from blocks of scored (user, item, logit) rows, such as the predictions of an
+exported model, so that candidate models can be evaluated on CPUs.
+
+A block may hold any number of users, in any order, but all of the rows of a
+user must be in the same block. The true item of each user is given by the
+eval positives of the dataset, and the remaining rows of the user are its
+negatives. As in the graph:
+  - The rank of the true item is the number of negatives whose logit is greater
+    than or equal to its logit; ties are ranked ahead of the true item.
+  - With match_mlperf=True, each item is only counted once per user (and
+    negatives which are the true item are ignored).
+  - HR is 1 if the rank is less than top_k, and NDCG is log(2) / log(rank + 2)
+    for hits and 0 otherwise.
+
+Rather than ranking all of the candidates of a user, only the number of
+candidates which beat the true item is counted, so a block is evaluated with a
+handful of vectorized passes regardless of top_k.
+
+Usage:
+  python offline_eval.py --data_dir /tmp/movielens-data --dataset ml-20m \
+    --scores "/tmp/ncf_scores/*.npz" --num_processes 8
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import timeit
+
+# pylint: disable=g-bad-import-order
+import numpy as np
+import six
+from absl import app as absl_app
+from absl import flags
+import tensorflow as tf
+# pylint: enable=g-bad-import-order
+
+from official.datasets import movielens
+from official.recommendation import constants as rconst
+from official.recommendation import data_preprocessing
+from official.recommendation import popen_helper
+from official.utils.flags import core as flags_core
+
+
+# The array of a .npz score file which holds the logits. The users and items
+# are stored under movielens.USER_COLUMN and movielens.ITEM_COLUMN.
+LOGITS_KEY = "logits"
+
+# Set in each worker process by the pool initializer, so that the eval
+# positives are not pickled with every block.
+_WORKER_STATE = {}
+
+
+def load_scores(path):
+  """Read a block of scores written with np.savez."""
+  with tf.gfile.Open(path, "rb") as f:
+    data = np.load(f, allow_pickle=False)
+    return (data[movielens.USER_COLUMN], data[movielens.ITEM_COLUMN],
+            data[LOGITS_KEY])
+
+
+class MetricAccumulator(object):
+  """Streaming sums of HR and NDCG over blocks of scored rows."""
+
+  def __init__(self, positive_items, top_k=rconst.TOP_K, match_mlperf=False):
+    # type: (np.ndarray, int, bool) -> None
+    """Constructs a `MetricAccumulator` instance.
+
+    Args:
+      positive_items: A vector of the true eval item of each user, indexed by
+        user.
+      top_k: The length of the ranked list for HR and NDCG.
+      match_mlperf: Use the MLPerf reference convention for computing rank.
+    """
+    self._positive_items = positive_items
+    self._top_k = top_k
+    self._match_mlperf = match_mlperf
+    self.num_users = 0
+    self.hr_sum = 0.
+    self.ndcg_sum = 0.
+
+  def _ranks(self, users, items, logits):
+    """Compute the rank of the true item of each user in a block."""
+    # Group the rows of each user. Blocks are usually already grouped, in
+    # which case the sort is skipped.
+    if np.any(users[1:] < users[:-1]):
+      order = np.argsort(users, kind="mergesort")
+      users, items, logits = users[order], items[order], logits[order]
+
+    is_positive = items == self._positive_items[users]
+    if self._match_mlperf:
+      # Keep the first row of each (user, item) pair, preferring the true item
+      # so that its duplicates are the ones which are discarded.
+      pair_order = np.lexsort((~is_positive, items, users))
+      sorted_users, sorted_items = users[pair_order], items[pair_order]
+      first = np.ones(pair_order.shape, dtype=np.bool_)
+      first[1:] = ((sorted_users[1:] != sorted_users[:-1]) |
+                   (sorted_items[1:] != sorted_items[:-1]))
+      keep = np.sort(pair_order[first])
+      users, items, logits = users[keep], items[keep], logits[keep]
+      is_positive = is_positive[keep]
+
+    new_group = np.ones(users.shape, dtype=np.bool_)
+    new_group[1:] = users[1:] != users[:-1]
+    group_starts = np.flatnonzero(new_group)
+    group_ids = np.cumsum(new_group) - 1
+
+    # The first row of each user which holds the true item.
+    (positive_rows,) = np.nonzero(is_positive)
+    positive_groups, first_positive = np.unique(group_ids[positive_rows],
+                                                return_index=True)
+    if positive_groups.shape[0] != group_starts.shape[0]:
+      missing = np.setdiff1d(users[group_starts],
+                             users[positive_rows], assume_unique=True)
+      raise ValueError("The true item of users {} is not in the block."
+                       .format(missing[:10].tolist()))
+    positive_logits = logits[positive_rows[first_positive]]
+
+    # Every row which ties or beats the true item, less the true item itself.
+    at_least_positive = logits >= positive_logits[group_ids]
+    return np.add.reduceat(at_least_positive.astype(np.int64),
+                           group_starts) - 1
+
+  def update(self, users, items, logits):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> None
+    """Add the metrics of the users in a block of scored rows.
+
+    Args:
+      users: A vector of user indices.
+      items: A vector of item indices, the same shape as users.
+      logits: A vector of the predicted logit of each (user, item) row.
+    """
+    if not users.shape == items.shape == logits.shape:
+      raise ValueError("Users {}, items {} and logits {} differ in shape."
+                       .format(users.shape, items.shape, logits.shape))
+    if not users.shape[0]:
+      return
+
+    ranks = self._ranks(users, items, logits)
+    hits = ranks < self._top_k
+    self.num_users += ranks.shape[0]
+    self.hr_sum += float(np.sum(hits))
+    self.ndcg_sum += float(np.sum(np.log(2.) / np.log(ranks[hits] + 2.)))
+
+  def merge(self, other):
+    # type: (MetricAccumulator) -> None
+    self.num_users += other.num_users
+    self.hr_sum += other.hr_sum
+    self.ndcg_sum += other.ndcg_sum
+
+  def result(self):
+    """The mean HR and NDCG over all users seen so far."""
+    if not self.num_users:
+      raise ValueError("No users have been evaluated.")
+    return {
+        rconst.HR_KEY: self.hr_sum / self.num_users,
+        rconst.NDCG_KEY: self.ndcg_sum / self.num_users,
+    }
+
+
+def _init_eval_worker(positive_items, top_k, match_mlperf):
+  _WORKER_STATE["args"] = (positive_items, top_k, match_mlperf)
+
+
+def _evaluate_block(block):
+  """Compute the metric sums of one block. This may run in a worker process."""
+  if isinstance(block, six.string_types):
+    block = load_scores(block)
+  accumulator = MetricAccumulator(*_WORKER_STATE["args"])
+  accumulator.update(*block)
+  return accumulator
+
+
+def evaluate(blocks, positive_items, top_k=rconst.TOP_K, match_mlperf=False,
+             num_processes=0):
+  """Compute HR and NDCG over an iterable of scored blocks.
+
+  Args:
+    blocks: An iterable of blocks, each of which is either a tuple of user,
+      item and logit vectors or the path of a .npz file holding them (see
+      load_scores). Paths are read by the workers, so only the path is sent to
+      them.
+    positive_items: A vector of the true eval item of each user, indexed by
+      user.
+    top_k: The length of the ranked list for HR and NDCG.
+    match_mlperf: Use the MLPerf reference convention for computing rank.
+    num_processes: If greater than zero, blocks are evaluated by this many
+      worker processes, which receive positive_items once when they are forked.
+
+  Returns:
+    A dict of the mean HR and NDCG, and the number of users evaluated.
+  """
+  init_args = (positive_items, top_k, match_mlperf)
+  if num_processes > 0:
+    get_pool = popen_helper.get_forkpool
+  else:
+    get_pool = popen_helper.get_fauxpool
+
+  total = MetricAccumulator(*init_args)
+  with get_pool(num_processes, init_worker=_init_eval_worker,
+                init_args=init_args) as pool:
+    imap = getattr(pool, "imap_unordered", pool.imap)
+    for accumulator in imap(_evaluate_block, blocks):
+      total.merge(accumulator)
+
+  metrics = total.result()
+  metrics["num_users"] = total.num_users
+  return metrics
+
+
+def load_positive_items(data_dir, dataset):
+  """Read the true eval item of each user from the preprocessed dataset."""
+  raw_rating_path = os.path.join(data_dir, dataset, movielens.RATINGS_FILE)
+  cache_path = os.path.join(data_dir, dataset, rconst.RAW_CACHE_DIR)
+  raw_data, _ = data_preprocessing._filter_index_sort(  # pylint: disable=protected-access
+      raw_rating_path, cache_path)
+
+  num_users, _ = data_preprocessing.DATASET_TO_NUM_USERS_AND_ITEMS[dataset]
+  positive_items = np.zeros(shape=(num_users,), dtype=rconst.ITEM_DTYPE)
+  positive_items[raw_data[rconst.EVAL_USER_KEY]] = (
+      raw_data[rconst.EVAL_ITEM_KEY])
+  return positive_items
+
+
+def define_flags():
+  flags.DEFINE_string(
+      name="data_dir", default="/tmp/movielens-data/",
+      help=flags_core.help_wrap("Directory containing the MovieLens data."))
+
+  flags.DEFINE_enum(
+      name="dataset", default=movielens.ML_20M,
+      enum_values=movielens.DATASETS, case_sensitive=False,
+      help=flags_core.help_wrap("Dataset the scores were computed on."))
+
+  flags.DEFINE_string(
+      name="scores", default=None,
+      help=flags_core.help_wrap(
+          "Glob of .npz files of scores, each holding {}, {} and {} vectors. "
+          "All of the rows of a user must be in the same file.".format(
+              movielens.USER_COLUMN, movielens.ITEM_COLUMN, LOGITS_KEY)))
+  flags.mark_flag_as_required("scores")
+
+  flags.DEFINE_integer(
+      name="num_processes", default=0,
+      help=flags_core.help_wrap(
+          "Number of worker processes to evaluate files with. If zero, files "
+          "are evaluated in the main process."))
+
+  flags.DEFINE_integer(
+      name="top_k", default=rconst.TOP_K,
+      help=flags_core.help_wrap("Length of the ranked list for HR and NDCG."))
+
+  flags.DEFINE_bool(
+      name="ml_perf", default=False,
+      help=flags_core.help_wrap(
+          "Use the MLPerf reference convention for computing rank, in which "
+          "duplicate items of a user are counted once."))
+
+
+def main(_):
+  flags_obj = flags.FLAGS
+  positive_items = load_positive_items(flags_obj.data_dir, flags_obj.dataset)
+  files = sorted(tf.gfile.Glob(flags_obj.scores))
+  if not files:
+    raise ValueError("No files match {}".format(flags_obj.scores))
+
+  start_time = timeit.default_timer()
+  metrics = evaluate(files, positive_items, top_k=flags_obj.top_k,
+                     match_mlperf=flags_obj.ml_perf,
+                     num_processes=flags_obj.num_processes)
+  run_time = timeit.default_timer() - start_time
+
+  tf.logging.info("Evaluated {} users from {} files in {:.1f} seconds "
+                  "({:.0f} users / sec)".format(
+                      metrics["num_users"], len(files), run_time,
+                      metrics["num_users"] / run_time))
+  tf.logging.info("HR = {:.4f}, NDCG = {:.4f}".format(
+      metrics[rconst.HR_KEY], metrics[rconst.NDCG_KEY]))
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  define_flags()
+  absl_app.run(main)
@@ -19,14 +19,16 @@ import multiprocessing
 import multiprocessing.pool
 
 
-def get_forkpool(num_workers, init_worker=None, closing=True):
-  pool = multiprocessing.Pool(processes=num_workers, initializer=init_worker)
+def get_forkpool(num_workers, init_worker=None, closing=True, init_args=()):
+  pool = multiprocessing.Pool(processes=num_workers, initializer=init_worker,
+                              initargs=init_args)
   return contextlib.closing(pool) if closing else pool
 
 
-def get_threadpool(num_workers, init_worker=None, closing=True):
+def get_threadpool(num_workers, init_worker=None, closing=True, init_args=()):
   pool = multiprocessing.pool.ThreadPool(processes=num_workers,
-                                         initializer=init_worker)
+                                         initializer=init_worker,
+                                         initargs=init_args)
   return contextlib.closing(pool) if closing else pool
 
 
@@ -34,10 +36,13 @@ class FauxPool(object):
   """Mimic a pool using for loops.
 
   This class is used in place of proper pools when true determinism is desired
-  for testing or debugging.
+  for testing or debugging. As in a real pool, the initializer is called before
+  any task is run.
   """
-  def __init__(self, *args, **kwargs):
-    pass
+  def __init__(self, processes=None, initializer=None, initargs=()):
+    del processes  # Unused.
+    if initializer is not None:
+      initializer(*initargs)
 
   def map(self, func, iterable, chunksize=None):
     return [func(i) for i in iterable]
@@ -55,6 +60,7 @@ class FauxPool(object):
   def join(self):
     pass
 
-def get_fauxpool(num_workers, init_worker=None, closing=True):
-  pool = FauxPool(processes=num_workers, initializer=init_worker)
+def get_fauxpool(num_workers, init_worker=None, closing=True, init_args=()):
+  pool = FauxPool(processes=num_workers, initializer=init_worker,
+                  initargs=init_args)
   return contextlib.closing(pool) if closing else pool
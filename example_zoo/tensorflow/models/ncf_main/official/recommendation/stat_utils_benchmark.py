@@ -0,0 +1,124 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Micro-benchmarks of the NCF sampling and de-duplication functions.
+
+mask_duplicates is timed on eval item matrices of (users per batch) x
+(1 + NUM_EVAL_NEGATIVES) items, against the original implementation which
+sorted twice. Every result is checked to be identical to the original
+implementation's before it is reported.
+
+very_slightly_biased_randint is timed on the shapes it is called with when
+sampling negatives for training and eval batches, and its outputs are checked
+to be within range.
+
+Usage:
+  python stat_utils_benchmark.py --repeats 10
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import timeit
+
+# pylint: disable=g-bad-import-order
+import numpy as np
+from absl import app as absl_app
+from absl import flags
+# pylint: enable=g-bad-import-order
+
+from official.recommendation import constants as rconst
+from official.recommendation import stat_utils
+from official.utils.flags import core as flags_core
+
+
+# ml-20m has 26744 items.
+NUM_ITEMS = 26744
+
+# Users per eval batch: the default eval batch size of 160000 on one device,
+# the MLPerf configuration on 8 devices, and a full ml-20m eval epoch in
+# chunks.
+EVAL_USERS_PER_BATCH = [160, 1000, 16384]
+
+# Negatives sampled per training batch at batch sizes 2048 and 98304, with four
+# negatives per positive.
+TRAIN_NEGATIVES_PER_BATCH = [1638, 78643]
+
+
+def _time(fn, repeats):
+  """The best of `repeats` timings of fn(), in milliseconds."""
+  return min(timeit.repeat(fn, number=1, repeat=repeats)) * 1000
+
+
+def benchmark_mask_duplicates(repeats):
+  print("{:<24}{:>16}{:>16}{:>10}".format(
+      "mask_duplicates shape", "reference (ms)", "current (ms)", "speedup"))
+  for users in EVAL_USERS_PER_BATCH:
+    x = np.random.randint(0, NUM_ITEMS,
+                          size=(users, 1 + rconst.NUM_EVAL_NEGATIVES),
+                          dtype=rconst.ITEM_DTYPE)
+    mask = stat_utils.mask_duplicates(x, axis=1)
+    if not np.array_equal(mask, stat_utils._mask_duplicates_two_sort(x)):  # pylint: disable=protected-access
+      raise ValueError("mask_duplicates differs from the reference for "
+                       "shape {}".format(x.shape))
+
+    reference_ms = _time(
+        lambda: stat_utils._mask_duplicates_two_sort(x),  # pylint: disable=protected-access,cell-var-from-loop
+        repeats)
+    current_ms = _time(
+        lambda: stat_utils.mask_duplicates(x, axis=1),  # pylint: disable=cell-var-from-loop
+        repeats)
+    print("{:<24}{:>16.2f}{:>16.2f}{:>10.2f}".format(
+        str(x.shape), reference_ms, current_ms, reference_ms / current_ms))
+
+
+def benchmark_randint(repeats):
+  print("\n{:<24}{:>16}{:>22}".format(
+      "randint shape", "time (ms)", "samples / sec (M)"))
+  shapes = ([(n,) for n in TRAIN_NEGATIVES_PER_BATCH] +
+            [(users, rconst.NUM_EVAL_NEGATIVES)
+             for users in EVAL_USERS_PER_BATCH])
+  for shape in shapes:
+    # Per user negative counts, as passed by the data constructors.
+    max_val_vector = np.random.randint(
+        NUM_ITEMS // 2, NUM_ITEMS, size=shape).astype(np.int64)
+    samples = stat_utils.very_slightly_biased_randint(max_val_vector)
+    if (samples.dtype != max_val_vector.dtype or np.any(samples < 0) or
+        np.any(samples >= max_val_vector)):
+      raise ValueError("very_slightly_biased_randint is out of range for "
+                       "shape {}".format(shape))
+
+    time_ms = _time(
+        lambda: stat_utils.very_slightly_biased_randint(max_val_vector),  # pylint: disable=cell-var-from-loop
+        repeats)
+    print("{:<24}{:>16.2f}{:>22.1f}".format(
+        str(shape), time_ms, samples.size / time_ms / 1000))
+
+
+def define_flags():
+  flags.DEFINE_integer(
+      name="repeats", default=5,
+      help=flags_core.help_wrap("Timings are the best of this many runs."))
+
+
+def main(_):
+  np.random.seed(0)
+  benchmark_mask_duplicates(flags.FLAGS.repeats)
+  benchmark_randint(flags.FLAGS.repeats)
+
+
+if __name__ == "__main__":
+  define_flags()
+  absl_app.run(main)
@@ -0,0 +1,62 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests of the single sort mask_duplicates against the two sort original."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pytest
+
+# The example's CI installs only pytest, so these tests are skipped there.
+np = pytest.importorskip("numpy")
+
+from official.recommendation import stat_utils  # pylint: disable=g-import-not-at-top
+
+
+# The dtype of items and the number of negatives of an eval row, as in
+# constants.py, which is not imported since it depends on TensorFlow.
+ITEM_DTYPE = np.int32
+NUM_EVAL_NEGATIVES = 999
+
+
+def _random_items(shape, num_items, seed=0):
+  return np.random.RandomState(seed).randint(
+      0, num_items, size=shape).astype(ITEM_DTYPE)
+
+
+CASES = {
+    "random": _random_items((100, 1 + NUM_EVAL_NEGATIVES), 500),
+    "one_column": _random_items((100, 1), 500),
+    "one_row": _random_items((1, 50), 20),
+    "few_items": _random_items((87, 50), 20),
+    "all_duplicates": np.full((48, 40), 7, dtype=ITEM_DTYPE),
+    "no_duplicates": np.tile(np.arange(40, dtype=ITEM_DTYPE)[::-1], (32, 1)),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_mask_duplicates(name):
+  x = CASES[name]
+  mask = stat_utils.mask_duplicates(x, axis=1)
+  assert mask.shape == x.shape
+  assert mask.dtype == np.int64
+  assert np.array_equal(mask, stat_utils._mask_duplicates_two_sort(x))  # pylint: disable=protected-access
+
+
+def test_all_duplicates_keeps_first():
+  mask = stat_utils.mask_duplicates(CASES["all_duplicates"])
+  assert not mask[:, 0].any()
+  assert mask[:, 1:].all()
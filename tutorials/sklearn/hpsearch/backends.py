@@ -0,0 +1,212 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Execution backends of `GKEParallel`.
+
+A backend stores objects, addressed by `gs://bucket_name/object_name` uris,
+and runs the worker jobs described by Kubernetes job bodies.
+
+`GKEBackend`: Stores objects in Google Cloud Storage and runs the jobs on a
+Google Kubernetes Engine cluster.  This is the default.
+
+`LocalProcessPoolBackend`: Stores objects in a local directory and runs each
+job as a `source/worker.py` subprocess, at most `n_nodes` at a time, without
+any cluster or cloud access.  It also records when each job started and
+ended, see `benchmark_local_backend.py`.
+"""
+
+import hashlib
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from helpers import gcs_helper
+from helpers.gke_helper import get_cluster
+from helpers.kubernetes_helper import create_jobs, delete_jobs_pods
+from source.local_storage import LocalBucket
+from source.task_queue import GCSStorage, LocalStorage
+
+
+class GKEBackend(object):
+    def __init__(self, project_id, zone, cluster_id):
+        self.cluster = get_cluster(project_id, zone, cluster_id)
+        self.n_nodes = self.cluster['currentNodeCount']
+
+    def pickle_and_upload(self, obj, bucket_name, object_name):
+        return gcs_helper.pickle_and_upload(obj, bucket_name, object_name)
+
+    def pickle_and_upload_deduplicated(self, obj, bucket_name, prefix):
+        return gcs_helper.pickle_and_upload_deduplicated(obj, bucket_name, prefix)
+
+    def save_array_and_upload_deduplicated(self, array, bucket_name, prefix):
+        return gcs_helper.save_array_and_upload_deduplicated(array, bucket_name, prefix)
+
+    def list_blob_uris(self, bucket_name, prefix):
+        return gcs_helper.list_blob_uris(bucket_name, prefix)
+
+    def download_uri_and_unpickle(self, gcs_uri):
+        return gcs_helper.download_uri_and_unpickle(gcs_uri)
+
+    def download_uris_and_unpickle(self, gcs_uris):
+        return gcs_helper.download_uris_and_unpickle(gcs_uris)
+
+    def storage(self, bucket_name):
+        # The storage of the task queue, see `source/task_queue.py`.
+        return GCSStorage(bucket_name)
+
+    def create_jobs(self, job_bodies):
+        return create_jobs(job_bodies)
+
+    def delete_jobs(self, label_selector):
+        delete_jobs_pods(label_selector=label_selector)
+
+
+class LocalProcessPoolBackend(object):
+    # The directory holding `worker.py`.
+    SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'source')
+
+    def __init__(self, root_dir=None, n_nodes=2, python=sys.executable):
+        self.root_dir = root_dir or tempfile.mkdtemp()
+        self.n_nodes = n_nodes
+        self.python = python
+
+        # Maps job names to dicts with the labels of the job, its node, and
+        # its start and end times.
+        self.jobs = {}
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._processes = {}
+        self._free_nodes = None
+
+    def __getstate__(self):
+        # The pool and processes only exist in the driving process.
+        state = self.__dict__.copy()
+        for key in ('_lock', '_pool', '_processes', '_free_nodes'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._processes = {}
+        self._free_nodes = None
+
+    def _blob(self, gcs_uri):
+        bucket_name, object_name = gcs_helper._split_uri(gcs_uri)
+        return LocalBucket(self.root_dir, bucket_name).blob(object_name)
+
+    def _upload_string(self, data, bucket_name, object_name):
+        LocalBucket(self.root_dir, bucket_name).blob(object_name).upload_from_string(data)
+        return gcs_helper._make_gcs_uri(bucket_name, object_name)
+
+    def pickle_and_upload(self, obj, bucket_name, object_name):
+        return self._upload_string(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), bucket_name, object_name)
+
+    def _upload_deduplicated(self, data, bucket_name, prefix, extension):
+        object_name = '{}/{}.{}'.format(prefix, hashlib.sha256(data).hexdigest(), extension)
+        if not LocalBucket(self.root_dir, bucket_name).blob(object_name).exists():
+            self._upload_string(data, bucket_name, object_name)
+
+        return gcs_helper._make_gcs_uri(bucket_name, object_name)
+
+    def pickle_and_upload_deduplicated(self, obj, bucket_name, prefix):
+        return self._upload_deduplicated(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), bucket_name, prefix, 'pkl')
+
+    def save_array_and_upload_deduplicated(self, array, bucket_name, prefix):
+        fd, filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            np.save(filename, array, allow_pickle=False)
+            with open(filename, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(filename)
+
+        return self._upload_deduplicated(data, bucket_name, prefix, 'npy')
+
+    def list_blob_uris(self, bucket_name, prefix):
+        return set(gcs_helper._make_gcs_uri(bucket_name, blob.name) for blob in LocalBucket(self.root_dir, bucket_name).list_blobs(prefix))
+
+    def download_uri_and_unpickle(self, gcs_uri):
+        return pickle.loads(self._blob(gcs_uri).download_as_string())
+
+    def download_uris_and_unpickle(self, gcs_uris):
+        return [self.download_uri_and_unpickle(gcs_uri) for gcs_uri in gcs_uris]
+
+    def storage(self, bucket_name):
+        return LocalStorage(os.path.join(self.root_dir, bucket_name))
+
+    def _run_job(self, job_body):
+        name = job_body['metadata']['name']
+        args = job_body['spec']['template']['spec']['containers'][0]['args']
+
+        with self._lock:
+            if name not in self.jobs:
+                # Cancelled before it started.
+                return
+            node = self._free_nodes.pop()
+            self.jobs[name].update(node=node, start=time.time())
+
+        env = dict(os.environ, HPSEARCH_LOCAL_ROOT=self.root_dir)
+        with open(os.path.join(self.root_dir, '{}.log'.format(name)), 'w') as log:
+            process = subprocess.Popen([self.python] + args, cwd=self.SOURCE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+            with self._lock:
+                self._processes[name] = process
+            process.wait()
+
+        with self._lock:
+            self._processes.pop(name, None)
+            self._free_nodes.append(node)
+            if name in self.jobs:
+                self.jobs[name].update(end=time.time(), returncode=process.returncode)
+
+    def create_jobs(self, job_bodies):
+        """Queues the jobs, which start as soon as one of the `n_nodes`
+        process slots is free, in order.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.n_nodes)
+                self._free_nodes = list(range(self.n_nodes))[::-1]
+
+            for job_body in job_bodies:
+                self.jobs[job_body['metadata']['name']] = {'labels': job_body['metadata'].get('labels', {}), 'queued': time.time()}
+
+        for job_body in job_bodies:
+            self._pool.apply_async(self._run_job, (job_body,))
+
+    def delete_jobs(self, label_selector):
+        key, value = label_selector.split('=')
+        with self._lock:
+            for name in [name for name, job in self.jobs.items() if job['labels'].get(key) == value]:
+                del self.jobs[name]
+                if name in self._processes:
+                    self._processes[name].kill()
+
+    def join(self):
+        """Blocks until every queued job has ended."""
+        while True:
+            with self._lock:
+                if all('end' in job for job in self.jobs.values()):
+                    return
+            time.sleep(0.1)
@@ -0,0 +1,147 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares ways of cancelling a search against a fake Kubernetes API.
+
+The namespace holds the jobs and pods of the cancelled search among many
+pods of other tasks, some of which were not created by a job.  Each request
+to the fake API sleeps for `latency` seconds, so the reported times reflect
+both the number of requests and the time spent matching pods locally.
+
+    list:   deletes the jobs one by one, then the pods whose job is found in
+            a list of job names (the original `delete_jobs_pods`).
+    set:    same, with a set of job names (`delete_jobs_pods(job_names)`).
+    label:  deletes the jobs and pods matching the task label, with one
+            request each (`delete_jobs_pods(label_selector=...)`).
+
+Usage:
+
+    python benchmark_cleanup.py --n_jobs 100 --n_pods 5000 --latency 0.005
+"""
+
+import argparse
+import time
+
+from helpers import kubernetes_helper
+
+
+TASK_LABEL = 'hpsearch-task'
+
+
+class _Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeKubernetesApi(object):
+    """Implements the subset of `BatchV1Api` and `CoreV1Api` used by
+    `kubernetes_helper.delete_jobs_pods`.
+    """
+    def __init__(self, n_jobs, n_pods, latency):
+        self.latency = latency
+        self.n_requests = 0
+
+        self.jobs = {}
+        self.pods = {}
+
+        for i in range(n_jobs):
+            name = 'task.worker.{}'.format(i)
+            labels = {TASK_LABEL: 'task'}
+            self.jobs[name] = labels
+            self.pods['{}-pod'.format(name)] = dict(labels, **{'job-name': name})
+
+        for i in range(n_pods - n_jobs):
+            if i % 10 == 0:
+                # Pods created without a job.
+                self.pods['other-{}'.format(i)] = None
+            else:
+                name = 'other.worker.{}'.format(i)
+                self.jobs[name] = {TASK_LABEL: 'other'}
+                self.pods['{}-pod'.format(name)] = {TASK_LABEL: 'other', 'job-name': name}
+
+    def _request(self):
+        self.n_requests += 1
+        time.sleep(self.latency)
+
+    @staticmethod
+    def _matches(labels, label_selector):
+        key, value = label_selector.split('=')
+        return (labels or {}).get(key) == value
+
+    def delete_namespaced_job(self, name, body, namespace):
+        self._request()
+        del self.jobs[name]
+
+    def delete_namespaced_pod(self, name, body, namespace):
+        self._request()
+        del self.pods[name]
+
+    def list_namespaced_pod(self, namespace):
+        self._request()
+        return _Object(items=[_Object(metadata=_Object(name=name, labels=labels)) for name, labels in self.pods.items()])
+
+    def delete_collection_namespaced_job(self, namespace, label_selector):
+        self._request()
+        self.jobs = dict((name, labels) for name, labels in self.jobs.items() if not self._matches(labels, label_selector))
+
+    def delete_collection_namespaced_pod(self, namespace, label_selector):
+        self._request()
+        self.pods = dict((name, labels) for name, labels in self.pods.items() if not self._matches(labels, label_selector))
+
+
+def delete_jobs_pods_list(job_names, api):
+    # The original implementation, with `.get` so that it does not fail on
+    # pods without a `job-name` label.
+    job_names = list(job_names)
+    for job_name in job_names:
+        api.delete_namespaced_job(name=job_name, body=None, namespace='default')
+
+    for pod in api.list_namespaced_pod(namespace='default').items:
+        if (pod.metadata.labels or {}).get('job-name') in job_names:
+            api.delete_namespaced_pod(name=pod.metadata.name, body=None, namespace='default')
+
+
+def run(n_jobs, n_pods, latency):
+    job_names = ['task.worker.{}'.format(i) for i in range(n_jobs)]
+
+    methods = [
+        ('list', lambda: delete_jobs_pods_list(job_names, api)),
+        ('set', lambda: kubernetes_helper.delete_jobs_pods(job_names)),
+        ('label', lambda: kubernetes_helper.delete_jobs_pods(label_selector='{}=task'.format(TASK_LABEL))),
+    ]
+
+    print('{:<10}{:>12}{:>12}{:>12}'.format('method', 'seconds', 'requests', 'pods left'))
+    for name, method in methods:
+        api = FakeKubernetesApi(n_jobs, n_pods, latency)
+        kubernetes_helper.get_batch_api = lambda: api
+        kubernetes_helper.get_core_api = lambda: api
+
+        start = time.time()
+        method()
+        elapsed = time.time() - start
+
+        assert not [job for job in api.jobs if job in job_names]
+        print('{:<10}{:>12.3f}{:>12}{:>12}'.format(name, elapsed, api.n_requests, len(api.pods)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--n_jobs', type=int, default=100)
+    parser.add_argument('--n_pods', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.005)
+
+    args = parser.parse_args()
+
+    run(args.n_jobs, args.n_pods, args.latency)
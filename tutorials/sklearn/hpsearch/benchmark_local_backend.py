@@ -0,0 +1,133 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs GKEParallel searches end to end on a `LocalProcessPoolBackend`.
+
+For each kind of search and number of candidates, a random forest is tuned on
+synthetic data, and the following are reported:
+
+    makespan:   seconds from `fit` until `done` returns True.
+    idle:       mean fraction of the makespan each node spent without a job.
+    serialize:  fraction of the workers' time spent loading data and the
+                search, and uploading results, rather than fitting.
+    driver:     seconds the driver spent uploading in `fit` and downloading
+                in `result`.
+
+Since everything runs on this machine, the numbers do not include network
+transfers, but they allow comparing scheduling and serialization changes
+reproducibly.
+
+Usage:
+
+    python benchmark_local_backend.py --n_nodes 4 --sizes 8 32 --work_stealing
+"""
+
+import argparse
+import time
+
+from scipy.stats import randint
+from sklearn.datasets import make_classification
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
+from skopt import BayesSearchCV
+from skopt.space import Integer
+
+from backends import LocalProcessPoolBackend
+from gke_parallel import GKEParallel
+
+
+def make_search(kind, size, random_state=0):
+    estimator = RandomForestClassifier(random_state=random_state)
+
+    if kind == 'grid':
+        # size candidates, with fitting times varying by a factor of 16.
+        n_depths = max(size // 4, 1)
+        param_grid = {
+            'n_estimators': [5, 10, 20, 40][:min(size, 4)],
+            'max_depth': list(range(2, 2 + n_depths)),
+        }
+        return GridSearchCV(estimator, param_grid, n_jobs=1)
+
+    elif kind == 'random':
+        param_distributions = {
+            'n_estimators': randint(5, 40),
+            'max_depth': randint(2, 10),
+        }
+        return RandomizedSearchCV(estimator, param_distributions, n_iter=size, n_jobs=1, random_state=random_state)
+
+    elif kind == 'bayes':
+        search_spaces = {
+            'n_estimators': Integer(5, 40),
+            'max_depth': Integer(2, 10),
+        }
+        return BayesSearchCV(estimator, search_spaces, n_iter=size, n_jobs=1, random_state=random_state)
+
+
+def run_one(kind, size, n_nodes, X, y, work_stealing):
+    backend = LocalProcessPoolBackend(n_nodes=n_nodes)
+    search = make_search(kind, size)
+    gke_search = GKEParallel(search, None, None, 'local', 'local', 'worker', work_stealing=work_stealing, backend=backend)
+
+    start = time.time()
+    gke_search.fit(X, y)
+    fit_time = time.time() - start
+
+    gke_search.wait(poll_interval=0.1, max_poll_interval=0.5)
+    makespan = time.time() - start
+
+    start = time.time()
+    gke_search.result()
+    result_time = time.time() - start
+
+    backend.join()
+
+    # Idle time per node, between the start of the search and its end.
+    busy = [0.0] * n_nodes
+    for job in backend.jobs.values():
+        busy[job['node']] += job['end'] - job['start']
+    idle = sum(max(makespan - b, 0.0) for b in busy) / (n_nodes * makespan)
+
+    serialize = 0.0
+    total = 0.0
+    for name in backend.jobs:
+        worker_id = name.split('.worker.')[-1]
+        timings = backend.download_uri_and_unpickle('gs://{}/{}/{}/timings.pkl'.format(gke_search.bucket_name, gke_search.task_name, worker_id))
+        serialize += timings['load'] + timings['upload']
+        total += sum(timings.values())
+
+    return makespan, idle, serialize / total, fit_time + result_time, gke_search.best_score_
+
+
+def run(kinds, sizes, n_nodes, n_samples, work_stealing):
+    X, y = make_classification(n_samples=n_samples, n_features=20, random_state=0)
+
+    print('{:<10}{:>8}{:>12}{:>10}{:>12}{:>10}{:>10}'.format('search', 'size', 'makespan', 'idle', 'serialize', 'driver', 'score'))
+    for kind in kinds:
+        for size in sizes:
+            makespan, idle, serialize, driver, score = run_one(kind, size, n_nodes, X, y, work_stealing)
+            print('{:<10}{:>8}{:>12.2f}{:>10.1%}{:>12.1%}{:>10.2f}{:>10.4f}'.format(kind, size, makespan, idle, serialize, driver, score))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--kinds', nargs='+', default=['grid', 'random', 'bayes'], choices=['grid', 'random', 'bayes'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[8, 32])
+    parser.add_argument('--n_nodes', type=int, default=2)
+    parser.add_argument('--n_samples', type=int, default=2000)
+    parser.add_argument('--work_stealing', action='store_true')
+
+    args = parser.parse_args()
+
+    run(args.kinds, args.sizes, args.n_nodes, args.n_samples, args.work_stealing)
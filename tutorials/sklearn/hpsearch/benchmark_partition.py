@@ -0,0 +1,170 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the makespan of grid partitioning strategies on synthetic grids.
+
+The fitting time of each cell of a grid is simulated from the asymptotic cost
+of fitting and scoring the estimator on `N_SAMPLES` rows of `N_FEATURES`
+features, perturbed with log-normal noise.  These costs are independent of
+the cost models being compared: they are nonlinear in the parameters, whose
+effects interact (e.g. the depth of a tree saturates, and matters more the
+more features each split tries), and depend on parameters the heuristic
+ignores, such as `max_features` or `subsample`.  Partitions are then
+scheduled on `n_nodes` workers in order, each partition going to the first
+worker that becomes idle, as Kubernetes would do with the jobs.
+
+Usage:
+
+    python benchmark_partition.py --n_nodes 8 --noise 0.3
+"""
+
+import argparse
+import heapq
+
+import numpy as np
+from sklearn.model_selection import ParameterGrid
+
+from partitioning import HeuristicCostModel, TimingCostModel, partition_param_grid, split_param_grid_by_keys
+
+
+SYNTHETIC_GRIDS = {
+    'random_forest': {
+        'n_estimators': [10, 50, 100, 200, 500],
+        'max_depth': [3, 5, 10, 20, None],
+        'max_features': ['sqrt', 'log2', 0.5],
+    },
+    'gradient_boosting': {
+        'learning_rate': [0.01, 0.05, 0.1],
+        'n_estimators': [50, 100, 200, 400, 800],
+        'max_depth': [2, 3, 5, 8],
+        'subsample': [0.5, 0.8, 1.0],
+    },
+    'knn': {
+        'weights': ['uniform', 'distance'],
+        'n_neighbors': [1, 2, 4, 8, 16, 32, 64],
+        'leaf_size': [10, 30, 100],
+    },
+}
+
+
+# The size of the simulated training data.
+N_SAMPLES = 10000
+N_FEATURES = 100
+
+
+def _forest_cost(params):
+    # Each tree tries max_features features at each of its nodes, and has
+    # about N_SAMPLES nodes per level up to the depth where leaves are pure.
+    n_features = {'sqrt': np.sqrt(N_FEATURES), 'log2': np.log2(N_FEATURES)}.get(params['max_features'])
+    if n_features is None:
+        n_features = params['max_features'] * N_FEATURES
+
+    depth = np.log2(N_SAMPLES)
+    if params['max_depth'] is not None:
+        depth = min(params['max_depth'], depth)
+
+    return params['n_estimators'] * n_features * N_SAMPLES * depth * 1e-6
+
+
+def _boosting_cost(params):
+    # Trees are fitted one after the other on a subsample, each split trying
+    # every feature, and deep trees have more nodes than rows to split.
+    rows = params['subsample'] * N_SAMPLES
+    levels = min(params['max_depth'], np.log2(rows))
+    per_tree = N_FEATURES * rows * np.log2(rows) * levels
+
+    # A large learning rate overfits early, and later trees split fewer rows.
+    shrink = 1.0 / (1.0 + 5 * params['learning_rate'] * np.log1p(params['n_estimators']))
+
+    return params['n_estimators'] * per_tree * (0.5 + 0.5 * shrink) * 1e-8
+
+
+def _knn_cost(params):
+    # Fitting builds a tree, while scoring queries it for every test row:
+    # small leaves mean deep descents, large leaves mean brute force scans,
+    # and distance weighting adds work per neighbor.
+    build = N_SAMPLES * np.log2(N_SAMPLES / float(params['leaf_size']))
+    per_query = (np.log2(N_SAMPLES / float(params['leaf_size'])) + params['leaf_size']) * np.log2(1 + params['n_neighbors'])
+    if params['weights'] == 'distance':
+        per_query *= 1.0 + 0.05 * params['n_neighbors']
+
+    return (build + N_SAMPLES * per_query) * N_FEATURES * 1e-6
+
+
+SIMULATED_COSTS = {
+    'random_forest': _forest_cost,
+    'gradient_boosting': _boosting_cost,
+    'knn': _knn_cost,
+}
+
+
+def simulated_fit_time(name, params, noise, random_state):
+    return SIMULATED_COSTS[name](params) * random_state.lognormal(0, noise)
+
+
+def makespan(partitions, fit_times, n_nodes):
+    """List-schedules the partitions on n_nodes workers and returns the time
+    at which the last worker finishes.
+    """
+    loads = [0.0] * n_nodes
+    for partition in partitions:
+        duration = sum(fit_times[_key(params)] for grid in partition for params in ParameterGrid(grid))
+        heapq.heappush(loads, heapq.heappop(loads) + duration)
+
+    return max(loads)
+
+
+def _key(params):
+    return tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+
+def run(n_nodes, noise, seed):
+    random_state = np.random.RandomState(seed)
+
+    print('{:<20}{:>12}{:>12}{:>12}{:>12}{:>12}'.format('grid', 'cells', 'bound', 'keys', 'heuristic', 'timing'))
+    for name, param_grid in sorted(SYNTHETIC_GRIDS.items()):
+        cells = list(ParameterGrid(param_grid))
+        fit_times = dict((_key(params), simulated_fit_time(name, params, noise, random_state)) for params in cells)
+
+        # The timing model learns from an earlier run on a random half of
+        # the grid with independent noise.
+        history = [cells[i] for i in random_state.permutation(len(cells))[:len(cells) // 2]]
+        timing_model = TimingCostModel().fit({
+            'params': history,
+            'mean_fit_time': [simulated_fit_time(name, params, noise, random_state) for params in history],
+        })
+
+        keys = split_param_grid_by_keys(param_grid, n_nodes)
+        heuristic = partition_param_grid(param_grid, n_nodes, HeuristicCostModel(param_grid))
+        timing = partition_param_grid(param_grid, n_nodes, timing_model)
+
+        bound = max(sum(fit_times.values()) / n_nodes, max(fit_times.values()))
+
+        print('{:<20}{:>12}{:>12.0f}{:>12.0f}{:>12.0f}{:>12.0f}'.format(
+            name, len(cells), bound,
+            makespan([[grid] for grid in keys], fit_times, n_nodes),
+            makespan(heuristic, fit_times, n_nodes),
+            makespan(timing, fit_times, n_nodes)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--n_nodes', type=int, default=8)
+    parser.add_argument('--noise', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    run(args.n_nodes, args.noise, args.seed)
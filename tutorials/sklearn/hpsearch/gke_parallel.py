@@ -13,16 +13,21 @@
 # limitations under the License.
 
 
+import hashlib
+import re
 import time
 import numpy as np
-from helpers.gke_helper import get_cluster
-from helpers.gcs_helper import pickle_and_upload, get_uri_blob, download_uri_and_unpickle
-from helpers.kubernetes_helper import create_job, delete_jobs_pods
+from backends import GKEBackend
+from partitioning import partition_param_grid
+from source.eval_cache import open_cache
+from source.results import cv_results_to_rows, rows_to_cv_results, score_key, best_index
+from source.task_queue import TaskQueue
 from copy import deepcopy
-from itertools import product
-from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
-from skopt import BayesSearchCV
+from sklearn.base import clone
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, ParameterGrid, ParameterSampler
+from skopt import BayesSearchCV, Optimizer
 from skopt.space import Categorical, Integer, Real
+from skopt.utils import dimensions_aslist, point_asdict
 
 
 class GKEParallel(object):
@@ -32,23 +37,104 @@ class GKEParallel(object):
         BayesSearchCV
     ]
 
-    def __init__(self, search, project_id, zone, cluster_id, bucket_name, image_name, task_name=None):
+    # Jobs and their pods are labeled with the task name under this key, so
+    # that all of them can be selected at once.
+    TASK_LABEL = 'hpsearch-task'
+
+    # Training data is stored under this prefix, keyed by content hash, so
+    # that it can be shared across tasks.
+    DATA_PREFIX = 'data'
+
+    def __init__(self, search, project_id, zone, cluster_id, bucket_name, image_name, task_name=None, cost_model=None,
+                 work_stealing=False, lease_size=4, lease_timeout=600, stream_results=False, target_score=None, max_wall_clock=None, cache_uri=None,
+                 lean=False, compress=False, backend=None):
         """Wraps around a SearchCV object and handles deploying `fit`
         jobs to a GKE cluster.
+
+        `cost_model` is used to balance a GridSearchCV's param_grid across
+        workers.  See `partitioning.py`.
+
+        If `work_stealing` is True, the candidates of a GridSearchCV or
+        RandomizedSearchCV are put in a queue in batches of `lease_size`,
+        and each node runs a worker that keeps leasing batches until the
+        queue is empty, so that no node idles while others still have
+        work.  A batch leased more than `lease_timeout` seconds ago is
+        leased again by idle workers, in case its worker died.  See
+        `source/task_queue.py`.
+
+        For a BayesSearchCV, `work_stealing` instead makes this process the
+        coordinator of a single skopt Optimizer: batches of `n_points`
+        points are asked with the constant liar strategy and put in the
+        queue, and the scores posted by the workers are told back to the
+        optimizer by `done`, so that every worker benefits from all
+        evaluations so far.
+
+        If `stream_results` is True, the workers of a GridSearchCV or
+        RandomizedSearchCV upload the scores of their candidates as they
+        are fitted, which `leaderboard` merges while the search runs.
+
+        The search stops early, cancelling the remaining jobs, once a
+        candidate reaches `target_score` or `max_wall_clock` seconds have
+        passed since `fit`.  Both need either `stream_results` or
+        `work_stealing`, since otherwise no result is known before the
+        workers are done.  For a BayesSearchCV, `stream_results`,
+        `target_score` and `max_wall_clock` all need `work_stealing`.
+        After stopping early, `result` returns the `cv_results_` of the
+        candidates fitted so far.
+
+        `cache_uri`, a `gs://bucket/prefix` uri, is the location of an
+        evaluation cache shared across tasks: workers of a GridSearchCV or
+        RandomizedSearchCV reuse the result of any candidate already fitted
+        on the same data with the same cross validation settings.  Its
+        tables are compacted once the workers are done.  See
+        `source/eval_cache.py`.
+
+        If `lean` is True, workers upload the compacted `cv_results_` of
+        their search and their best estimator, gzip compressed if
+        `compress` is True, instead of pickling the fitted search object
+        twice.  `result` then compares the workers' scores from their
+        tables, and downloads only the overall best estimator.
+
+        `backend` stores the task's objects and runs the workers, by default
+        a `GKEBackend` for the given cluster.  With a
+        `LocalProcessPoolBackend` the search runs on this machine, and the
+        bucket is a directory.  See `backends.py`.
         """
         if type(search) not in self.SUPPORTED_SEARCH:
             raise TypeError('Search type {} not supported.  Only supporting {}.'.format(type(search), [s.__name__ for s in self.SUPPORTED_SEARCH]))
 
+        if type(search) == BayesSearchCV and not work_stealing:
+            # Bayes search workers neither stream nor share their results.
+            for name, value in [('stream_results', stream_results), ('target_score', target_score), ('max_wall_clock', max_wall_clock)]:
+                if value not in (None, False):
+                    raise ValueError('{} requires work_stealing for a BayesSearchCV.'.format(name))
+
+        if target_score is not None and not (stream_results or work_stealing):
+            raise ValueError('target_score requires stream_results or work_stealing.')
+
+        if max_wall_clock is not None and not (stream_results or work_stealing):
+            raise ValueError('max_wall_clock requires stream_results or work_stealing.')
+
         self.search = search
         self.project_id = project_id
         self.cluster_id = cluster_id
         self.bucket_name = bucket_name
         self.image_name = image_name
         self.task_name = task_name
+        self.cost_model = cost_model
+        self.work_stealing = work_stealing
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.stream_results = stream_results
+        self.target_score = target_score
+        self.max_wall_clock = max_wall_clock
+        self.cache_uri = cache_uri
+        self.lean = lean
+        self.compress = compress
         self.gcs_uri = None
 
-        self.cluster = get_cluster(project_id, zone, cluster_id)
-        self.n_nodes = self.cluster['currentNodeCount']
+        self.backend = backend or GKEBackend(project_id, zone, cluster_id)
+        self.n_nodes = self.backend.n_nodes
 
         self.task_name = None
 
@@ -59,13 +145,23 @@ class GKEParallel(object):
         self.n_iter = None
         # For BayesSearchCV
         self.search_spaces = {}
+        # For BayesSearchCV with work stealing
+        self.optimizer = None
+        self.pending_points = {}
+        self.n_asked = 0
 
         self.job_names = {}
         self.output_uris = {}
         self.output_without_estimator_uris = {}
+        self.best_estimator_uris = {}
         self.dones = {}
         self.results = {}
 
+        # Result rows of the candidates fitted so far, keyed by the uri
+        # they were downloaded from.
+        self.partial_rows = {}
+
+        self.cv_results_ = None
         self.best_estimator_ = None
         self.best_params_ = None
         self.best_score_ = None
@@ -73,27 +169,48 @@ class GKEParallel(object):
 
         self._cancelled = False
         self._done = False
+        self._stopped_early = False
+        self._start_time = None
 
 
     def _make_job_name(self, worker_id):
         return '{}.worker.{}'.format(self.task_name, worker_id)
 
 
-    def _make_job_body(self, worker_id, X_uri, y_uri):
+    def _make_task_label(self):
+        """Returns the task name as a valid label value: at most 63
+        alphanumeric characters, '-', '_' or '.', starting and ending with
+        an alphanumeric character.
+        """
+        label = re.sub(r'[^A-Za-z0-9_.-]', '-', self.task_name)
+        if len(label) > 63:
+            # Keep the names of long tasks unique.
+            label = '{}-{}'.format(label[:54], hashlib.sha1(self.task_name.encode('utf-8')).hexdigest()[:8])
+
+        return label.strip('-_.')
+
+
+    def _make_job_body(self, worker_id, X_uri, y_uri, extra_args=()):
+        labels = {self.TASK_LABEL: self._make_task_label()}
+
         body = {
             'apiVersion': 'batch/v1',
             'kind': 'Job',
             'metadata': {
-                'name': self._make_job_name(worker_id)
+                'name': self._make_job_name(worker_id),
+                'labels': labels
             },
             'spec': {
                 'template': {
+                    'metadata': {
+                        'labels': labels
+                    },
                     'spec': {
                         'containers': [
                             {
                                 'image': 'gcr.io/{}/{}'.format(self.project_id, self.image_name),
                                 'command': ['python'],
-                                'args': ['worker.py', self.bucket_name, self.task_name, worker_id, X_uri, y_uri],
+                                'args': ['worker.py', self.bucket_name, self.task_name, worker_id, X_uri, y_uri] + list(extra_args),
                                 'name': 'worker'
                             }
                         ],
@@ -105,27 +222,41 @@ class GKEParallel(object):
         return body
 
 
-    def _deploy_job(self, worker_id, X_uri, y_uri):
-        job_body = self._make_job_body(worker_id, X_uri, y_uri)
+    def _deploy_jobs(self, worker_ids, X_uri, y_uri, extra_args=()):
+        job_bodies = [self._make_job_body(worker_id, X_uri, y_uri, extra_args) for worker_id in worker_ids]
 
-        print('Deploying worker {}'.format(worker_id))
-        create_job(job_body)
+        print('Deploying workers {}'.format(', '.join(worker_ids)))
+        self.backend.create_jobs(job_bodies)
 
 
-    def _partition_grid(self, param_grid_dict, partition_keys):
-        _param_grid_dict = deepcopy(param_grid_dict)
+    def _worker_args(self):
+        args = []
+        if self.stream_results:
+            args.append('--stream')
+        if self.cache_uri is not None:
+            args.extend(['--cache_uri', self.cache_uri])
+        if self.lean:
+            args.append('--lean')
+        if self.compress:
+            args.append('--compress')
 
-        partition_lists = [_param_grid_dict.pop(key) for key in partition_keys]
-        
-        partitioned = []
-        for prod in product(*partition_lists):
-            lists = [[element] for element in prod]
-            singleton = dict(zip(partition_keys, lists))
-            singleton.update(_param_grid_dict)
+        return args
 
-            partitioned.append(singleton)
 
-        return partitioned
+    def _set_output_uris(self, worker_id):
+        prefix = 'gs://{}/{}/{}'.format(self.bucket_name, self.task_name, worker_id)
+
+        if self.lean:
+            # The results table is uploaded last, so it marks the worker as
+            # done.
+            self.output_uris[worker_id] = '{}/cv_results.pkl'.format(prefix)
+            self.output_without_estimator_uris[worker_id] = '{}/cv_results.pkl'.format(prefix)
+            # Workers only upload a best estimator if they refit one.
+            if self.search.refit:
+                self.best_estimator_uris[worker_id] = '{}/best_estimator.pkl{}'.format(prefix, '.gz' if self.compress else '')
+        else:
+            self.output_uris[worker_id] = '{}/fitted_search.pkl'.format(prefix)
+            self.output_without_estimator_uris[worker_id] = '{}/fitted_search_without_estimator.pkl'.format(prefix)
 
 
     def _partition_param_grid(self, param_grid, target_n_partition=5):
@@ -134,35 +265,17 @@ class GKEParallel(object):
 
         If param_grid is a dict:
 
-        The implemented strategy attempts to partition the param_grid
-        into at least target_n_partition smaller param_grids.
-
-        NOTE: The naive strategy implemented here does not distinguish
-        between different types of parameters nor their impact on the
-        running time.  The user of this module is encouraged to
-        implement their own paritioning strategy based on their needs.
+        The cells of the grid are distributed among target_n_partition
+        param_grids such that their estimated costs, according to
+        `self.cost_model`, are balanced.  Without a cost model the grid is
+        split by keys, see `partitioning.py`.
         """
         if type(param_grid) == list:
             # If the input is already a list of param_grids then just
             # use it as is.
             return param_grid
         else:
-            # The strategy is to simply expand the grid fully with
-            # respect to a parameter:
-            # [1, 2, 3]x[4, 5] --> [1]x[4, 5], [2]x[4, 5], [3]x[4, 5]
-            # until the target number of partitions is reached.
-            partition_keys = []
-            n_partition = 1
-            for key, lst in param_grid.items():
-                partition_keys.append(key)
-                n_partition *= len(lst)
-
-                if n_partition >= target_n_partition:
-                    break
-
-            partitioned = self._partition_grid(param_grid, partition_keys)
-
-            return partitioned
+            return partition_param_grid(param_grid, target_n_partition, self.cost_model)
 
 
     def _handle_grid_search(self, X_uri, y_uri):
@@ -173,13 +286,12 @@ class GKEParallel(object):
 
             self.param_grids[worker_id] = param_grid
             self.job_names[worker_id] = self._make_job_name(worker_id)
-            self.output_uris[worker_id] = 'gs://{}/{}/{}/fitted_search.pkl'.format(self.bucket_name, self.task_name, worker_id)
-            self.output_without_estimator_uris[worker_id] = 'gs://{}/{}/{}/fitted_search_without_estimator.pkl'.format(self.bucket_name, self.task_name, worker_id)
+            self._set_output_uris(worker_id)
             self.dones[worker_id] = False
 
-            pickle_and_upload(param_grid, self.bucket_name, '{}/{}/param_grid.pkl'.format(self.task_name, worker_id))
+            self.backend.pickle_and_upload(param_grid, self.bucket_name, '{}/{}/param_grid.pkl'.format(self.task_name, worker_id))
 
-            self._deploy_job(worker_id, X_uri, y_uri)
+        self._deploy_jobs([str(i) for i in range(len(param_grids))], X_uri, y_uri, self._worker_args())
 
 
     def _handle_randomized_search(self, X_uri, y_uri):
@@ -191,14 +303,13 @@ class GKEParallel(object):
             worker_id = str(i)
 
             self.job_names[worker_id] = self._make_job_name(worker_id)
-            self.output_uris[worker_id] = 'gs://{}/{}/{}/fitted_search.pkl'.format(self.bucket_name, self.task_name, worker_id)
-            self.output_without_estimator_uris[worker_id] = 'gs://{}/{}/{}/fitted_search_without_estimator.pkl'.format(self.bucket_name, self.task_name, worker_id)
+            self._set_output_uris(worker_id)
             self.dones[worker_id] = False
 
-            pickle_and_upload(self.param_distributions, self.bucket_name, '{}/{}/param_distributions.pkl'.format(self.task_name, worker_id))
-            pickle_and_upload(n_iter, self.bucket_name, '{}/{}/n_iter.pkl'.format(self.task_name, worker_id))
+            self.backend.pickle_and_upload(self.param_distributions, self.bucket_name, '{}/{}/param_distributions.pkl'.format(self.task_name, worker_id))
+            self.backend.pickle_and_upload(n_iter, self.bucket_name, '{}/{}/n_iter.pkl'.format(self.task_name, worker_id))
 
-            self._deploy_job(worker_id, X_uri, y_uri)
+        self._deploy_jobs([str(i) for i in xrange(self.n_nodes)], X_uri, y_uri, self._worker_args())
 
 
     def _partition_space(self, space):
@@ -310,27 +421,163 @@ class GKEParallel(object):
 
             self.search_spaces[worker_id] = search_spaces
             self.job_names[worker_id] = self._make_job_name(worker_id)
-            self.output_uris[worker_id] = 'gs://{}/{}/{}/fitted_search.pkl'.format(self.bucket_name, self.task_name, worker_id)
-            self.output_without_estimator_uris[worker_id] = 'gs://{}/{}/{}/fitted_search_without_estimator.pkl'.format(self.bucket_name, self.task_name, worker_id)
+            self._set_output_uris(worker_id)
             self.dones[worker_id] = False
 
-            pickle_and_upload(search_spaces, self.bucket_name, '{}/{}/search_spaces.pkl'.format(self.task_name, worker_id))
+            self.backend.pickle_and_upload(search_spaces, self.bucket_name, '{}/{}/search_spaces.pkl'.format(self.task_name, worker_id))
+
+        self._deploy_jobs([str(i) for i in range(len(partitioned_search_spaces))], X_uri, y_uri, self._worker_args())
+
+
+    def _list_candidates(self):
+        if type(self.search) == GridSearchCV:
+            candidates = list(ParameterGrid(self.search.param_grid))
+        else:
+            candidates = list(ParameterSampler(self.search.param_distributions, self.search.n_iter, random_state=self.search.random_state))
+
+        # Fit the expensive candidates first, so that the cheap ones fill
+        # the gaps at the end of the search.
+        if self.cost_model is not None:
+            candidates.sort(key=self.cost_model, reverse=True)
+
+        return candidates
+
+
+    def _task_queue(self):
+        # The same queue the workers lease batches from.
+        return TaskQueue(self.backend.storage(self.bucket_name), '{}/queue'.format(self.task_name), self.lease_timeout)
+
 
-            self._deploy_job(worker_id, X_uri, y_uri)
+    def _handle_queue(self, X_uri, y_uri):
+        candidates = self._list_candidates()
+        batches = [candidates[start:start + self.lease_size] for start in range(0, len(candidates), self.lease_size)]
+
+        queue = self._task_queue()
+        for batch_id in queue.put(batches):
+            self.output_uris[batch_id] = 'gs://{}/{}/queue/done/{}.pkl'.format(self.bucket_name, self.task_name, batch_id)
+            self.dones[batch_id] = False
+
+        # Workers exit once the queue is closed and all batches are done.
+        queue.close()
+
+        worker_ids = [str(i) for i in range(self.n_nodes)]
+        for worker_id in worker_ids:
+            self.job_names[worker_id] = self._make_job_name(worker_id)
+
+        self._deploy_jobs(worker_ids, X_uri, y_uri, ['--queue', '--lease_timeout', str(self.lease_timeout)] + self._worker_args())
+
+
+    def _make_optimizer(self):
+        if type(self.search.search_spaces) != dict:
+            raise TypeError('Work stealing is only supported for a BayesSearchCV with a single search space.')
+
+        kwargs = dict(self.search.optimizer_kwargs or {})
+        kwargs.setdefault('random_state', self.search.random_state)
+
+        return Optimizer(dimensions_aslist(self.search.search_spaces), **kwargs)
+
+
+    def _ask(self, n_points):
+        optimizer = self.optimizer
+
+        # Points still being evaluated are told to a copy of the optimizer
+        # with the best score so far, the same lie `ask` uses within a batch,
+        # so that new points are not drawn next to them.
+        pending = [x for points in self.pending_points.values() for x in points]
+        if pending and optimizer.yi:
+            optimizer = optimizer.copy(random_state=optimizer.rng)
+            optimizer.tell(pending, [min(self.optimizer.yi)] * len(pending))
+
+        return optimizer.ask(n_points=n_points, strategy='cl_min')
+
+
+    def _put_bayes_batches(self):
+        """Asks the optimizer for enough points to give each node a batch,
+        and closes the queue once `n_iter` points have been asked.
+        """
+        batch_size = self.search.n_points
+        n_batches = min(self.n_nodes - len(self.pending_points), int(np.ceil((self.search.n_iter - self.n_asked) / float(batch_size))))
+        if n_batches <= 0:
+            return
+
+        points = self._ask(min(n_batches * batch_size, self.search.n_iter - self.n_asked))
+        batches = [points[start:start + batch_size] for start in range(0, len(points), batch_size)]
+
+        queue = self._task_queue()
+        batch_ids = queue.put([[point_asdict(self.search.search_spaces, x) for x in batch] for batch in batches],
+                              start=len(self.output_uris))
+
+        for batch_id, batch in zip(batch_ids, batches):
+            self.pending_points[batch_id] = batch
+            self.output_uris[batch_id] = 'gs://{}/{}/queue/done/{}.pkl'.format(self.bucket_name, self.task_name, batch_id)
+            self.dones[batch_id] = False
+
+        self.n_asked += len(points)
+        if self.n_asked >= self.search.n_iter:
+            queue.close()
+
+
+    def _tell_bayes_results(self, uris):
+        done_ids = sorted(batch_id for batch_id in self.pending_points if self.output_uris[batch_id] in uris)
+        if not done_ids:
+            return
+
+        self._download_results(dict((batch_id, self.output_uris[batch_id]) for batch_id in done_ids))
+
+        for batch_id in done_ids:
+            rows = self.results[batch_id]
+            key = score_key(rows[0], self.search.refit)
+
+            # The optimizer minimizes, while higher scores are better.
+            self.optimizer.tell(self.pending_points.pop(batch_id), [-row[key] for row in rows])
+
+        self._put_bayes_batches()
+        self.persist()
+
+
+    def _handle_bayes_queue(self, X_uri, y_uri):
+        self.optimizer = self._make_optimizer()
+        self.pending_points = {}
+        self.n_asked = 0
+
+        self._put_bayes_batches()
+
+        worker_ids = [str(i) for i in range(self.n_nodes)]
+        for worker_id in worker_ids:
+            self.job_names[worker_id] = self._make_job_name(worker_id)
+
+        self._deploy_jobs(worker_ids, X_uri, y_uri, ['--queue', '--lease_timeout', str(self.lease_timeout)] + self._worker_args())
+
+
+    def _upload_array(self, array):
+        # Plain NumPy arrays are shipped in the `.npy` format, which workers
+        # can memory-map.  Anything else, e.g. sparse matrices or DataFrames,
+        # is pickled.
+        if type(array) == np.ndarray and not array.dtype.hasobject:
+            return self.backend.save_array_and_upload_deduplicated(array, self.bucket_name, self.DATA_PREFIX)
+        else:
+            return self.backend.pickle_and_upload_deduplicated(array, self.bucket_name, self.DATA_PREFIX)
+
+
+    def _worker_search(self):
+        # The SearchCV object the workers fit.
+        return self.search
 
 
     def _upload_data(self, X, y):
+        # X and y are content addressed: data already uploaded by a previous
+        # task is reused rather than uploaded again.
         if type(X) == str and X.startswith('gs://'):
             X_uri = X
         else:
-            X_uri = pickle_and_upload(X, self.bucket_name, '{}/X.pkl'.format(self.task_name))
+            X_uri = self._upload_array(X)
 
         if type(y) == str and y.startswith('gs://'):
             y_uri = y
         else:
-            y_uri = pickle_and_upload(y, self.bucket_name, '{}/y.pkl'.format(self.task_name))
+            y_uri = self._upload_array(y)
 
-        search_uri = pickle_and_upload(self.search, self.bucket_name, '{}/search.pkl'.format(self.task_name))
+        search_uri = self.backend.pickle_and_upload(self._worker_search(), self.bucket_name, '{}/search.pkl'.format(self.task_name))
 
         return X_uri, y_uri, search_uri
 
@@ -342,10 +589,16 @@ class GKEParallel(object):
         self.task_name = self.task_name or '{}.{}.{}'.format(self.cluster_id, self.image_name, timestamp)
         self._done = False
         self._cancelled = False
+        self._stopped_early = False
+        self._start_time = time.time()
 
         X_uri, y_uri, _ = self._upload_data(X, y)
 
-        if type(self.search) == GridSearchCV:
+        if self.work_stealing and type(self.search) == BayesSearchCV:
+            handler = self._handle_bayes_queue
+        elif self.work_stealing:
+            handler = self._handle_queue
+        elif type(self.search) == GridSearchCV:
             handler = self._handle_grid_search
         elif type(self.search) == RandomizedSearchCV:
             handler = self._handle_randomized_search
@@ -362,19 +615,125 @@ class GKEParallel(object):
         """Pickle and upload self to GCS, allowing recovering of parallel
         search objects across experiments.
         """
-        self.gcs_uri = pickle_and_upload(self, self.bucket_name, '{}/gke_search.pkl'.format(self.task_name))
+        self.gcs_uri = self.backend.pickle_and_upload(self, self.bucket_name, '{}/gke_search.pkl'.format(self.task_name))
         print('Persisted the GKEParallel instance: {}'.format(self.gcs_uri))
 
 
     # Implement part of the concurrent.future.Future interface.
     def done(self):
         if not self._done:
+            # A single listing of the task's objects covers all workers.
+            uris = self.backend.list_blob_uris(self.bucket_name, '{}/'.format(self.task_name))
+
+            # New batches are put before checking the workers, so that the
+            # search is not done while the optimizer has points left to ask.
+            if self.optimizer is not None:
+                self._tell_bayes_results(uris)
+
             for worker_id, output_uri in self.output_uris.items():
-                print('Checking if worker {} is done'.format(worker_id))
-                self.dones[worker_id] = get_uri_blob(output_uri).exists()
+                self.dones[worker_id] = output_uri in uris
 
             self._done = all(self.dones.values())
 
+            # The workers are done writing to the cache.
+            if self._done and self.cache_uri is not None:
+                open_cache(self.cache_uri, self.task_name).compact()
+
+            # Merged on the last poll too, so that the leaderboard holds the
+            # final rows once the search is done.
+            if self.stream_results or self.work_stealing:
+                self._update_leaderboard(uris)
+
+            if not self._done and self._should_stop():
+                self._stop_early()
+
+        return self._done
+
+
+    def _update_leaderboard(self, uris):
+        # Streamed chunks and finished queue batches are immutable, so only
+        # the ones not seen before are downloaded.
+        new_uris = sorted(uri for uri in uris if uri not in self.partial_rows and ('/partial/' in uri or '/queue/done/' in uri))
+        if not new_uris:
+            return
+
+        prefix = 'gs://{}/{}/'.format(self.bucket_name, self.task_name)
+        for uri, rows in zip(new_uris, self.backend.download_uris_and_unpickle(new_uris)):
+            # Rows from `<task>/<worker_id>/partial/...` are tagged with the
+            # worker that fitted them.
+            worker_id = None if '/queue/done/' in uri else uri[len(prefix):].split('/')[0]
+            for row in rows:
+                row['worker_id'] = worker_id
+
+            self.partial_rows[uri] = rows
+
+
+    def leaderboard(self, n=None):
+        """Returns the result rows of the candidates fitted so far, best
+        first, as dicts with the `cv_results_` keys of each candidate and
+        the id of the worker that fitted it.  Needs `stream_results` or
+        `work_stealing`.
+        """
+        if not self._done:
+            self.done()
+
+        return self._ranked_rows()[:n]
+
+
+    def _ranked_rows(self):
+        rows = [row for uri in sorted(self.partial_rows) for row in self.partial_rows[uri]]
+        if not rows:
+            return []
+
+        key = score_key(rows[0], self.search.refit)
+        rows.sort(key=lambda row: row[key], reverse=True)
+
+        return rows
+
+
+    def _should_stop(self):
+        if self.max_wall_clock is not None and time.time() - self._start_time > self.max_wall_clock:
+            print('Reached the maximum wall clock time of {} seconds.'.format(self.max_wall_clock))
+            return True
+
+        if self.target_score is not None:
+            rows = self._ranked_rows()
+            if rows:
+                score = rows[0][score_key(rows[0], self.search.refit)]
+                if score >= self.target_score:
+                    print('Reached the target score {}: {}'.format(self.target_score, score))
+                    return True
+
+        return False
+
+
+    def _stop_early(self):
+        self.cancel()
+        self._stopped_early = True
+        self._done = True
+
+
+    def stopped_early(self):
+        return self._stopped_early
+
+
+    def wait(self, timeout=None, poll_interval=1, max_poll_interval=60):
+        """Blocks until all workers are done or `timeout` seconds have
+        passed, and returns `done()`.  The interval between polls starts at
+        `poll_interval` seconds and doubles up to `max_poll_interval`.
+        """
+        start = time.time()
+        while not self.done():
+            elapsed = time.time() - start
+            if timeout is not None and elapsed >= timeout:
+                break
+
+            if timeout is not None:
+                poll_interval = min(poll_interval, timeout - elapsed)
+
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+
         return self._done
 
 
@@ -382,7 +741,7 @@ class GKEParallel(object):
         """Deletes the kubernetes jobs.
         Persisted data and the cluster will not be deleted."""
         if not self._cancelled:
-            delete_jobs_pods(self.job_names.values())
+            self.backend.delete_jobs('{}={}'.format(self.TASK_LABEL, self._make_task_label()))
             self._cancelled = True
 
 
@@ -390,16 +749,50 @@ class GKEParallel(object):
         return self._cancelled
 
 
+    def _download_results(self, uris):
+        ids = sorted(uris)
+        print('Getting results from {} workers'.format(len(ids)))
+        self.results.update(zip(ids, self.backend.download_uris_and_unpickle([uris[i] for i in ids])))
+
+
     def result(self, download=False):
+        """Returns the results of the workers once they are all done, and
+        None before.  These are the fitted search objects of the workers,
+        or their `cv_results_` tables in lean mode, keyed by worker id, or
+        the result rows of each batch in work stealing mode.
+
+        After the search stopped early there are no such results, and the
+        merged `cv_results_` of the candidates fitted so far is returned
+        instead, None if no candidate was fitted.
+        """
         if not self.done():
-            n_done = len(d for d in self.dones.values() if d)
+            n_done = len([d for d in self.dones.values() if d])
             print('Not done: {} out of {} workers completed.'.format(n_done, len(self.dones)))
             return None
 
+        if self._stopped_early:
+            if self.cv_results_ is None and self.partial_rows:
+                rows = [row for uri in sorted(self.partial_rows) for row in self.partial_rows[uri]]
+                self._aggregate_rows([dict((k, v) for k, v in row.items() if k != 'worker_id') for row in rows])
+
+                self.persist()
+
+            return self.cv_results_
+
+        if self.work_stealing:
+            if self.cv_results_ is None:
+                # In the Bayes coordinator mode, results were already
+                # downloaded as they came in.
+                self._download_results(dict((batch_id, uri) for batch_id, uri in self.output_uris.items() if batch_id not in self.results))
+
+                self._aggregate_rows([row for batch_id in sorted(self.results) for row in self.results[batch_id]])
+
+                self.persist()
+
+            return self.results
+
         if not self.results or download:
-            for worker_id, output_uri in self.output_without_estimator_uris.items():
-                print('Getting result from worker {}'.format(worker_id))
-                self.results[worker_id] = download_uri_and_unpickle(output_uri)
+            self._download_results(self.output_without_estimator_uris)
 
             self._aggregate_results(download)
 
@@ -408,22 +801,61 @@ class GKEParallel(object):
         return self.results
 
 
-    def _aggregate_results(self, download):
-        best_id = None
-        for worker_id, result in self.results.items():
-            if self.best_score_ is None or result.best_score_ > self.best_score_ or download:
-
-                self.best_score_ = result.best_score_
-                self.best_params_ = result.best_params_
+    def _result_cv_results(self, worker_id):
+        # In lean mode the results are the workers' `cv_results_` tables,
+        # otherwise their fitted search objects.
+        result = self.results[worker_id]
+        return result if self.lean else result.cv_results_
 
-                best_id = worker_id
 
-        if download and self.best_estimator_ is None:
+    def _aggregate_results(self, download):
+        # Merge the results of all workers, including rows they took from
+        # the evaluation cache, and remember which worker fitted each row.
+        rows = []
+        worker_ids = []
+        for worker_id in sorted(self.results):
+            worker_rows = cv_results_to_rows(self._result_cv_results(worker_id))
+            rows.extend(worker_rows)
+            worker_ids.extend([worker_id] * len(worker_rows))
+
+        self.cv_results_ = rows_to_cv_results(rows)
+
+        index = best_index(self.cv_results_, self.search.refit)
+        self.best_params_ = self.cv_results_['params'][index]
+        self.best_score_ = self.cv_results_[score_key(self.cv_results_, self.search.refit)][index]
+        best_id = worker_ids[index]
+
+        if download and self.best_estimator_ is None and not self.search.refit:
+            print('The workers did not refit a best estimator since refit=False, use `refit` to fit one locally.')
+
+        elif download and self.best_estimator_ is None:
             # Download only the best estimator among the workers.
             print('Downloading the best estimator (worker {}).'.format(best_id))
-            output_uri = self.output_uris[best_id]
-            self.best_search_ = download_uri_and_unpickle(output_uri)
-            self.best_estimator_ = self.best_search_.best_estimator_
+            if self.lean:
+                self.best_estimator_ = self.backend.download_uri_and_unpickle(self.best_estimator_uris[best_id])
+            else:
+                output_uri = self.output_uris[best_id]
+                self.best_search_ = self.backend.download_uri_and_unpickle(output_uri)
+                self.best_estimator_ = self.best_search_.best_estimator_
+
+
+    def _aggregate_rows(self, rows):
+        self.cv_results_ = rows_to_cv_results(rows)
+
+        index = best_index(self.cv_results_, self.search.refit)
+        self.best_params_ = self.cv_results_['params'][index]
+        self.best_score_ = self.cv_results_[score_key(self.cv_results_, self.search.refit)][index]
+
+
+    def refit(self, X, y):
+        """Fits the search's estimator with the best parameters found on the
+        full data locally.  Workers do not refit in work stealing mode, so
+        this is needed before `predict` can be used.
+        """
+        self.best_estimator_ = clone(self.search.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(X, y)
+
+        return self
 
 
     # Implement part of SearchCV interface by delegation.
@@ -0,0 +1,208 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Successive halving on a GKE cluster.
+
+All candidates of a GridSearchCV or RandomizedSearchCV are first fitted with
+a small budget, either a random subsample of the data or a low value of an
+estimator parameter such as `n_estimators`.  Only the best `1 / factor` of
+them are promoted to the next round, whose budget is `factor` times larger,
+until the remaining candidates are fitted with the full budget.  Each round
+is a set of Kubernetes jobs, deployed by `done` once the previous round has
+finished.
+"""
+
+import math
+
+import numpy as np
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, ParameterGrid, ParameterSampler
+from sklearn.utils.validation import _num_samples
+
+from gke_parallel import GKEParallel
+from partitioning import partition_param_grid
+from source.results import cv_results_to_rows, rows_to_cv_results, score_key
+
+
+class GKESuccessiveHalving(GKEParallel):
+    SUPPORTED_SEARCH = [
+        GridSearchCV,
+        RandomizedSearchCV
+    ]
+
+    def __init__(self, search, project_id, zone, cluster_id, bucket_name, image_name, min_resource, max_resource=None,
+                 resource='n_samples', factor=3, task_name=None, cost_model=None, cache_uri=None,
+                 lean=False, compress=False, backend=None):
+        """Wraps around a GridSearchCV or RandomizedSearchCV and fits its
+        candidates by successive halving.
+
+        `resource` is either 'n_samples', to budget the number of training
+        rows, or the name of an integer parameter of the estimator, e.g.
+        'n_estimators', which must then not be part of the search.  The
+        budget grows from `min_resource` to `max_resource` by `factor` in
+        each round.  With 'n_samples', `max_resource` defaults to the size
+        of the training data.
+
+        The best estimator is refitted on the full budget in the last round
+        only.  The `cv_results_` of every round are kept in `rounds_`.
+        """
+        super(GKESuccessiveHalving, self).__init__(search, project_id, zone, cluster_id, bucket_name, image_name,
+                                                   task_name=task_name, cost_model=cost_model, cache_uri=cache_uri,
+                                                   lean=lean, compress=compress, backend=backend)
+
+        if resource != 'n_samples' and max_resource is None:
+            raise ValueError('max_resource is required when the resource is {}.'.format(resource))
+
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.resource = resource
+        self.factor = factor
+
+        self.resources_ = None
+        self.rounds_ = []
+        self._round = None
+        self._X_uri = None
+        self._y_uri = None
+
+
+    def _budgets(self):
+        resources = []
+        resource = self.min_resource
+        while resource < self.max_resource:
+            resources.append(int(resource))
+            resource *= self.factor
+        resources.append(self.max_resource)
+
+        return resources
+
+
+    def _worker_search(self):
+        # Workers are given explicit lists of candidates, which only a
+        # GridSearchCV accepts.
+        search = self.search
+        return GridSearchCV(
+            search.estimator, [{}], scoring=search.scoring, n_jobs=search.n_jobs, iid=search.iid,
+            refit=search.refit, cv=search.cv, verbose=search.verbose, pre_dispatch=search.pre_dispatch,
+            error_score=search.error_score, return_train_score=search.return_train_score)
+
+
+    def _start_round(self, round_index, candidates):
+        resource = self.resources_[round_index]
+        last = round_index == len(self.resources_) - 1
+
+        grids = []
+        for params in candidates:
+            grid = dict((key, [value]) for key, value in params.items())
+            if self.resource != 'n_samples':
+                grid[self.resource] = [resource]
+            grids.append(grid)
+
+        extra_args = self._worker_args()
+        if not last:
+            extra_args.append('--no_refit')
+            if self.resource == 'n_samples':
+                extra_args.extend(['--n_samples', str(resource)])
+
+        print('Round {}: fitting {} candidates with {}={}'.format(round_index, len(candidates), self.resource, resource))
+
+        self._round = round_index
+        self.output_uris = {}
+        self.output_without_estimator_uris = {}
+        self.dones = {}
+        self.results = {}
+
+        worker_ids = []
+        for i, param_grid in enumerate(partition_param_grid(grids, self.n_nodes, self.cost_model)):
+            worker_id = '{}-{}'.format(round_index, i)
+            worker_ids.append(worker_id)
+
+            self.param_grids[worker_id] = param_grid
+            self.job_names[worker_id] = self._make_job_name(worker_id)
+            self._set_output_uris(worker_id)
+            self.dones[worker_id] = False
+
+            self.backend.pickle_and_upload(param_grid, self.bucket_name, '{}/{}/param_grid.pkl'.format(self.task_name, worker_id))
+
+        self._deploy_jobs(worker_ids, self._X_uri, self._y_uri, extra_args)
+
+
+    def _handle_rounds(self, X_uri, y_uri):
+        self._X_uri = X_uri
+        self._y_uri = y_uri
+
+        if type(self.search) == GridSearchCV:
+            candidates = list(ParameterGrid(self.search.param_grid))
+        else:
+            candidates = list(ParameterSampler(self.search.param_distributions, self.search.n_iter, random_state=self.search.random_state))
+
+        self._start_round(0, candidates)
+
+    _handle_grid_search = _handle_rounds
+    _handle_randomized_search = _handle_rounds
+
+
+    def _promote(self):
+        """Ranks the candidates of the finished round and starts the next
+        round with the best of them.
+        """
+        self._download_results(self.output_without_estimator_uris)
+
+        rows = [row for worker_id in sorted(self.results) for row in cv_results_to_rows(self._result_cv_results(worker_id))]
+        cv_results = rows_to_cv_results(rows)
+        self.rounds_.append({'resource': self.resources_[self._round], 'cv_results': cv_results})
+
+        n_promoted = int(math.ceil(len(rows) / float(self.factor)))
+        order = np.argsort(-cv_results[score_key(cv_results, self.search.refit)], kind='mergesort')[:n_promoted]
+
+        candidates = []
+        for index in order:
+            params = dict(cv_results['params'][index])
+            params.pop(self.resource, None)
+            candidates.append(params)
+
+        self._start_round(self._round + 1, candidates)
+        self._done = False
+
+        self.persist()
+
+
+    def fit(self, X, y):
+        if self.max_resource is None:
+            if type(X) == str:
+                raise ValueError('max_resource is required when X is a GCS uri.')
+            self.max_resource = _num_samples(X)
+
+        self.resources_ = self._budgets()
+        self.rounds_ = []
+
+        super(GKESuccessiveHalving, self).fit(X, y)
+
+
+    def done(self):
+        # The rounds are advanced by polling: once every worker of a round
+        # is done, the next round is deployed.
+        if super(GKESuccessiveHalving, self).done() and not self._stopped_early and self._round + 1 < len(self.resources_):
+            self._promote()
+
+        return self._done
+
+
+    def result(self, download=False):
+        results = super(GKESuccessiveHalving, self).result(download)
+
+        if results is not None and len(self.rounds_) < len(self.resources_):
+            rows = [row for worker_id in sorted(self.results) for row in cv_results_to_rows(self._result_cv_results(worker_id))]
+            self.rounds_.append({'resource': self.resources_[self._round], 'cv_results': rows_to_cv_results(rows)})
+            self.cv_results_ = self.rounds_[-1]['cv_results']
+
+        return results
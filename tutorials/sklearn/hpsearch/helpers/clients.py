@@ -0,0 +1,78 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""API clients shared by all the helpers.
+
+Each client is created on first use and then reused, so that credentials,
+the kubeconfig and discovery documents are loaded once per process, and
+connections are pooled across calls.
+
+`get_storage_client`: A Google Cloud Storage client.
+
+`get_batch_api`, `get_core_api`: Kubernetes API clients, sharing a single
+`ApiClient` and connection pool.
+
+`get_service`: A Google API discovery client, e.g. for 'container' or
+'cloudbuild'.  Discovery clients are not thread safe, and should only be used
+from the thread that drives the search.
+"""
+
+import threading
+
+from google.cloud import storage
+from googleapiclient import discovery
+from kubernetes import client, config
+from oauth2client.client import GoogleCredentials
+
+# Reentrant, since creating a Kubernetes API client creates the shared
+# `ApiClient` first.
+_lock = threading.RLock()
+_clients = {}
+
+
+def _get_or_create(key, create):
+    with _lock:
+        if key not in _clients:
+            _clients[key] = create()
+
+    return _clients[key]
+
+
+def get_credentials():
+    return _get_or_create('credentials', GoogleCredentials.get_application_default)
+
+
+def get_storage_client():
+    return _get_or_create('storage', storage.Client)
+
+
+def _get_kubernetes_api_client():
+    def create():
+        config.load_kube_config()
+        return client.ApiClient()
+
+    return _get_or_create('kubernetes', create)
+
+
+def get_batch_api():
+    return _get_or_create('batch_v1', lambda: client.BatchV1Api(_get_kubernetes_api_client()))
+
+
+def get_core_api():
+    return _get_or_create('core_v1', lambda: client.CoreV1Api(_get_kubernetes_api_client()))
+
+
+def get_service(name, version='v1'):
+    credentials = get_credentials()
+    return _get_or_create(('service', name, version), lambda: discovery.build(name, version, credentials=credentials))
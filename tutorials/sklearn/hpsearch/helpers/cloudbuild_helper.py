@@ -22,13 +22,9 @@ https://cloud.google.com/container-builder/
 https://cloud.google.com/container-registry/
 """
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
-
+from clients import get_service
 from gcs_helper import archive_and_upload
 
-credentials = GoogleCredentials.get_application_default()
-
 
 def _make_body(source_bucket_name, source_object_name, image_name):
     body = {
@@ -62,7 +58,7 @@ def build(project_id, source_dir, bucket_name, image_name):
 
     body = _make_body(bucket_name, '{}.zip'.format(source_dir), image_name)
 
-    service = discovery.build('cloudbuild', 'v1', credentials=credentials)
+    service = get_service('cloudbuild')
     build = service.projects().builds().create(projectId=project_id, body=body).execute()
 
     return build
@@ -19,16 +19,41 @@ user-specified `bucket_name` and `object_name`.
 
 `download_and_unpickle`: The opposite of `pickle_and_upload`.
 
+`pickle_and_upload_deduplicated`: Like `pickle_and_upload`, but the object
+name is derived from the sha256 of the pickled content, so identical objects
+are only uploaded once.  Large objects are uploaded in parallel chunks.
+
+`save_array_and_upload_deduplicated`: Same as above for NumPy arrays, which
+are saved in the `.npy` format so that workers can memory-map them instead of
+unpickling a copy.
+
 For more information:
 https://cloud.google.com/storage/
 """
 
+import io
 import os
 import re
+import gzip
 import shutil
 import pickle
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from clients import get_storage_client
 
-from google.cloud import storage
+
+# Objects larger than this are uploaded as several chunks in parallel, and
+# then composed into a single object.
+CHUNK_SIZE = 32 * 1024 * 1024
+N_UPLOAD_THREADS = 8
+N_DOWNLOAD_THREADS = 8
+
+# GCS allows at most 32 source objects in a single compose request.
+_MAX_COMPOSE_SOURCES = 32
 
 
 def _make_gcs_uri(bucket_name, object_name):
@@ -46,9 +71,14 @@ def _split_uri(gcs_uri):
     return bucket_name, object_name
 
 
+def _get_bucket(bucket_name):
+    # Unlike `get_bucket`, this does not make a request to fetch the
+    # bucket's metadata, which none of the helpers need.
+    return get_storage_client().bucket(bucket_name)
+
+
 def get_blob(bucket_name, object_name):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = _get_bucket(bucket_name)
     blob = bucket.blob(object_name)
     return blob
 
@@ -58,17 +88,23 @@ def get_uri_blob(gcs_uri):
     return get_blob(bucket_name, object_name)
 
 
+def list_blob_uris(bucket_name, prefix):
+    """Returns the set of GCS uris of the objects under prefix, using a
+    single listing rather than a request per object.
+    """
+    bucket = _get_bucket(bucket_name)
+    return set(_make_gcs_uri(bucket_name, blob.name) for blob in bucket.list_blobs(prefix=prefix))
+
+
 def archive_and_upload(bucket_name, directory, extension='zip', object_name=None):
     """Archives a directory and upload to GCS.
     Returns the object's GCS uri.
     """
-    storage_client = storage.Client()
     object_name = object_name or '{}.{}'.format(directory, extension)
 
     temp_filename = shutil.make_archive('_tmp', extension, directory)
 
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(object_name)
+    blob = get_blob(bucket_name, object_name)
     blob.upload_from_filename(temp_filename)
 
     os.remove(temp_filename)
@@ -81,9 +117,7 @@ def pickle_and_upload(obj, bucket_name, object_name):
     print('pickling data')
     pickle_str = pickle.dumps(obj)
 
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(object_name)
+    blob = get_blob(bucket_name, object_name)
     print('uploading object {} to bucket {}'.format(object_name, bucket_name))
     blob.upload_from_string(pickle_str)
 
@@ -94,6 +128,9 @@ def download_and_unpickle(bucket_name, object_name):
     blob = get_blob(bucket_name, object_name)
     pickle_str = blob.download_as_string()
 
+    if object_name.endswith('.gz'):
+        pickle_str = gzip.GzipFile(fileobj=io.BytesIO(pickle_str)).read()
+
     obj = pickle.loads(pickle_str)
     return obj
 
@@ -105,3 +142,148 @@ def download_uri_and_unpickle(gcs_uri):
     return obj
 
 
+def download_uris_and_unpickle(gcs_uris, n_threads=N_DOWNLOAD_THREADS):
+    """Downloads and unpickles several objects concurrently.  Returns the
+    objects in the same order as `gcs_uris`.
+    """
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(download_uri_and_unpickle, gcs_uris)
+    finally:
+        pool.close()
+
+
+def _hash_file(filename, block_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _upload_chunk(args):
+    filename, offset, size, bucket_name, chunk_name = args
+
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+
+    get_blob(bucket_name, chunk_name).upload_from_string(data)
+
+
+def _compose(bucket, sources, object_name):
+    """Composes `sources` into `object_name`, going through intermediate
+    objects if there are more sources than a single request allows.
+    Returns the list of intermediate blobs, which the caller should delete.
+    """
+    intermediates = []
+    level = 0
+    while len(sources) > _MAX_COMPOSE_SOURCES:
+        grouped = []
+        for i in range(0, len(sources), _MAX_COMPOSE_SOURCES):
+            blob = bucket.blob('{}.compose/{}.{:05d}'.format(object_name, level, i))
+            blob.content_type = 'application/octet-stream'
+            blob.compose(sources[i:i + _MAX_COMPOSE_SOURCES])
+            grouped.append(blob)
+
+        intermediates.extend(grouped)
+        sources = grouped
+        level += 1
+
+    blob = bucket.blob(object_name)
+    blob.content_type = 'application/octet-stream'
+    blob.compose(sources)
+
+    return intermediates
+
+
+def upload_file_chunked(filename, bucket_name, object_name, chunk_size=CHUNK_SIZE, n_threads=N_UPLOAD_THREADS):
+    """Uploads a local file as chunks in parallel, then composes the chunks
+    into a single object.
+
+    Chunks that already exist in the bucket, e.g. from an upload that was
+    interrupted, are not uploaded again.
+
+    Returns the object's GCS uri.
+    """
+    file_size = os.path.getsize(filename)
+    if file_size <= chunk_size:
+        get_blob(bucket_name, object_name).upload_from_filename(filename)
+        return _make_gcs_uri(bucket_name, object_name)
+
+    bucket = _get_bucket(bucket_name)
+
+    chunk_prefix = '{}.chunks/'.format(object_name)
+    uploaded = set(blob.name for blob in bucket.list_blobs(prefix=chunk_prefix))
+
+    chunk_names = []
+    pending = []
+    for i, offset in enumerate(range(0, file_size, chunk_size)):
+        chunk_name = '{}{:05d}'.format(chunk_prefix, i)
+        chunk_names.append(chunk_name)
+
+        if chunk_name not in uploaded:
+            size = min(chunk_size, file_size - offset)
+            pending.append((filename, offset, size, bucket_name, chunk_name))
+
+    print('uploading {} of {} chunks of object {} to bucket {}'.format(len(pending), len(chunk_names), object_name, bucket_name))
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(_upload_chunk, pending)
+    finally:
+        pool.close()
+
+    chunks = [bucket.blob(chunk_name) for chunk_name in chunk_names]
+    intermediates = _compose(bucket, chunks, object_name)
+
+    for blob in chunks + intermediates:
+        blob.delete()
+
+    return _make_gcs_uri(bucket_name, object_name)
+
+
+def _upload_file_deduplicated(filename, bucket_name, prefix, extension):
+    object_name = '{}/{}.{}'.format(prefix, _hash_file(filename), extension)
+
+    if get_blob(bucket_name, object_name).exists():
+        print('object {} already exists in bucket {}, skipping upload'.format(object_name, bucket_name))
+    else:
+        upload_file_chunked(filename, bucket_name, object_name)
+
+    return _make_gcs_uri(bucket_name, object_name)
+
+
+def pickle_and_upload_deduplicated(obj, bucket_name, prefix):
+    """Pickles `obj` and uploads it to `prefix/<sha256>.pkl`, unless an
+    object with the same content has already been uploaded.
+
+    Returns the object's GCS uri.
+    """
+    print('pickling data')
+    fd, temp_filename = tempfile.mkstemp(suffix='.pkl')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return _upload_file_deduplicated(temp_filename, bucket_name, prefix, 'pkl')
+    finally:
+        os.remove(temp_filename)
+
+
+def save_array_and_upload_deduplicated(array, bucket_name, prefix):
+    """Saves a NumPy array in the `.npy` format and uploads it to
+    `prefix/<sha256>.npy`, unless an object with the same content has already
+    been uploaded.
+
+    Returns the object's GCS uri.
+    """
+    print('saving array')
+    fd, temp_filename = tempfile.mkstemp(suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+
+        return _upload_file_deduplicated(temp_filename, bucket_name, prefix, 'npy')
+    finally:
+        os.remove(temp_filename)
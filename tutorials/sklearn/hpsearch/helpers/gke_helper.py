@@ -21,17 +21,14 @@ For more information:
 https://cloud.google.com/kubernetes-engine/
 """
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
-
-credentials = GoogleCredentials.get_application_default()
+from clients import get_service
 
 
 def create_cluster(project_id, zone, cluster_id, n_nodes=1, machine_type='n1-highcpu-4'):
     """Documentation:
     https://cloud.google.com/sdk/gcloud/reference/container/clusters/create
     """
-    service = discovery.build('container', 'v1', credentials=credentials)
+    service = get_service('container')
     cluster = {
         'master_auth': {
             'username': 'admin'
@@ -67,14 +64,14 @@ def create_cluster(project_id, zone, cluster_id, n_nodes=1, machine_type='n1-hig
 
 
 def get_cluster(project_id, zone, cluster_id):
-    service = discovery.build('container', 'v1', credentials=credentials)
+    service = get_service('container')
     cluster = service.projects().zones().clusters().get(zone=zone, projectId=project_id, clusterId=cluster_id).execute()
 
     return cluster
 
 
 def delete_cluster(project_id, zone, cluster_id):
-    service = discovery.build('container', 'v1', credentials=credentials)
+    service = get_service('container')
     delete = service.projects().zones().clusters().delete(zone=zone, projectId=project_id, clusterId=cluster_id).execute()
 
     return delete
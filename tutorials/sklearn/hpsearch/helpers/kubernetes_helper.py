@@ -20,31 +20,54 @@ https://github.com/kubernetes-client/python
 `create_job`: Creates a Kubernetes job and deploy it to a cluster.  For a
 sample of `job_body`, see `../gke_parallel.py`'s `_make_job_body` method.
 
+`create_jobs`: Creates several Kubernetes jobs concurrently.
+
+`delete_jobs_pods`: Deletes jobs and their pods, either all those matching a
+label selector, with one request each for jobs and pods, or by job name.
+
 For more information:
 https://kubernetes.io/
 https://kubernetes.io/docs/concepts/workloads/controllers/jobs-run-to-completion/
 """
 
+from multiprocessing.pool import ThreadPool
+
 import yaml
-from kubernetes import client, config
+from kubernetes import client
+
+from clients import get_batch_api, get_core_api
+
+
+# The Kubernetes client keeps a pool of 4 connections, more concurrent
+# requests would open and discard extra connections.
+N_SUBMIT_THREADS = 4
 
 
 def get_nodes():
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_api()
     nodes = v1.list_node()
     
     return nodes
 
 
 def create_job(job_body, namespace='default'):
-    config.load_kube_config()
-    v1 = client.BatchV1Api()
+    v1 = get_batch_api()
 
     job = v1.create_namespaced_job(body=job_body, namespace=namespace)
     return job
 
 
+def create_jobs(job_bodies, namespace='default', n_threads=N_SUBMIT_THREADS):
+    """Creates the jobs with at most n_threads requests in flight, and
+    returns them in the same order.
+    """
+    pool = ThreadPool(max(min(n_threads, len(job_bodies)), 1))
+    try:
+        return pool.map(lambda job_body: create_job(job_body, namespace), job_bodies)
+    finally:
+        pool.close()
+
+
 def create_job_from_file(job_filename, namespace='default'):
     with open(job_filename, 'r') as f:
         job_body = yaml.load(f)
@@ -54,8 +77,7 @@ def create_job_from_file(job_filename, namespace='default'):
 
 
 def get_pod_logs(namespace='default'):
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_api()
 
     pod_list = v1.list_namespaced_pod(namespace=namespace)
 
@@ -70,8 +92,7 @@ def get_pod_logs(namespace='default'):
 
 
 def delete_job(job_name, namespace='default'):
-    config.load_kube_config()
-    batch_v1 = client.BatchV1Api()
+    batch_v1 = get_batch_api()
 
     print('deleting job {} with namespace {}'.format(job_name, namespace))
     delete = batch_v1.delete_namespaced_job(name=job_name, body=client.V1DeleteOptions(), namespace=namespace)
@@ -79,24 +100,38 @@ def delete_job(job_name, namespace='default'):
 
 
 def delete_pod(pod_name, namespace='default'):
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_api()
 
     print('deleting pod {} with namespace {}'.format(pod_name, namespace))
     delete = v1.delete_namespaced_pod(name=pod_name, body=client.V1DeleteOptions(), namespace=namespace)
     return delete
 
 
-def delete_jobs_pods(job_names, namespace='default'):
+def delete_jobs_pods(job_names=(), namespace='default', label_selector=None):
+    """Deletes the jobs and their pods.
+
+    With `label_selector`, e.g. 'hpsearch-task=my-task', all jobs and pods
+    matching it are deleted with two requests, regardless of `job_names`.
+    The pinned client does not support a propagation policy for collection
+    deletes, so pods are deleted explicitly rather than by garbage
+    collection of their jobs.
+    """
+    if label_selector is not None:
+        print('deleting jobs and pods matching {} with namespace {}'.format(label_selector, namespace))
+        get_batch_api().delete_collection_namespaced_job(namespace, label_selector=label_selector)
+        get_core_api().delete_collection_namespaced_pod(namespace, label_selector=label_selector)
+        return
+
+    job_names = set(job_names)
     for job_name in job_names:
         delete_job(job_name, namespace)
 
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_api()
 
     pod_list = v1.list_namespaced_pod(namespace=namespace)
 
     for pod in pod_list.items:
-        if pod.metadata.labels['job-name'] in job_names:
+        # Pods not created by a job have no `job-name` label.
+        if (pod.metadata.labels or {}).get('job-name') in job_names:
             delete_pod(pod.metadata.name, namespace)
 
@@ -0,0 +1,204 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Strategies for splitting a GridSearchCV param_grid across workers.
+
+`split_param_grid_by_keys`: Expands the grid fully with respect to its first
+keys until enough partitions are obtained.  This ignores how expensive each
+cell of the grid is to fit.
+
+`partition_param_grid`: Enumerates every cell of the grid and assigns them to
+partitions so that the estimated cost of each partition is balanced, using
+the longest-processing-time-first rule.  Without a cost model, a dict grid is
+split by keys instead, since no estimate beats that split reliably (see
+`benchmark_partition.py`).
+
+`HeuristicCostModel` and `TimingCostModel`: Cost models that can be passed to
+`partition_param_grid`.  Any callable that maps a dict of parameters to a
+positive number can be used as a cost model.
+"""
+
+import heapq
+import numbers
+from copy import deepcopy
+from itertools import product
+
+import numpy as np
+from sklearn.model_selection import ParameterGrid
+
+
+def _is_integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+class HeuristicCostModel(object):
+    """Estimates the cost of fitting a set of parameters as the product of
+    its integer-valued parameters, e.g. `n_estimators * max_depth`.
+
+    Integer-valued parameters of typical estimators (number of trees,
+    depth, iterations, neighbors) tend to scale the fitting time roughly
+    linearly.  Other parameters are ignored.  A value of `None` for a
+    parameter that otherwise takes integers (e.g. `max_depth=None`) is
+    treated as the largest integer seen for that parameter.
+    """
+    def __init__(self, param_grid=None):
+        self._none_values = {}
+
+        if param_grid is not None:
+            grids = param_grid if type(param_grid) == list else [param_grid]
+            for grid in grids:
+                for key, values in grid.items():
+                    integers = [v for v in values if _is_integer(v)]
+                    if integers:
+                        self._none_values[key] = max(max(integers), self._none_values.get(key, 0))
+
+    def __call__(self, params):
+        cost = 1.0
+        for key, value in params.items():
+            if value is None:
+                value = self._none_values.get(key)
+
+            if _is_integer(value):
+                cost *= max(value, 1)
+
+        return cost
+
+
+class TimingCostModel(object):
+    """Learns the cost of fitting a set of parameters from the `cv_results_`
+    of earlier searches.
+
+    The model is a least squares fit of `log(mean_fit_time)` on the log of
+    the numeric parameters and on indicators of the other parameter values.
+    Until `fit` has been called the `fallback` model, by default a
+    `HeuristicCostModel`, is used.
+    """
+    def __init__(self, fallback=None):
+        self.fallback = fallback or HeuristicCostModel()
+
+        self._params = []
+        self._fit_times = []
+        self._features = None
+        self._coef = None
+
+    def _featurize(self, params):
+        row = np.zeros(len(self._features) + 1)
+        row[-1] = 1.0
+
+        for key, value in params.items():
+            if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                feature = (key, '')
+                value = np.log(max(value, 1e-12))
+            else:
+                feature = (key, repr(value))
+                value = 1.0
+
+            index = self._features.get(feature)
+            if index is not None:
+                row[index] = value
+
+        return row
+
+    def fit(self, cv_results):
+        """Adds the timings in `cv_results`, a `cv_results_` dict of a fitted
+        SearchCV object, to the training data of the model and refits it.
+        Can be called repeatedly with the results of several searches.
+        """
+        self._params.extend(cv_results['params'])
+        self._fit_times.extend(cv_results['mean_fit_time'])
+
+        features = set()
+        for params in self._params:
+            for key, value in params.items():
+                if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                    features.add((key, ''))
+                else:
+                    features.add((key, repr(value)))
+
+        self._features = dict((feature, i) for i, feature in enumerate(sorted(features)))
+
+        A = np.array([self._featurize(params) for params in self._params])
+        b = np.log(np.maximum(self._fit_times, 1e-6))
+        self._coef = np.linalg.lstsq(A, b, rcond=-1)[0]
+
+        return self
+
+    def __call__(self, params):
+        if self._coef is None:
+            return self.fallback(params)
+
+        return float(np.exp(self._featurize(params).dot(self._coef)))
+
+
+def split_param_grid_by_keys(param_grid, target_n_partition=5):
+    """Returns a list of param_grids whose union is the input param_grid.
+
+    The strategy is to simply expand the grid fully with respect to a
+    parameter:
+    [1, 2, 3]x[4, 5] --> [1]x[4, 5], [2]x[4, 5], [3]x[4, 5]
+    until the target number of partitions is reached.
+    """
+    partition_keys = []
+    n_partition = 1
+    for key, lst in param_grid.items():
+        partition_keys.append(key)
+        n_partition *= len(lst)
+
+        if n_partition >= target_n_partition:
+            break
+
+    _param_grid = deepcopy(param_grid)
+    partition_lists = [_param_grid.pop(key) for key in partition_keys]
+
+    partitioned = []
+    for prod in product(*partition_lists):
+        lists = [[element] for element in prod]
+        singleton = dict(zip(partition_keys, lists))
+        singleton.update(_param_grid)
+
+        partitioned.append(singleton)
+
+    return partitioned
+
+
+def partition_param_grid(param_grid, n_partition=5, cost_model=None):
+    """Returns a list of at most n_partition param_grids whose union is the
+    input param_grid, balanced with respect to `cost_model`.
+
+    Each returned param_grid is a list of single-cell grids, which
+    GridSearchCV accepts as is.  The cells are assigned greedily, most
+    expensive first, to the partition with the smallest total cost so far.
+
+    If `cost_model` is None, a dict param_grid is split with
+    `split_param_grid_by_keys`, and the cells of a list of param_grids are
+    counted as equally expensive.
+    """
+    if cost_model is None:
+        if type(param_grid) == dict:
+            return split_param_grid_by_keys(param_grid, n_partition)
+
+        cost_model = lambda params: 1.0
+
+    cells = list(ParameterGrid(param_grid))
+    costs = [cost_model(params) for params in cells]
+
+    partitions = [[] for _ in range(n_partition)]
+    heap = [(0.0, i) for i in range(n_partition)]
+
+    for index in np.argsort(costs, kind='mergesort')[::-1]:
+        load, i = heapq.heappop(heap)
+        partitions[i].append(dict((key, [value]) for key, value in cells[index].items()))
+        heapq.heappush(heap, (load + costs[index], i))
+
+    return [partition for partition in partitions if partition]
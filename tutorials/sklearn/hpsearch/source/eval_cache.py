@@ -0,0 +1,168 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent cache of cross validation results, shared across tasks.
+
+Each candidate is keyed on a hash of the parameters of the estimator with the
+candidate's parameters set, the training data, the settings of the search and
+the indices of its cross validation splits, so that fitting the same candidate
+on the same data and splits again returns the known result row instead.
+Splitters shuffling without a fixed random state draw new splits every time,
+so their candidates are never found in the cache.
+
+The cache is a set of tables, one per writer, each a pickled dict mapping
+keys to result rows:
+
+    <prefix>/<writer_id>.pkl
+
+Writers never share a table, so that no locking is needed; readers merge
+all tables.  So that readers do not load ever more tables, `compact` merges
+them into a single `<prefix>/compacted.<time>.pkl` table once a task is
+done.  The tables are kept in a bucket (`gs://bucket/prefix`) or in a local
+directory, using the storage classes of the task queue.
+"""
+
+import hashlib
+import pickle
+import time
+
+import numpy as np
+from sklearn.base import clone, is_classifier
+from sklearn.model_selection import check_cv
+
+from task_queue import GCSStorage, LocalStorage
+
+
+def _canonical(value):
+    """Returns a string identifying `value`, which unlike `repr` is never
+    abbreviated.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    elif hasattr(value, 'get_params'):
+        # The parameters of nested estimators are listed separately by
+        # `get_params(deep=True)`.
+        return '{}.{}'.format(type(value).__module__, type(value).__name__)
+    elif isinstance(value, (list, tuple)):
+        return '{}[{}]'.format(type(value).__name__, ', '.join(_canonical(item) for item in value))
+    elif isinstance(value, dict):
+        return '{{{}}}'.format(', '.join('{}: {}'.format(_canonical(key), _canonical(value[key])) for key in sorted(value, key=repr)))
+    else:
+        return hashlib.sha256(pickle.dumps(value, protocol=2)).hexdigest()
+
+
+def splits_key(search, X, y):
+    """Returns a hash of the indices of the cross validation splits `search`
+    uses on `X` and `y`.
+    """
+    cv = check_cv(search.cv, y, classifier=is_classifier(search.estimator))
+
+    digest = hashlib.sha256()
+    for train, test in cv.split(X, y):
+        digest.update(np.asarray(train, dtype=np.int64).tobytes())
+        digest.update(b'|')
+        digest.update(np.asarray(test, dtype=np.int64).tobytes())
+        digest.update(b'\n')
+
+    return digest.hexdigest()
+
+
+def search_key(search, data_key, X, y):
+    """Returns the part of the candidate keys shared by all candidates of
+    `search` fitted on `X` and `y`, the data identified by `data_key`.
+    """
+    return '\n'.join([data_key, splits_key(search, X, y), _canonical(search.scoring), repr(search.iid),
+                      repr(search.error_score), repr(search.return_train_score)])
+
+
+def candidate_key(estimator, params, search_key):
+    params = clone(estimator).set_params(**params).get_params(deep=True)
+    lines = ['{}={}'.format(name, _canonical(params[name])) for name in sorted(params)]
+    lines.insert(0, _canonical(estimator))
+    lines.append(search_key)
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+class EvalCache(object):
+    def __init__(self, storage, prefix, writer_id):
+        self.storage = storage
+        self.prefix = prefix
+        self.writer_id = writer_id
+
+        self._rows = None
+        self._new_rows = {}
+
+    def _load(self):
+        if self._rows is None:
+            self._rows = {}
+            for name in sorted(self.storage.list('{}/'.format(self.prefix))):
+                table = self.storage.read(name)
+                self._rows.update(table)
+
+                # Keep the rows of a previous attempt of this writer, which
+                # `flush` would otherwise overwrite.
+                if name == self._table_name():
+                    self._new_rows.update(table)
+
+        return self._rows
+
+    def _table_name(self):
+        return '{}/{}.pkl'.format(self.prefix, self.writer_id)
+
+    def get(self, key):
+        return self._new_rows.get(key) or self._load().get(key)
+
+    def add(self, key, row):
+        self._new_rows[key] = row
+
+    def flush(self):
+        """Writes this writer's table, holding every row added so far."""
+        self._load()
+        if self._new_rows:
+            self.storage.write(self._table_name(), self._new_rows)
+
+    def compact(self):
+        """Merges all tables into one and deletes the merged tables.
+
+        A table rewritten while it is merged is kept.  A writer racing
+        with the deletion of its table may still lose the rows it just
+        wrote, which only causes cache misses later.
+        """
+        tables = self.storage.list('{}/'.format(self.prefix))
+        if len(tables) < 2:
+            return
+
+        rows = {}
+        for name in sorted(tables):
+            rows.update(self.storage.read(name))
+
+        self.storage.write('{}/compacted.{}.pkl'.format(self.prefix, int(time.time() * 1000)), rows)
+
+        current = self.storage.list('{}/'.format(self.prefix))
+        for name, updated in tables.items():
+            if current.get(name) == updated:
+                self.storage.delete(name)
+
+        print('Compacted {} evaluation cache tables with {} rows'.format(len(tables), len(rows)))
+
+
+def open_cache(cache_uri, writer_id):
+    """Opens the cache at `cache_uri`, either `gs://bucket/prefix` or a
+    local directory.
+    """
+    if cache_uri.startswith('gs://'):
+        bucket_name, _, prefix = cache_uri[len('gs://'):].partition('/')
+        return EvalCache(GCSStorage(bucket_name), prefix.strip('/') or 'eval_cache', writer_id)
+    else:
+        return EvalCache(LocalStorage(cache_uri), 'eval_cache', writer_id)
@@ -19,17 +19,36 @@ user-specified `bucket_name` and `object_name`.
 
 `download_and_unpickle`: The opposite of `pickle_and_upload`.
 
+`dump_and_upload`: Pickles a Python object to a local file, optionally gzip
+compressed, and uploads the file.  This keeps a single serialized copy of the
+object, on disk rather than in memory.
+
+`download_uri_and_load_array`: Downloads a `.npy` object to local disk and
+memory-maps it.
+
+When the `HPSEARCH_LOCAL_ROOT` environment variable is set, objects are kept
+in that local directory instead, see `local_storage.py`.
+
 For more information:
 https://cloud.google.com/storage/
 """
 
 import os
 import re
+import gzip
 import shutil
 import pickle
+import tempfile
+import threading
 
+import numpy as np
 from google.cloud import storage
 
+from local_storage import LocalBucket
+
+
+LOCAL_ROOT = os.environ.get('HPSEARCH_LOCAL_ROOT')
+
 
 def _make_gcs_uri(bucket_name, object_name):
     return 'gs://{}/{}'.format(bucket_name, object_name)
@@ -46,13 +65,37 @@ def _split_uri(gcs_uri):
     return bucket_name, object_name
 
 
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def _get_bucket(bucket_name):
+    """Returns a bucket of a storage client shared by all the helpers, so
+    that its credentials and connections are reused across calls.  Unlike
+    `get_bucket`, this does not make a request for the bucket's metadata.
+    """
+    if LOCAL_ROOT:
+        return LocalBucket(LOCAL_ROOT, bucket_name)
+
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+
+    return _storage_client.bucket(bucket_name)
+
+
 def get_blob(bucket_name, object_name):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = _get_bucket(bucket_name)
     blob = bucket.blob(object_name)
     return blob
 
 
+def list_blobs(bucket_name, prefix):
+    bucket = _get_bucket(bucket_name)
+    return bucket.list_blobs(prefix=prefix)
+
+
 def get_uri_blob(gcs_uri):
     bucket_name, object_name = _split_uri(gcs_uri)
     return get_blob(bucket_name, object_name)
@@ -62,13 +105,11 @@ def archive_and_upload(bucket_name, directory, extension='zip', object_name=None
     """Archives a directory and upload to GCS.
     Returns the object's GCS uri.
     """
-    storage_client = storage.Client()
     object_name = object_name or '{}.{}'.format(directory, extension)
 
     temp_filename = shutil.make_archive('_tmp', extension, directory)
 
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(object_name)
+    blob = get_blob(bucket_name, object_name)
     blob.upload_from_filename(temp_filename)
 
     os.remove(temp_filename)
@@ -81,15 +122,31 @@ def pickle_and_upload(obj, bucket_name, object_name):
     print('pickling data')
     pickle_str = pickle.dumps(obj)
 
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(object_name)
+    blob = get_blob(bucket_name, object_name)
     print('uploading object {} to bucket {}'.format(object_name, bucket_name))
     blob.upload_from_string(pickle_str)
 
     return _make_gcs_uri(bucket_name, object_name)
 
 
+def dump_and_upload(obj, bucket_name, object_name, compress=False):
+    """Returns the object's GCS uri."""
+    fd, temp_filename = tempfile.mkstemp()
+    os.close(fd)
+
+    print('pickling data')
+    with (gzip.open if compress else open)(temp_filename, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    blob = get_blob(bucket_name, object_name)
+    print('uploading object {} to bucket {}'.format(object_name, bucket_name))
+    blob.upload_from_filename(temp_filename)
+
+    os.remove(temp_filename)
+
+    return _make_gcs_uri(bucket_name, object_name)
+
+
 def download_and_unpickle(bucket_name, object_name):
     blob = get_blob(bucket_name, object_name)
     pickle_str = blob.download_as_string()
@@ -105,3 +162,17 @@ def download_uri_and_unpickle(gcs_uri):
     return obj
 
 
+def download_uri_and_load_array(gcs_uri, mmap_mode='r', local_dir=None):
+    """Streams a `.npy` object to local disk and loads it with `np.load`.
+
+    With the default `mmap_mode` the array is memory-mapped rather than read
+    into memory, so only the pages that are actually used are resident.
+    """
+    bucket_name, object_name = _split_uri(gcs_uri)
+    local_dir = local_dir or tempfile.mkdtemp()
+    filename = os.path.join(local_dir, os.path.basename(object_name))
+
+    print('downloading object {} from bucket {}'.format(object_name, bucket_name))
+    get_blob(bucket_name, object_name).download_to_filename(filename)
+
+    return np.load(filename, mmap_mode=mmap_mode, allow_pickle=False)
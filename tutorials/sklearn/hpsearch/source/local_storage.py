@@ -0,0 +1,94 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local directory standing in for Google Cloud Storage.
+
+`LocalBucket` and `LocalBlob` implement the subset of the `google.cloud.storage`
+bucket and blob interfaces used by the helpers.  The object `gs://bucket/name`
+is kept in the file `<root_dir>/bucket/name`.
+
+When the `HPSEARCH_LOCAL_ROOT` environment variable is set, the workers'
+`gcs_helper` uses this instead of GCS, see `../backends.py`.
+"""
+
+import datetime
+import os
+import shutil
+
+
+class LocalBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+
+    @property
+    def updated(self):
+        return datetime.datetime.utcfromtimestamp(os.path.getmtime(self.path))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _write(self, write):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # Another process created the directory.
+                pass
+
+        # Write then rename, so that readers never see a partial object.
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        write(temp_path)
+        os.rename(temp_path, self.path)
+
+    def upload_from_string(self, data, content_type=None):
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        self._write(write)
+
+    def upload_from_filename(self, filename, content_type=None):
+        self._write(lambda path: shutil.copyfile(filename, path))
+
+    def download_as_string(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket(object):
+    def __init__(self, root_dir, name):
+        self.name = name
+        self.path = os.path.join(root_dir, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix=''):
+        for dirpath, _, filenames in os.walk(os.path.join(self.path, os.path.dirname(prefix))):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.path).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    yield LocalBlob(self, name)
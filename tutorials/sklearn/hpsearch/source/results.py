@@ -0,0 +1,79 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conversions between a SearchCV's `cv_results_` and result rows.
+
+A result row is a dict holding the `params` of a single candidate and its
+entries of `cv_results_`, e.g. `mean_test_score`.  Rows are what workers
+exchange with the driver when results are streamed or fitted in batches,
+since unlike `cv_results_` they can be merged across workers.
+
+This module is used by both the workers and `../gke_parallel.py`.
+"""
+
+import numpy as np
+
+
+def cv_results_to_rows(cv_results):
+    """Splits a `cv_results_` dict into one dict per candidate.  Ranks and
+    the masked `param_*` arrays are dropped since they are only meaningful
+    within a single search.
+    """
+    keys = [key for key in cv_results if not key.startswith('param_') and not key.startswith('rank_')]
+    return [dict((key, cv_results[key][i]) for key in keys) for i in range(len(cv_results['params']))]
+
+
+def compact_cv_results(cv_results):
+    """Returns the columns of a `cv_results_` dict that are not derived from
+    others: the masked `param_*` arrays and the ranks are dropped.
+    """
+    return dict((key, value) for key, value in cv_results.items() if not key.startswith('param_') and not key.startswith('rank_'))
+
+
+def rows_to_cv_results(rows):
+    """The opposite of `cv_results_to_rows`: assembles result rows into a
+    `cv_results_` dict, ranking each `mean_test_*` score.
+    """
+    keys = sorted(set(key for row in rows for key in row if key != 'params'))
+
+    cv_results = {'params': [row['params'] for row in rows]}
+    for key in keys:
+        cv_results[key] = np.array([row.get(key, np.nan) for row in rows])
+
+    for key in keys:
+        if key.startswith('mean_test_'):
+            scores = cv_results[key]
+            # Same convention as sklearn: rank 1 is the best score, ties
+            # share the lowest rank.
+            cv_results['rank_' + key[len('mean_'):]] = np.array([np.sum(scores > score) + 1 for score in scores], dtype=np.int32)
+
+    return cv_results
+
+
+def score_key(cv_results, refit=None):
+    """Returns the key of the mean test score used to pick the best
+    candidate.  With several metrics, this is the metric named by `refit`
+    as in sklearn, or else the first metric.
+    """
+    if 'mean_test_score' in cv_results:
+        return 'mean_test_score'
+
+    if isinstance(refit, str):
+        return 'mean_test_{}'.format(refit)
+
+    return sorted(key for key in cv_results if key.startswith('mean_test_'))[0]
+
+
+def best_index(cv_results, refit=None):
+    return int(np.argmin(cv_results['rank' + score_key(cv_results, refit)[len('mean'):]]))
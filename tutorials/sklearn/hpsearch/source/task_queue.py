@@ -0,0 +1,199 @@
+# Copyright 2017, Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A queue of parameter batches shared by long-lived workers.
+
+The queue is a set of objects under a common prefix:
+
+    <prefix>/pending/<batch_id>.pkl             a list of parameter dicts
+    <prefix>/leases/<batch_id>/<worker_id>      one per worker fitting the batch
+    <prefix>/done/<batch_id>.pkl                the result rows of the batch
+    <prefix>/closed                             no more batches will be added
+
+Workers call `lease` to get a batch nobody is working on, fit it, and post
+the result rows with `complete`.  Once every batch is leased, a worker leases
+the batch with the oldest lease older than `lease_timeout` instead, which
+speculatively re-executes batches held by slow or dead workers.  A worker
+only leases when it is idle, so a batch it holds itself was leased before it
+crashed and restarted with the same worker id, and it takes that batch back
+first without waiting for the lease to expire.  The first result posted for a
+batch wins.
+
+`GCSStorage` keeps the objects in a bucket; `LocalStorage` keeps them in a
+local directory, which allows running the queue without a cluster.
+"""
+
+import calendar
+import os
+import pickle
+import random
+import time
+
+from gcs_helper import get_blob, list_blobs
+
+
+class GCSStorage(object):
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+
+    def list(self, prefix):
+        """Returns a dict mapping object names under prefix to their
+        creation times in seconds since the epoch.
+        """
+        return dict((blob.name, calendar.timegm(blob.updated.utctimetuple())) for blob in list_blobs(self.bucket_name, prefix))
+
+    def read(self, name):
+        return pickle.loads(get_blob(self.bucket_name, name).download_as_string())
+
+    def write(self, name, obj):
+        get_blob(self.bucket_name, name).upload_from_string(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def exists(self, name):
+        return get_blob(self.bucket_name, name).exists()
+
+    def delete(self, name):
+        get_blob(self.bucket_name, name).delete()
+
+
+class LocalStorage(object):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, name)
+
+    def list(self, prefix):
+        result = {}
+        for dirpath, _, filenames in os.walk(self._path(os.path.dirname(prefix))):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    result[name] = os.path.getmtime(path)
+
+        return result
+
+    def read(self, name):
+        with open(self._path(name), 'rb') as f:
+            return pickle.load(f)
+
+    def write(self, name, obj):
+        path = self._path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another worker created the directory.
+                pass
+
+        # Write then rename, so that readers never see a partial object.
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def delete(self, name):
+        os.remove(self._path(name))
+
+
+class TaskQueue(object):
+    # Workers pick at random among this many of the first available
+    # batches, so that workers starting together rarely pick the same batch
+    # while batches enqueued first are still fitted first.
+    SPREAD = 8
+
+    def __init__(self, storage, prefix, lease_timeout=600):
+        self.storage = storage
+        self.prefix = prefix
+        self.lease_timeout = lease_timeout
+
+    def _name(self, *parts):
+        return '/'.join((self.prefix,) + parts)
+
+    @staticmethod
+    def _batch_id(name):
+        return name.split('/')[-1].split('.')[0]
+
+    def put(self, batches, start=0):
+        """Adds batches, each a list of parameter dicts, to the queue.
+        Returns their batch ids.
+        """
+        batch_ids = []
+        for i, batch in enumerate(batches):
+            batch_id = '{:05d}'.format(start + i)
+            self.storage.write(self._name('pending', '{}.pkl'.format(batch_id)), batch)
+            batch_ids.append(batch_id)
+
+        return batch_ids
+
+    def close(self):
+        self.storage.write(self._name('closed'), True)
+
+    def pending_ids(self):
+        return set(self._batch_id(name) for name in self.storage.list(self._name('pending', '')))
+
+    def done_ids(self):
+        return set(self._batch_id(name) for name in self.storage.list(self._name('done', '')))
+
+    def finished(self):
+        """True once the queue is closed and every batch has a result."""
+        return self.storage.exists(self._name('closed')) and not (self.pending_ids() - self.done_ids())
+
+    def lease(self, worker_id):
+        """Returns a (batch_id, batch) tuple for the worker to fit, or None
+        if there is currently nothing to do.
+        """
+        available = sorted(self.pending_ids() - self.done_ids())
+        if not available:
+            return None
+
+        # Maps each batch id to the time of its most recent lease and the
+        # workers holding it.
+        leases = {}
+        for name, created in self.storage.list(self._name('leases', '')).items():
+            batch_id, holder = name.split('/')[-2:]
+            latest, holders = leases.get(batch_id, (0, set()))
+            leases[batch_id] = (max(latest, created), holders | set([holder]))
+
+        own = [batch_id for batch_id in available if worker_id in leases.get(batch_id, (0, set()))[1]]
+        unleased = [batch_id for batch_id in available if batch_id not in leases]
+        if own:
+            batch_id = own[0]
+            print('resuming batch {} leased before a restart'.format(batch_id))
+        elif unleased:
+            batch_id = random.choice(unleased[:self.SPREAD])
+        else:
+            now = time.time()
+            expired = [(leases[batch_id][0], batch_id) for batch_id in available
+                       if now - leases[batch_id][0] > self.lease_timeout]
+            if not expired:
+                return None
+
+            _, batch_id = min(expired)
+            print('speculatively re-executing batch {}'.format(batch_id))
+
+        self.storage.write(self._name('leases', batch_id, worker_id), time.time())
+        return batch_id, self.storage.read(self._name('pending', '{}.pkl'.format(batch_id)))
+
+    def complete(self, batch_id, rows):
+        name = self._name('done', '{}.pkl'.format(batch_id))
+        if not self.storage.exists(name):
+            self.storage.write(name, rows)
+
+    def results(self):
+        """Returns a dict mapping batch ids to their result rows."""
+        return dict((batch_id, self.storage.read(self._name('done', '{}.pkl'.format(batch_id)))) for batch_id in self.done_ids())
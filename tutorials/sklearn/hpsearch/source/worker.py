@@ -16,24 +16,88 @@
 
 `execute`: Gets data and a pickled copy of a SearchCV object from GCS, calls
 the `fit` method on that object, and persist the fitted object to GCS.
+
+With `stream=True`, the candidates of a GridSearchCV or RandomizedSearchCV are
+fitted in small chunks instead, and the result rows of each chunk are uploaded
+as soon as it completes so that the driver can follow the search.  With
+`n_samples`, the search is fitted on a fixed random subsample of the data, and
+with `refit=False` the best estimator is not refitted; both are used by the
+early rounds of successive halving.  With `cache_uri`, candidates found in the
+evaluation cache are not fitted again, see `eval_cache.py`.  With `lean=True`,
+only the compacted `cv_results_` and the best estimator are uploaded, each
+serialized once, instead of two copies of the fitted search object.
+
+Both return, and upload next to their results, the time spent loading data,
+fitting and uploading results, which `../benchmark_local_backend.py` uses to
+measure serialization overhead.
+
+`execute_queue`: Gets data and a pickled copy of a SearchCV object from GCS,
+then repeatedly leases a batch of parameter settings from the task's queue,
+fits them and posts their scores, until the queue is finished.
 """
 
 import argparse
 import datetime
 import logging
+import multiprocessing
 import pickle
 import re
+import time
+import numpy as np
 from google.cloud import storage
-from gcs_helper import pickle_and_upload, download_and_unpickle, download_uri_and_unpickle
-from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
+from gcs_helper import pickle_and_upload, dump_and_upload, download_and_unpickle, download_uri_and_unpickle, download_uri_and_load_array
+from eval_cache import search_key, candidate_key, open_cache
+from results import compact_cv_results, cv_results_to_rows, rows_to_cv_results, score_key, best_index
+from task_queue import GCSStorage, TaskQueue
+from sklearn.base import clone, is_classifier
+from sklearn.metrics.scorer import _check_multimetric_scoring
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, ParameterGrid, ParameterSampler, check_cv
+from sklearn.utils import safe_indexing
+from sklearn.utils.validation import _num_samples
 from skopt import BayesSearchCV
 
 
-def execute(bucket_name, task_name, worker_id, X_uri, y_uri):
-    X = download_uri_and_unpickle(X_uri)
-    y = download_uri_and_unpickle(y_uri)
+# Seconds to wait before asking an empty queue for work again.
+QUEUE_POLL_INTERVAL = 10
+
+
+def load_data(uri):
+    # Arrays uploaded in the `.npy` format are memory-mapped from local disk
+    # instead of being unpickled into memory.
+    if uri.endswith('.npy'):
+        return download_uri_and_load_array(uri)
+    else:
+        return download_uri_and_unpickle(uri)
+
+
+def subsample(X, y, n_samples, random_state=0):
+    # Every worker draws the same rows, so that the scores of candidates
+    # fitted by different workers remain comparable.
+    indices = np.random.RandomState(random_state).permutation(_num_samples(X))[:n_samples]
+    indices.sort()
+    return safe_indexing(X, indices), safe_indexing(y, indices)
+
+
+def data_key(X_uri, y_uri, n_samples=None):
+    # Uploaded data is content addressed, so its uris identify it.
+    return '\n'.join([X_uri, y_uri, repr(n_samples)])
+
+
+def execute(bucket_name, task_name, worker_id, X_uri, y_uri, stream=False, n_samples=None, refit=True, cache_uri=None,
+            lean=False, compress=False):
+    timings = {}
+    start = time.time()
+
+    X = load_data(X_uri)
+    y = load_data(y_uri)
     search = download_and_unpickle(bucket_name, '{}/search.pkl'.format(task_name))
 
+    if n_samples is not None:
+        X, y = subsample(X, y, n_samples)
+
+    if not refit:
+        search.refit = False
+
     if type(search) == GridSearchCV:
         param_grid = download_and_unpickle(bucket_name, '{}/{}/param_grid.pkl'.format(task_name, worker_id))
         search.param_grid = param_grid
@@ -48,18 +112,203 @@ def execute(bucket_name, task_name, worker_id, X_uri, y_uri):
         search_spaces = download_and_unpickle(bucket_name, '{}/{}/search_spaces.pkl'.format(task_name, worker_id))
         search.search_spaces = search_spaces
 
+    timings['load'] = time.time() - start
+    start = time.time()
+
     # Calling `search.fit` on the pickled of the SearchCV object, in particular
     # this will be using the same `n_jobs` as when the original copy of the
     # object created in the notebook.
-    search.fit(X, y)
+    if (stream or cache_uri) and type(search) in (GridSearchCV, RandomizedSearchCV):
+        partial_prefix = '{}/{}/partial'.format(task_name, worker_id) if stream else None
+        cache = open_cache(cache_uri, '{}.{}'.format(task_name, worker_id)) if cache_uri else None
+        fit_rows(search, X, y, bucket_name, partial_prefix, cache, data_key(X_uri, y_uri, n_samples))
+    else:
+        search.fit(X, y)
+
+    timings['fit'] = time.time() - start
+    start = time.time()
+
+    if lean:
+        upload_lean(search, bucket_name, '{}/{}'.format(task_name, worker_id), compress)
+    else:
+        pickle_and_upload(search, bucket_name, '{}/{}/fitted_search.pkl'.format(task_name, worker_id))
+
+        # Save a copy of the search object without the estimator, useful when the
+        # user only wants to examine the scores without having to download the
+        # estimator, which can sometimes be large.
+        if search.refit:
+            del search.best_estimator_
+        pickle_and_upload(search, bucket_name, '{}/{}/fitted_search_without_estimator.pkl'.format(task_name, worker_id))
+
+    timings['upload'] = time.time() - start
+    pickle_and_upload(timings, bucket_name, '{}/{}/timings.pkl'.format(task_name, worker_id))
+
+    return timings
+
+
+def upload_lean(search, bucket_name, prefix, compress=False):
+    # The best estimator is uploaded and released before the results table,
+    # whose presence tells the driver that the worker is done.
+    if search.refit:
+        dump_and_upload(search.best_estimator_, bucket_name, '{}/best_estimator.pkl{}'.format(prefix, '.gz' if compress else ''), compress)
+        del search.best_estimator_
+
+    dump_and_upload(compact_cv_results(search.cv_results_), bucket_name, '{}/cv_results.pkl'.format(prefix))
+
+
+def fit_candidates(search, candidates, X, y):
+    """Cross-validates each dict of parameters in `candidates` with the
+    settings of `search`, without refitting.  Returns one result row per
+    candidate.
+    """
+    # A GridSearchCV over single-cell grids fits exactly the candidates.
+    grid_search = GridSearchCV(
+        search.estimator, [dict((key, [value]) for key, value in params.items()) for params in candidates],
+        scoring=search.scoring, n_jobs=search.n_jobs, iid=search.iid, refit=False, cv=search.cv,
+        verbose=search.verbose, pre_dispatch=search.pre_dispatch, error_score=search.error_score,
+        return_train_score=search.return_train_score)
+    grid_search.fit(X, y)
+
+    return cv_results_to_rows(grid_search.cv_results_)
+
+
+def list_candidates(search):
+    if type(search) == GridSearchCV:
+        return list(ParameterGrid(search.param_grid))
+    else:
+        return list(ParameterSampler(search.param_distributions, search.n_iter, random_state=search.random_state))
+
+
+def set_search_results(search, rows, X, y):
+    """Sets the attributes `search.fit` would have set from result rows,
+    refitting the best estimator if needed.
+    """
+    scorers, multimetric = _check_multimetric_scoring(search.estimator, scoring=search.scoring)
+
+    search.cv_results_ = rows_to_cv_results(rows)
+    search.scorer_ = scorers if multimetric else scorers['score']
+    search.multimetric_ = multimetric
+    search.n_splits_ = check_cv(search.cv, y, classifier=is_classifier(search.estimator)).get_n_splits(X, y)
 
-    pickle_and_upload(search, bucket_name, '{}/{}/fitted_search.pkl'.format(task_name, worker_id))
+    search.best_index_ = best_index(search.cv_results_, search.refit)
+    search.best_params_ = search.cv_results_['params'][search.best_index_]
+    search.best_score_ = search.cv_results_[score_key(search.cv_results_, search.refit)][search.best_index_]
 
-    # Save a copy of the search object without the estimator, useful when the
-    # user only wants to examine the scores without having to download the
-    # estimator, which can sometimes be large.
-    del search.best_estimator_
-    pickle_and_upload(search, bucket_name, '{}/{}/fitted_search_without_estimator.pkl'.format(task_name, worker_id))
+    if search.refit:
+        search.best_estimator_ = clone(search.estimator).set_params(**search.best_params_)
+        search.best_estimator_.fit(X, y)
+
+
+def lookup_candidates(search, candidates, cache, data_key, X, y):
+    """Returns the cache keys of the candidates and their cached result
+    rows, None for candidates not in the cache.
+    """
+    shared_key = search_key(search, data_key, X, y)
+    keys = [candidate_key(search.estimator, params, shared_key) for params in candidates]
+    return keys, [cache.get(key) for key in keys]
+
+
+def fit_rows(search, X, y, bucket_name, partial_prefix=None, cache=None, data_key=None):
+    """Fits the candidates of `search` one chunk at a time and sets its
+    results.  With `partial_prefix`, the result rows of each chunk are
+    uploaded to `partial_prefix/<chunk>.pkl` as soon as it is done.  With
+    `cache`, cached candidates are not fitted again.
+    """
+    candidates = list_candidates(search)
+
+    if cache is not None:
+        keys, rows = lookup_candidates(search, candidates, cache, data_key, X, y)
+        print('{} of {} candidates found in the cache'.format(len([row for row in rows if row is not None]), len(candidates)))
+    else:
+        keys, rows = None, [None] * len(candidates)
+
+    todo = [i for i, row in enumerate(rows) if row is None]
+
+    if partial_prefix is not None:
+        # Chunks of one candidate per core keep all cores busy, since each
+        # candidate is fitted once per cross validation fold.
+        n_jobs = search.n_jobs if search.n_jobs > 0 else multiprocessing.cpu_count() + 1 + search.n_jobs
+        chunk_size = max(n_jobs, 1)
+    else:
+        chunk_size = max(len(todo), 1)
+
+    chunks = [[i for i, row in enumerate(rows) if row is not None]]
+    chunks.extend(todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size))
+
+    for chunk_id, chunk in enumerate(chunks):
+        if not chunk:
+            continue
+
+        # The first chunk holds the cached candidates.
+        if chunk_id > 0:
+            chunk_rows = fit_candidates(search, [candidates[i] for i in chunk], X, y)
+            for i, row in zip(chunk, chunk_rows):
+                rows[i] = row
+                if cache is not None:
+                    cache.add(keys[i], row)
+
+            if cache is not None:
+                cache.flush()
+
+        if partial_prefix is not None:
+            pickle_and_upload([rows[i] for i in chunk], bucket_name, '{}/{:05d}.pkl'.format(partial_prefix, chunk_id))
+
+    set_search_results(search, rows, X, y)
+
+
+def execute_queue(bucket_name, task_name, worker_id, X_uri, y_uri, cache_uri=None, lease_timeout=600):
+    timings = {'fit': 0.0, 'upload': 0.0, 'wait': 0.0}
+    start = time.time()
+
+    X = load_data(X_uri)
+    y = load_data(y_uri)
+    search = download_and_unpickle(bucket_name, '{}/search.pkl'.format(task_name))
+
+    timings['load'] = time.time() - start
+
+    queue = TaskQueue(GCSStorage(bucket_name), '{}/queue'.format(task_name), lease_timeout)
+    cache = open_cache(cache_uri, '{}.{}'.format(task_name, worker_id)) if cache_uri else None
+
+    while True:
+        lease = queue.lease(worker_id)
+
+        if lease is None:
+            if queue.finished():
+                break
+
+            time.sleep(QUEUE_POLL_INTERVAL)
+            timings['wait'] += QUEUE_POLL_INTERVAL
+            continue
+
+        batch_id, candidates = lease
+
+        if cache is not None:
+            keys, rows = lookup_candidates(search, candidates, cache, data_key(X_uri, y_uri), X, y)
+        else:
+            keys, rows = None, [None] * len(candidates)
+
+        todo = [i for i, row in enumerate(rows) if row is None]
+        print('fitting batch {} with {} candidates, {} cached'.format(batch_id, len(todo), len(rows) - len(todo)))
+
+        start = time.time()
+        if todo:
+            for i, row in zip(todo, fit_candidates(search, [candidates[i] for i in todo], X, y)):
+                rows[i] = row
+                if cache is not None:
+                    cache.add(keys[i], row)
+
+            if cache is not None:
+                cache.flush()
+
+        timings['fit'] += time.time() - start
+        start = time.time()
+
+        queue.complete(batch_id, rows)
+        timings['upload'] += time.time() - start
+
+    pickle_and_upload(timings, bucket_name, '{}/{}/timings.pkl'.format(task_name, worker_id))
+
+    return timings
 
 
 if __name__ == '__main__':
@@ -74,6 +323,19 @@ if __name__ == '__main__':
     parser.add_argument('X_uri', type=str)
     parser.add_argument('y_uri', type=str)
 
+    parser.add_argument('--queue', action='store_true', help='Fit batches leased from the task queue.')
+    parser.add_argument('--lease_timeout', type=int, default=600, help='Seconds after which a leased batch may be leased again.')
+    parser.add_argument('--stream', action='store_true', help='Upload result rows as candidates are fitted.')
+    parser.add_argument('--n_samples', type=int, default=None, help='Fit on a random subsample of this many rows.')
+    parser.add_argument('--no_refit', action='store_true', help='Do not refit the best estimator.')
+    parser.add_argument('--cache_uri', type=str, default=None, help='Location of the evaluation cache.')
+    parser.add_argument('--lean', action='store_true', help='Upload only the results table and the best estimator.')
+    parser.add_argument('--compress', action='store_true', help='Compress the best estimator with gzip.')
+
     args = parser.parse_args()
 
-    execute(args.bucket_name, args.task_name, args.worker_id, args.X_uri, args.y_uri)
+    if args.queue:
+        execute_queue(args.bucket_name, args.task_name, args.worker_id, args.X_uri, args.y_uri, args.cache_uri, args.lease_timeout)
+    else:
+        execute(args.bucket_name, args.task_name, args.worker_id, args.X_uri, args.y_uri, args.stream, args.n_samples, not args.no_refit, args.cache_uri,
+                args.lean, args.compress)